@@ -0,0 +1,40 @@
+from django.http import HttpResponse, HttpResponseNotAllowed
+from rest_framework.renderers import JSONRenderer
+from recipes.async_db import run_in_thread
+from recipes.ingredient_index import ingredient_index
+from api.views import RecipeViewSet, ingredient_index_response
+
+
+# DRF 3.12 не умеет async-views, поэтому аутентификация, запросы
+# к базе и сериализация рецепта выполняются в пуле потоков,
+# а цикл событий тем временем обслуживает другие запросы
+recipe_detail_view = RecipeViewSet.as_view({
+    'get': 'retrieve',
+    'put': 'update',
+    'patch': 'partial_update',
+    'delete': 'destroy',
+})
+
+
+async def recipe_detail(request, pk):
+    return await run_in_thread(recipe_detail_view)(request, pk=pk)
+
+
+# csrf_exempt оборачивает view в синхронную функцию, поэтому флаг
+# ставится напрямую, как это делает DRF для своих views
+recipe_detail.csrf_exempt = True
+
+
+async def ingredient_list(request):
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponseNotAllowed(('GET', 'HEAD'))
+    # Проверка версии индекса обращается к кэшу и иногда к базе,
+    # сам поиск идёт в памяти
+    await run_in_thread(ingredient_index.ensure_fresh)()
+    name = request.GET.get('name')
+    if name:
+        return HttpResponse(
+            JSONRenderer().render(ingredient_index.lookup(name)),
+            content_type='application/json'
+        )
+    return ingredient_index_response(request)
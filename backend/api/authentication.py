@@ -0,0 +1,30 @@
+import hashlib
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.authentication import TokenAuthentication
+
+
+def token_cache_key(key):
+    # Сам токен в ключ кэша не попадает
+    return f'auth_token:{hashlib.sha256(key.encode()).hexdigest()}'
+
+
+def forget_token(key):
+    cache.delete(token_cache_key(key))
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    # Пользователь по токену берётся из кэша, в базу запрос уходит
+    # только при промахе. Счётчики устаревшей копии save() не
+    # записывает (CustomUser.COUNTER_FIELDS). Записи удаляются сигналами
+    # при выходе, удалении токена и сохранении пользователя (смена
+    # пароля, деактивация), а TTL ограничивает устаревание после
+    # изменений в обход сигналов, например через QuerySet.update()
+
+    def authenticate_credentials(self, key):
+        cache_key = token_cache_key(key)
+        credentials = cache.get(cache_key)
+        if credentials is None:
+            credentials = super().authenticate_credentials(key)
+            cache.set(cache_key, credentials, settings.AUTH_TOKEN_CACHE_TTL)
+        return credentials
@@ -0,0 +1,45 @@
+from django.conf import settings
+from drf_extra_fields.fields import Base64ImageField
+from PIL import Image
+from rest_framework import serializers
+from recipes.images import reencode
+
+
+class RecipeImageField(Base64ImageField):
+    # Размер проверяется по длине base64 до декодирования, размеры
+    # в пикселях — по заголовку до разбора всего изображения
+    default_error_messages = {
+        'too_large': 'Размер изображения превышает {max_size} байт.',
+        'too_many_pixels': 'Слишком большое разрешение изображения.',
+    }
+
+    def to_internal_value(self, data):
+        if isinstance(data, str):
+            encoded = data.partition(';base64,')[2] or data
+            if len(encoded) * 3 // 4 > settings.RECIPE_IMAGE_MAX_SIZE:
+                self.fail('too_large',
+                          max_size=settings.RECIPE_IMAGE_MAX_SIZE)
+        image = super().to_internal_value(data)
+        if image is None:
+            return image
+        image.seek(0)
+        with Image.open(image) as header:
+            width, height = header.size
+        if width * height > settings.RECIPE_IMAGE_MAX_PIXELS:
+            self.fail('too_many_pixels')
+        return reencode(image)
+
+
+class RenditionField(serializers.ImageField):
+    # URL уменьшенной копии изображения рецепта, пока её нет — оригинала
+
+    def __init__(self, rendition, **kwargs):
+        self.rendition = rendition
+        kwargs['source'] = '*'
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, recipe):
+        return super().to_representation(
+            getattr(recipe, self.rendition) or recipe.image
+        )
@@ -1,12 +1,32 @@
 import django_filters
 from django_filters import rest_framework as filters
-from recipes.models import Recipe, Ingredient
+from django.db.models import Case, IntegerField, When
+from recipes.models import Recipe
+from recipes.popularity import PERIODS, order_by_popularity
+from recipes.recipe_index import recipe_ingredient_index
+from recipes.search import search_recipes
+from recipes.short_links import order_by_clicks
+
+
+class IdInFilter(filters.BaseInFilter, filters.NumberFilter):
+    pass
 
 
 class RecipeFilter(django_filters.FilterSet):
     author = filters.NumberFilter(field_name='author__id')
     is_favorited = filters.NumberFilter(method='filter_favorited')
     is_in_shopping_cart = filters.NumberFilter(method='filter_shopping_cart')
+    search = filters.CharFilter(method='filter_search')
+    ingredients = IdInFilter(method='filter_ingredients')
+    exclude_ingredients = IdInFilter(method='filter_ingredients')
+    # Объявлен последним, чтобы явная сортировка перекрывала порядок
+    # подбора по продуктам
+    ordering = filters.ChoiceFilter(choices=(('popular', 'popular'),
+                                             ('viral', 'viral')),
+                                    method='filter_ordering')
+    period = filters.ChoiceFilter(choices=[(period, period)
+                                           for period in PERIODS],
+                                  method='filter_period')
 
     def filter_favorited(self, recipes, name, value):
         user = self.request.user
@@ -24,15 +44,45 @@ class RecipeFilter(django_filters.FilterSet):
             return recipes.filter(shopping_carts__user=user)
         return recipes
 
-    class Meta:
-        model = Recipe
-        fields = ['author', 'is_favorited', 'is_in_shopping_cart']
+    def filter_search(self, recipes, name, value):
+        return search_recipes(recipes, value) if value.strip() else recipes
 
+    def filter_ingredients(self, recipes, name, value):
+        # Подбор по имеющимся продуктам: оба параметра разбираются
+        # за один проход по индексу, когда фильтр вызван для ingredients
+        data = self.form.cleaned_data
+        include = [int(pk) for pk in data.get('ingredients') or ()]
+        exclude = [int(pk) for pk in data.get('exclude_ingredients') or ()]
+        if not include:
+            excluded = recipe_ingredient_index.recipes_with(exclude)
+            return recipes.exclude(id__in=excluded)
+        if name != 'ingredients':
+            return recipes
+        # Остальные фильтры уже применены: их рецепты отбираются до
+        # ограничения RECIPE_MATCH_LIMIT, иначе оно отсекло бы подходящие
+        allowed = None
+        if recipes.query.where:
+            allowed = set(recipes.values_list('id', flat=True))
+        ranked = recipe_ingredient_index.match(include, exclude,
+                                               allowed=allowed)
+        recipe_ids = [recipe_id for _, _, recipe_id in ranked]
+        return recipes.filter(id__in=recipe_ids).order_by(Case(
+            *(When(id=recipe_id, then=position)
+              for position, recipe_id in enumerate(recipe_ids)),
+            output_field=IntegerField()
+        ))
 
-class IngredientFilter(django_filters.FilterSet):
-    name = django_filters.CharFilter(field_name='name',
-                                     lookup_expr='istartswith')
+    def filter_ordering(self, recipes, name, value):
+        if value == 'viral':
+            return order_by_clicks(recipes)
+        period = self.form.cleaned_data.get('period') or 'week'
+        return order_by_popularity(recipes, period)
+
+    def filter_period(self, recipes, name, value):
+        # Окно уточняет только ordering=popular
+        return recipes
 
     class Meta:
-        model = Ingredient
-        fields = ['name']
+        model = Recipe
+        fields = ['author', 'is_favorited', 'is_in_shopping_cart', 'search',
+                  'ingredients', 'exclude_ingredients', 'ordering', 'period']
@@ -0,0 +1,183 @@
+import logging
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+
+logger = logging.getLogger('api.sql')
+
+# Статистика текущего запроса. Контекст копируется в потоки
+# sync_to_async, поэтому запросы async-views из пула потоков
+# попадают в статистику своего запроса, а фоновые задачи — нет
+current_stats = ContextVar('query_stats', default=None)
+
+FINGERPRINT_RULES = (
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'%s'), '?'),
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(...)'),
+    (re.compile(r'\s+'), ' '),
+)
+
+
+def fingerprint(sql):
+    # Запрос без значений: одинаковые запросы с разными параметрами
+    # и списками IN разной длины дают один отпечаток
+    for pattern, replacement in FINGERPRINT_RULES:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip()
+
+
+def view_tag(view_func, method):
+    # Для DRF — класс view и действие viewset, для остальных — имя функции
+    cls = getattr(view_func, 'cls', None)
+    if cls is None:
+        return f'{view_func.__module__}.{view_func.__name__}'
+    action = (getattr(view_func, 'actions', None) or {}).get(method.lower())
+    return f'{cls.__name__}.{action}' if action else cls.__name__
+
+
+class QueryStats:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.slowest_duration = 0.0
+        self.slowest_sql = ''
+        self.fingerprints = Counter()
+        self.view = ''
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - started
+            with self._lock:
+                self.add(sql, duration)
+
+    def add(self, sql, duration):
+        self.count += 1
+        self.duration += duration
+        if duration >= self.slowest_duration:
+            self.slowest_duration = duration
+            self.slowest_sql = sql
+        self.fingerprints[fingerprint(sql)] += 1
+
+    def repeated(self):
+        threshold = settings.SQL_REPEATED_QUERY_THRESHOLD
+        return [(sql, count) for sql, count in self.fingerprints.most_common()
+                if count >= threshold]
+
+
+def record_query(execute, sql, params, many, context):
+    stats = current_stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    return stats(execute, sql, params, many, context)
+
+
+def install_recorder(connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+# Обёртка ставится на каждое соединение любого потока один раз
+connection_created.connect(install_recorder)
+
+
+class QueryStatsMiddleware:
+    # Считает запросы к базе, их время, самый медленный запрос и
+    # повторяющиеся отпечатки (признак N+1) для каждого запроса к API.
+    # При DEBUG отдаёт их в заголовках X-SQL-*, при превышении бюджета
+    # пишет в лог api.sql. Работает и в WSGI, и в ASGI без перевода
+    # цепочки middleware в синхронный режим
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        stats = request.query_stats = QueryStats()
+        with self.recording(stats):
+            response = self.get_response(request)
+        return self.finish(request, response, stats)
+
+    async def __acall__(self, request):
+        stats = request.query_stats = QueryStats()
+        with self.recording(stats):
+            response = await self.get_response(request)
+        return self.finish(request, response, stats)
+
+    def finish(self, request, response, stats):
+        response.query_stats = stats
+        self.add_headers(response, stats)
+        if response.streaming:
+            # Тело потокового ответа читается из базы уже после выхода
+            # из middleware: запросы досчитываются при его отдаче,
+            # а заголовки содержат только запросы до начала потока
+            response.streaming_content = self.stream(
+                request, response.streaming_content, stats
+            )
+        else:
+            self.report(request, stats)
+        return response
+
+    @contextmanager
+    def recording(self, stats):
+        # Соединения, открытые до загрузки middleware, сигнала не видели
+        for connection in connections.all():
+            install_recorder(connection)
+        token = current_stats.set(stats)
+        try:
+            yield
+        finally:
+            current_stats.reset(token)
+
+    def stream(self, request, content, stats):
+        with self.recording(stats):
+            yield from content
+        self.report(request, stats)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.query_stats.view = view_tag(view_func, request.method)
+
+    def get_budget(self, view):
+        budget = settings.SQL_BUDGETS.get(view, {})
+        return (budget.get('queries', settings.SQL_QUERY_BUDGET),
+                budget.get('time_ms', settings.SQL_TIME_BUDGET_MS))
+
+    def add_headers(self, response, stats):
+        if settings.DEBUG:
+            response['X-SQL-View'] = stats.view
+            response['X-SQL-Queries'] = stats.count
+            response['X-SQL-Time'] = f'{stats.duration * 1000:.1f}'
+            response['X-SQL-Slowest'] = f'{stats.slowest_duration * 1000:.1f}'
+            response['X-SQL-Repeated'] = len(stats.repeated())
+
+    def report(self, request, stats):
+        max_queries, max_time = self.get_budget(stats.view)
+        if stats.count <= max_queries and stats.duration * 1000 <= max_time:
+            return
+        logger.warning(
+            '%s %s (%s): %d запросов за %.1f мс, самый медленный %.1f мс: '
+            '%s; повторы: %s',
+            request.method, request.path, stats.view, stats.count,
+            stats.duration * 1000, stats.slowest_duration * 1000,
+            stats.slowest_sql[:500],
+            '; '.join(f'{count}× {sql[:200]}'
+                      for sql, count in stats.repeated()) or 'нет'
+        )
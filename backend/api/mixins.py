@@ -0,0 +1,74 @@
+import hashlib
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework.response import Response
+from recipes.cache import (RECIPES_LIST_VERSION_KEY, get_version,
+                           recipe_version_key)
+
+
+class AnonymousCacheMixin:
+    # Кэширует данные ответов list и retrieve для анонимных
+    # пользователей. Версия в ключе меняется сигналами при изменении
+    # рецепта, его продуктов или профиля автора
+
+    def _cached_response(self, request, version_key, handler, *args,
+                         **kwargs):
+        if request.user.is_authenticated:
+            return handler(request, *args, **kwargs)
+
+        key = (f'response:{version_key}:{get_version(version_key)}:'
+               f'{request.get_host()}:{request.get_full_path()}')
+        data = cache.get(key)
+        if data is not None:
+            return Response(data)
+
+        response = handler(request, *args, **kwargs)
+        if response.status_code == 200:
+            cache.set(key, response.data, settings.RECIPE_CACHE_TIMEOUT)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self._cached_response(request, RECIPES_LIST_VERSION_KEY,
+                                     super().list, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self._cached_response(
+            request, recipe_version_key(kwargs[self.lookup_field]),
+            super().retrieve, *args, **kwargs
+        )
+
+
+class ConditionalRetrieveMixin:
+    # Отвечает 304 на If-None-Match/If-Modified-Since до сериализации.
+    # get_retrieve_validators возвращает (etag, last_modified) или None,
+    # если объекта нет. Ответ авторизованному пользователю зависит
+    # от его подписок и списков, поэтому для него проверяется только
+    # ETag, в который эти флаги входят
+
+    def get_retrieve_validators(self):
+        # По умолчанию условных ответов нет
+        return None
+
+    def retrieve(self, request, *args, **kwargs):
+        validators = self.get_retrieve_validators()
+        if validators is None:
+            return super().retrieve(request, *args, **kwargs)
+
+        etag, last_modified = validators
+        etag = quote_etag(hashlib.md5(
+            '|'.join(map(str, etag)).encode()
+        ).hexdigest())
+        if request.user.is_authenticated:
+            last_modified = None
+        timestamp = last_modified and int(last_modified.timestamp())
+
+        response = get_conditional_response(request, etag=etag,
+                                            last_modified=timestamp)
+        if response is None:
+            response = super().retrieve(request, *args, **kwargs)
+        response['ETag'] = etag
+        if timestamp:
+            response['Last-Modified'] = http_date(timestamp)
+        return response
@@ -1,7 +1,77 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
 from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 
 
 class CustomPagination(LimitOffsetPagination):
     default_limit = 6
     limit_query_param = 'limit'
     offset_query_param = 'offset'
+
+
+class RecipePagination(CustomPagination):
+    # По умолчанию limit/offset. Если в запросе есть параметр cursor
+    # (для первой страницы — пустой), страницы строятся по ключу
+    # (created_at, id): база не пропускает offset строк, и глубина
+    # прокрутки не влияет на скорость ответа. Выдача со своим порядком
+    # (поиск по рангу, подбор по продуктам, популярность, лента)
+    # курсор бы пересортировал, поэтому она всегда идёт через
+    # limit/offset
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Неверный курсор'
+
+    def encode_cursor(self, recipe):
+        position = f'{recipe.created_at.isoformat()}|{recipe.id}'
+        return urlsafe_b64encode(position.encode()).decode()
+
+    def decode_cursor(self, cursor):
+        try:
+            created_at, recipe_id = (urlsafe_b64decode(cursor.encode())
+                                     .decode().split('|'))
+            return datetime.fromisoformat(created_at), int(recipe_id)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.use_cursor = (self.cursor_query_param in request.query_params
+                           and not queryset.query.order_by)
+        if not self.use_cursor:
+            return super().paginate_queryset(queryset, request, view)
+
+        self.request = request
+        self.limit = self.get_limit(request)
+        queryset = queryset.order_by('-created_at', '-id')
+        cursor = request.query_params[self.cursor_query_param]
+        if cursor:
+            created_at, recipe_id = self.decode_cursor(cursor)
+            queryset = queryset.filter(
+                Q(created_at__lt=created_at)
+                | Q(created_at=created_at, id__lt=recipe_id)
+            )
+
+        page = list(queryset[:self.limit + 1])
+        self.has_next = len(page) > self.limit
+        page = page[:self.limit]
+        self.next_cursor = self.encode_cursor(page[-1]) if page else None
+        return page
+
+    def get_next_link(self):
+        if not self.use_cursor:
+            return super().get_next_link()
+        if not self.has_next:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(),
+                                   self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_response(self, data):
+        if not self.use_cursor:
+            return super().get_paginated_response(data)
+        return Response({
+            'next': self.get_next_link(),
+            'previous': None,
+            'results': data
+        })
@@ -0,0 +1,74 @@
+import csv
+import json
+from abc import ABCMeta, abstractmethod
+from django.template.loader import render_to_string
+from django.utils.html import format_html
+from rest_framework.renderers import BaseRenderer
+
+
+class ShoppingCartRenderer(BaseRenderer, metaclass=ABCMeta):
+    # Список покупок отдаётся потоком через stream(), а render() нужен
+    # только для ответов с ошибками
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return json.dumps(data, ensure_ascii=False).encode(self.charset)
+
+    def get_content_type(self):
+        return f'{self.media_type}; charset={self.charset}'
+
+    @abstractmethod
+    def stream(self, items):
+        # Возвращает части ответа по мере чтения строк списка
+        pass
+
+
+class ShoppingCartTextRenderer(ShoppingCartRenderer):
+    media_type = 'text/plain'
+    format = 'txt'
+
+    def stream(self, items):
+        yield 'Список покупок\n\n'
+        for item in items:
+            yield '{name} ({measurement_unit}) — {amount_total}\n'.format(
+                **item
+            )
+
+
+class Echo:
+    def write(self, value):
+        return value
+
+
+class ShoppingCartCSVRenderer(ShoppingCartRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+    def stream(self, items):
+        writer = csv.writer(Echo())
+        yield writer.writerow(('Продукт', 'Единица измерения', 'Количество'))
+        for item in items:
+            yield writer.writerow((item['name'], item['measurement_unit'],
+                                   item['amount_total']))
+
+
+class ShoppingCartHTMLRenderer(ShoppingCartRenderer):
+    media_type = 'text/html'
+    format = 'html'
+    template_name = 'shopping_cart.html'
+    items_placeholder = '<!-- items -->'
+
+    def stream(self, items):
+        # Шаблон рендерится один раз, строки списка вставляются
+        # между его частями по мере чтения из базы
+        head, tail = render_to_string(self.template_name).split(
+            self.items_placeholder
+        )
+        yield head
+        for item in items:
+            yield format_html(
+                '<div class="item"><div class="checkbox"></div>'
+                '<div class="text">{} — {} {}</div></div>\n',
+                item['name'], item['amount_total'], item['measurement_unit']
+            )
+        yield tail
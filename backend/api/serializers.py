@@ -1,14 +1,28 @@
 from rest_framework import serializers
 from drf_extra_fields.fields import Base64ImageField
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.db import transaction
 from djoser.serializers import UserSerializer as DjoserUserSerializer
+from api.fields import RecipeImageField, RenditionField
+from recipes.counters import suspend_row_handlers
 from recipes.models import (Recipe, Ingredient, RecipeIngredient,
-                            Favorite, ShoppingCart, Subscription)
+                            Favorite, ShoppingCart, ShoppingListItem,
+                            Subscription)
+from recipes.shopping_lists import shift_recipe_ingredients
 
 
 User = get_user_model()
 
 
+def get_recipes_limit(request):
+    try:
+        recipes_limit = int(request.query_params.get('recipes_limit'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+    return recipes_limit if recipes_limit > 0 else None
+
+
 # Сериализаторы для пользователей и подписок
 
 
@@ -24,6 +38,8 @@ class UserSerializer(DjoserUserSerializer):
     is_subscribed = serializers.SerializerMethodField()
 
     def get_is_subscribed(self, author):
+        if hasattr(author, 'is_subscribed'):
+            return author.is_subscribed
         request = self.context.get('request')
         user = getattr(request, 'user', None)
 
@@ -48,19 +64,16 @@ class UserSerializer(DjoserUserSerializer):
 
 class UserWithRecipesSerializer(UserSerializer):
     recipes = serializers.SerializerMethodField()
-    recipes_count = serializers.IntegerField(source='recipes.count',
-                                             read_only=True)
+    recipes_count = serializers.IntegerField(read_only=True)
 
     def get_recipes(self, author):
-        request = self.context.get('request')
-        try:
-            recipes_limit = int(request.query_params.get('recipes_limit'))
-        except (TypeError, ValueError):
-            recipes_limit = None
-
-        recipes = author.recipes.all()
-        if recipes_limit:
-            recipes = recipes[:recipes_limit]
+        if hasattr(author, 'recipes_preview'):
+            recipes = author.recipes_preview
+        else:
+            recipes = author.recipes.all()
+            recipes_limit = get_recipes_limit(self.context.get('request'))
+            if recipes_limit:
+                recipes = recipes[:recipes_limit]
 
         serializer = ShortRecipeSerializer(recipes, many=True,
                                            context=self.context)
@@ -98,13 +111,22 @@ class IngredientInRecipeSerializer(serializers.ModelSerializer):
         read_only_fields = fields
 
 
+class ShoppingListItemSerializer(IngredientInRecipeSerializer):
+
+    class Meta(IngredientInRecipeSerializer.Meta):
+        model = ShoppingListItem
+
+
 class ShortRecipeSerializer(serializers.ModelSerializer):
+    image_small = RenditionField('image_small')
+
     class Meta:
         model = Recipe
         fields = (
             'id',
             'name',
             'image',
+            'image_small',
             'cooking_time'
         )
         read_only_fields = fields
@@ -116,8 +138,12 @@ class RecipeReadSerializer(serializers.ModelSerializer):
                                                many=True, read_only=True)
     is_favorited = serializers.SerializerMethodField()
     is_in_shopping_cart = serializers.SerializerMethodField()
+    image_small = RenditionField('image_small')
+    image_large = RenditionField('image_large')
 
     def get_is_favorited(self, recipe):
+        if hasattr(recipe, 'is_favorited'):
+            return recipe.is_favorited
         request = self.context.get('request')
         user = getattr(request, 'user', None)
 
@@ -125,6 +151,8 @@ class RecipeReadSerializer(serializers.ModelSerializer):
                 and Favorite.objects.filter(user=user, recipe=recipe).exists())
 
     def get_is_in_shopping_cart(self, recipe):
+        if hasattr(recipe, 'is_in_shopping_cart'):
+            return recipe.is_in_shopping_cart
         request = self.context.get('request')
         user = getattr(request, 'user', None)
 
@@ -142,6 +170,8 @@ class RecipeReadSerializer(serializers.ModelSerializer):
             'is_in_shopping_cart',
             'name',
             'image',
+            'image_small',
+            'image_large',
             'text',
             'cooking_time'
         )
@@ -149,54 +179,106 @@ class RecipeReadSerializer(serializers.ModelSerializer):
 
 
 class IngredientAmountSerializer(serializers.Serializer):
-    id = serializers.PrimaryKeyRelatedField(
-        queryset=Ingredient.objects.all(),
-        source='ingredient'
-    )
+    # Существование продуктов проверяется одним запросом
+    # для всего списка в RecipeCreateUpdateSerializer
+    id = serializers.IntegerField()
     amount = serializers.IntegerField(min_value=1)
 
 
 class RecipeCreateUpdateSerializer(serializers.ModelSerializer):
+    EMPTY_INGREDIENTS = 'Нужно указать хотя бы один ингредиент'
+
     ingredients = IngredientAmountSerializer(many=True, required=True)
-    image = Base64ImageField(required=True, allow_null=False)
+    image = RecipeImageField(required=True, allow_null=False)
     cooking_time = serializers.IntegerField(min_value=1)
 
     def create_ingredients(self, recipe, ingredients):
         RecipeIngredient.objects.bulk_create(
             RecipeIngredient(
                 recipe=recipe,
-                ingredient=item['ingredient'],
+                ingredient_id=item['id'],
                 amount=item['amount']
             ) for item in ingredients
         )
 
+    def update_ingredients(self, recipe, ingredients):
+        # Применяется только разница: новые строки добавляются,
+        # лишние удаляются, у оставшихся меняется количество. Та же
+        # разница одним проходом сдвигает списки покупок
+        current = {item.ingredient_id: item
+                   for item in recipe.recipe_ingredients.all()}
+        amounts = {item['id']: item['amount'] for item in ingredients}
+        deltas = {ingredient_id: -item.amount
+                  for ingredient_id, item in current.items()}
+        for ingredient_id, amount in amounts.items():
+            deltas[ingredient_id] = deltas.get(ingredient_id, 0) + amount
+
+        # Рецепт, его поисковый вектор и индекс обновит сохранение
+        # рецепта в update, построчные сигналы удаления отключены
+        removed = current.keys() - amounts.keys()
+        if removed:
+            with suspend_row_handlers():
+                recipe.recipe_ingredients.filter(
+                    ingredient_id__in=removed
+                ).delete()
+        self.create_ingredients(
+            recipe, [item for item in ingredients
+                     if item['id'] not in current]
+        )
+        changed = []
+        for ingredient_id, item in current.items():
+            amount = amounts.get(ingredient_id)
+            if amount is not None and amount != item.amount:
+                item.amount = amount
+                changed.append(item)
+        RecipeIngredient.objects.bulk_update(changed, ('amount',))
+        shift_recipe_ingredients(recipe.id, deltas)
+
+    @transaction.atomic
     def create(self, validated_data):
         ingredients = validated_data.pop('ingredients')
         recipe = super().create(validated_data)
         self.create_ingredients(recipe, ingredients)
         return recipe
 
+    @transaction.atomic
     def update(self, instance, validated_data):
         ingredients = validated_data.pop('ingredients', None)
-        self.validate_ingredients(ingredients)
+        if not ingredients:
+            raise serializers.ValidationError(self.EMPTY_INGREDIENTS)
 
-        instance.recipe_ingredients.all().delete()
-        self.create_ingredients(instance, ingredients)
-        return super().update(instance, validated_data)
+        self.update_ingredients(instance, ingredients)
+        # Сохраняются только изменённые поля: счётчики обновляются
+        # отдельными запросами, и устаревшая копия их бы затёрла
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
+        instance.save(update_fields=(*validated_data, 'updated_at'))
+        return instance
 
     def to_representation(self, instance):
-        return RecipeReadSerializer(instance, context=self.context).data
+        request = self.context.get('request')
+        recipe = Recipe.objects.for_read(getattr(request, 'user', None)).get(
+            pk=instance.pk
+        )
+        return RecipeReadSerializer(recipe, context=self.context).data
 
     def validate_ingredients(self, ingredients):
         if not ingredients:
-            raise serializers.ValidationError('Нужно указать хотя '
-                                              'бы один ингредиент')
+            raise serializers.ValidationError(self.EMPTY_INGREDIENTS)
 
-        ingredient_ids = [item['ingredient'].id for item in ingredients]
+        ingredient_ids = [item['id'] for item in ingredients]
         if len(ingredient_ids) != len(set(ingredient_ids)):
             raise serializers.ValidationError('Ингредиенты не '
                                               'должны повторяться')
 
+        existing = set(Ingredient.objects.filter(id__in=ingredient_ids)
+                       .values_list('id', flat=True))
+        missing = [pk for pk in ingredient_ids if pk not in existing]
+        if missing:
+            raise serializers.ValidationError(
+                f'Продукты с id {", ".join(map(str, missing))} не найдены'
+            )
+
         return ingredients
 
     def validate_image(self, image):
@@ -213,3 +295,11 @@ class IngredientSerializer(serializers.ModelSerializer):
     class Meta:
         model = Ingredient
         fields = ('id', 'name', 'measurement_unit')
+
+
+class RecipeIdsSerializer(serializers.Serializer):
+    ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=settings.BULK_RECIPES_MAX_IDS
+    )
@@ -0,0 +1,20 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+from api.authentication import forget_token
+from recipes.models import CustomUser
+
+
+@receiver(post_delete, sender=Token)
+def forget_deleted_token(instance, **kwargs):
+    forget_token(instance.key)
+
+
+@receiver(post_save, sender=CustomUser)
+def forget_user_tokens(instance, created, update_fields=None, **kwargs):
+    # Вход в систему меняет только last_login, кэш при этом не сбрасывается
+    if created or update_fields and set(update_fields) <= {'last_login'}:
+        return
+    keys = Token.objects.filter(user=instance).values_list('key', flat=True)
+    for key in keys:
+        forget_token(key)
@@ -1,3 +1,1452 @@
-# from django.test import TestCase
+import asyncio
+import base64
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import mock
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, transaction
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+from rest_framework.test import APITestCase
+from api.middleware import QueryStatsMiddleware, fingerprint
+from api.urls import router
+from recipes.cache import bump_version
+from recipes.counters import (row_handlers_suspended, shift_counter,
+                              suspend_row_handlers)
+from recipes.feeds import fan_out_recipe
+from recipes.images import make_renditions
+from recipes.ingredient_index import ingredient_index
+from recipes.recipe_index import recipe_ingredient_index
+from recipes.short_links import clicks, encode, recipe_ids
+from recipes.signals import flush_changed_recipes
+from recipes.models import (Recipe, Ingredient, RecipeIngredient,
+                            Favorite, FeedEntry, PopularityBucket,
+                            ShoppingCart, ShoppingListItem, Subscription)
 
-# Create your tests here.
+
+User = get_user_model()
+
+
+def create_user(username):
+    return User.objects.create_user(
+        email=f'{username}@example.com',
+        username=username,
+        first_name=username,
+        last_name=username,
+        password='password'
+    )
+
+
+def create_recipes(author, count, ingredients):
+    recipes = []
+    for number in range(count):
+        # Файла картинки нет, фоновые копии для неё не считаются
+        with mock.patch('recipes.signals.schedule_renditions'):
+            recipe = Recipe.objects.create(
+                author=author,
+                name=f'Рецепт {number}',
+                image='recipes/images/test.png',
+                text='Описание',
+                cooking_time=10
+            )
+        RecipeIngredient.objects.bulk_create(
+            RecipeIngredient(recipe=recipe, ingredient=ingredient, amount=1)
+            for ingredient in ingredients
+        )
+        recipes.append(recipe)
+    return recipes
+
+
+class QueryBudgetMixin:
+    # Проверка по данным QueryStatsMiddleware: число запросов в пределах
+    # бюджета и ни один запрос не повторяется (признак N+1)
+
+    def assert_query_budget(self, response, budget):
+        stats = response.query_stats
+        self.assertLessEqual(
+            stats.count, budget,
+            f'{stats.view}: {stats.count} запросов при бюджете {budget}'
+        )
+        self.assertEqual(stats.repeated(), [],
+                         f'{stats.view}: повторяющиеся запросы')
+
+
+class RecipeQueryBudgetTest(APITestCase):
+    # Число запросов на страницу рецептов не должно расти вместе
+    # с количеством рецептов на ней
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user('reader')
+        cls.ingredients = [
+            Ingredient.objects.create(name=f'Продукт {number}',
+                                      measurement_unit='г')
+            for number in range(3)
+        ]
+
+    def count_queries(self, url):
+        cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def add_authors_with_recipes(self, count):
+        for _ in range(count):
+            author = create_user(f'author{User.objects.count()}')
+            recipe, = create_recipes(author, 1, self.ingredients)
+            Favorite.objects.create(user=self.user, recipe=recipe)
+            ShoppingCart.objects.create(user=self.user, recipe=recipe)
+            Subscription.objects.create(subscriber=self.user, author=author)
+
+    def assert_constant_queries(self, url):
+        self.add_authors_with_recipes(1)
+        small_page = self.count_queries(url)
+        self.add_authors_with_recipes(5)
+        large_page = self.count_queries(url)
+        self.assertEqual(small_page, large_page)
+
+    def test_anonymous_list(self):
+        self.assert_constant_queries('/api/recipes/')
+
+    def test_authenticated_list(self):
+        self.client.force_authenticate(self.user)
+        self.assert_constant_queries('/api/recipes/')
+
+    def test_retrieve(self):
+        self.client.force_authenticate(self.user)
+        self.add_authors_with_recipes(1)
+        recipe = Recipe.objects.first()
+        # Проверка ETag, рецепт с флагами, авторы, продукты
+        with self.assertNumQueries(4):
+            response = self.client.get(f'/api/recipes/{recipe.id}/')
+        self.assertTrue(response.data['is_favorited'])
+        self.assertTrue(response.data['is_in_shopping_cart'])
+        self.assertTrue(response.data['author']['is_subscribed'])
+        self.assertEqual(len(response.data['ingredients']), 3)
+
+    def test_flags_for_other_user(self):
+        self.add_authors_with_recipes(2)
+        self.client.force_authenticate(create_user('stranger'))
+        response = self.client.get('/api/recipes/')
+        for recipe in response.data['results']:
+            self.assertFalse(recipe['is_favorited'])
+            self.assertFalse(recipe['is_in_shopping_cart'])
+            self.assertFalse(recipe['author']['is_subscribed'])
+
+
+class DownloadShoppingCartTest(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user('buyer')
+        cls.ingredients = [
+            Ingredient.objects.create(name='Соль', measurement_unit='г'),
+            Ingredient.objects.create(name='Молоко', measurement_unit='мл'),
+        ]
+        for recipe in create_recipes(cls.user, 3, cls.ingredients):
+            ShoppingCart.objects.create(user=cls.user, recipe=recipe)
+
+    def download(self, format):
+        self.client.force_authenticate(self.user)
+        response = self.client.get('/api/recipes/download_shopping_cart/',
+                                   {'format': format})
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode()
+
+    def test_totals_are_summed(self):
+        content = self.download('txt')
+        self.assertIn('Соль (г) — 3', content)
+        self.assertIn('Молоко (мл) — 3', content)
+
+    def test_csv(self):
+        lines = self.download('csv').splitlines()
+        self.assertEqual(lines[1:], ['Молоко,мл,3', 'Соль,г,3'])
+
+    def test_html_is_default(self):
+        self.client.force_authenticate(self.user)
+        response = self.client.get('/api/recipes/download_shopping_cart/')
+        self.assertTrue(response['Content-Type'].startswith('text/html'))
+        self.assertIn('Соль — 3 г',
+                      b''.join(response.streaming_content).decode())
+
+    def test_unknown_format(self):
+        self.client.force_authenticate(self.user)
+        response = self.client.get('/api/recipes/download_shopping_cart/',
+                                   {'format': 'pdf'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_anonymous(self):
+        response = self.client.get('/api/recipes/download_shopping_cart/')
+        self.assertEqual(response.status_code, 401)
+
+
+class ShoppingListTest(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user('shopper')
+        cls.author = create_user('cook')
+        cls.salt, cls.milk, cls.flour = (
+            Ingredient.objects.create(name=name, measurement_unit=unit)
+            for name, unit in (('Соль', 'г'), ('Молоко', 'мл'),
+                               ('Мука', 'г'))
+        )
+        cls.first, cls.second = create_recipes(cls.author, 2,
+                                               (cls.salt, cls.milk))
+
+    def setUp(self):
+        self.client.force_authenticate(self.user)
+
+    def items(self, user=None):
+        return dict(ShoppingListItem.objects.filter(user=user or self.user)
+                    .values_list('ingredient__name', 'amount'))
+
+    def current(self):
+        response = self.client.get('/api/recipes/shopping_list/')
+        self.assertEqual(response.status_code, 200)
+        return [(item['name'], item['amount']) for item in response.data]
+
+    def test_cart_add_and_remove(self):
+        for recipe in (self.first, self.second):
+            self.client.post(f'/api/recipes/{recipe.id}/shopping_cart/')
+        self.assertEqual(self.items(), {'Соль': 2, 'Молоко': 2})
+        self.assertEqual(self.current(), [('Молоко', 2), ('Соль', 2)])
+        self.client.delete(f'/api/recipes/{self.first.id}/shopping_cart/')
+        self.assertEqual(self.items(), {'Соль': 1, 'Молоко': 1})
+        self.client.delete(f'/api/recipes/{self.second.id}/shopping_cart/')
+        self.assertEqual(self.current(), [])
+
+    def test_bulk_cart(self):
+        ids = [self.first.id, self.second.id]
+        self.client.post('/api/recipes/shopping_cart/bulk/', {'ids': ids},
+                         format='json')
+        self.assertEqual(self.items(), {'Соль': 2, 'Молоко': 2})
+        self.client.delete('/api/recipes/shopping_cart/bulk/',
+                           {'ids': ids[:1]}, format='json')
+        self.assertEqual(self.items(), {'Соль': 1, 'Молоко': 1})
+
+    def test_bulk_cart_repeats_change_nothing(self):
+        ids = [self.first.id, self.second.id]
+        for _ in range(2):
+            self.client.post('/api/recipes/shopping_cart/bulk/',
+                             {'ids': ids}, format='json')
+        self.assertEqual(self.items(), {'Соль': 2, 'Молоко': 2})
+        for _ in range(2):
+            self.client.delete('/api/recipes/shopping_cart/bulk/',
+                               {'ids': ids[:1]}, format='json')
+        self.assertEqual(self.items(), {'Соль': 1, 'Молоко': 1})
+
+    def test_recipe_edit_updates_carts(self):
+        other = create_user('other_shopper')
+        for user in (self.user, other):
+            ShoppingCart.objects.create(user=user, recipe=self.first)
+        ShoppingCart.objects.create(user=self.user, recipe=self.second)
+        self.client.force_authenticate(self.author)
+        response = self.client.patch(f'/api/recipes/{self.first.id}/', {
+            'ingredients': [{'id': self.milk.id, 'amount': 5},
+                            {'id': self.flour.id, 'amount': 7}],
+            'name': 'Блины', 'text': 'Описание', 'cooking_time': 20,
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.items(), {'Соль': 1, 'Молоко': 6, 'Мука': 7})
+        self.assertEqual(self.items(other), {'Молоко': 5, 'Мука': 7})
+
+        self.first.delete()
+        self.assertEqual(self.items(), {'Соль': 1, 'Молоко': 1})
+        self.assertEqual(self.items(other), {})
+
+    def test_rebuild_repairs_drift(self):
+        ShoppingCart.objects.create(user=self.user, recipe=self.first)
+        ShoppingListItem.objects.filter(user=self.user,
+                                        ingredient=self.salt).delete()
+        ShoppingListItem.objects.create(user=self.author,
+                                        ingredient=self.flour, amount=3)
+        out = StringIO()
+        call_command('rebuild_shopping_lists', batch_size=1, stdout=out)
+        self.assertIn('исправлено: 2', out.getvalue())
+        self.assertEqual(self.items(), {'Соль': 1, 'Молоко': 1})
+        self.assertEqual(self.items(self.author), {})
+
+    def test_anonymous(self):
+        self.client.force_authenticate(None)
+        response = self.client.get('/api/recipes/shopping_list/')
+        self.assertEqual(response.status_code, 401)
+
+
+class SubscriptionsQueryBudgetTest(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user('follower')
+
+    def subscribe_to_authors(self, count, recipes_per_author=3):
+        for _ in range(count):
+            author = create_user(f'author{User.objects.count()}')
+            create_recipes(author, recipes_per_author, ())
+            Subscription.objects.create(subscriber=self.user, author=author)
+
+    def get_subscriptions(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/api/users/subscriptions/',
+                                       {'recipes_limit': 2})
+        self.assertEqual(response.status_code, 200)
+        return response, len(context.captured_queries)
+
+    def test_constant_queries(self):
+        self.client.force_authenticate(self.user)
+        self.subscribe_to_authors(1)
+        _, small_page = self.get_subscriptions()
+        self.subscribe_to_authors(5)
+        response, large_page = self.get_subscriptions()
+        self.assertEqual(small_page, large_page)
+        for author in response.data['results']:
+            self.assertTrue(author['is_subscribed'])
+            self.assertEqual(author['recipes_count'], 3)
+            self.assertEqual(len(author['recipes']), 2)
+
+
+class IngredientIndexTest(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        for name in ('Яблоки', 'яблочный сок', 'Груши'):
+            Ingredient.objects.create(name=name, measurement_unit='г')
+
+    def setUp(self):
+        ingredient_index.invalidate()
+
+    def test_prefix_search_without_queries(self):
+        self.client.get('/api/ingredients/')
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/ingredients/', {'name': 'ЯБЛ'})
+        self.assertEqual([item['name'] for item in response.data],
+                         ['Яблоки', 'яблочный сок'])
+
+    def test_conditional_get(self):
+        response = self.client.get('/api/ingredients/')
+        self.assertEqual(len(response.json()), 3)
+        etag = response['ETag']
+        response = self.client.get('/api/ingredients/',
+                                   HTTP_IF_NONE_MATCH=f'"old", {etag}')
+        self.assertEqual(response.status_code, 304)
+        # ETag сравнивается целиком, а не как подстрока заголовка
+        response = self.client.get('/api/ingredients/',
+                                   HTTP_IF_NONE_MATCH=f'"x{etag[1:]}')
+        self.assertEqual(response.status_code, 200)
+
+    def test_rebuilt_on_change(self):
+        etag = self.client.get('/api/ingredients/')['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            Ingredient.objects.create(name='Груша сушёная',
+                                      measurement_unit='г')
+        response = self.client.get('/api/ingredients/',
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get('/api/ingredients/', {'name': 'груш'})
+        self.assertEqual(len(response.data), 2)
+
+    def test_version_checked_once_per_refresh_interval(self):
+        # Продукт добавлен другим процессом: он поднял версию в кэше
+        ingredient_index.ensure_fresh()
+        Ingredient.objects.bulk_create(
+            [Ingredient(name='Грейпфрут', measurement_unit='г')]
+        )
+        bump_version(ingredient_index.version_key)
+        self.assertEqual(len(ingredient_index.search('гр')), 1)
+        with override_settings(INGREDIENT_INDEX_REFRESH=0):
+            self.assertEqual(len(ingredient_index.search('гр')), 2)
+
+
+class RecipeCursorPaginationTest(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user('scroller')
+        cls.recipes = create_recipes(cls.user, 7, ())
+        # Одинаковое время публикации, порядок задаёт id
+        Recipe.objects.filter(id__in=[r.id for r in cls.recipes[2:5]]).update(
+            created_at=cls.recipes[2].created_at
+        )
+        for recipe in cls.recipes[::2]:
+            Favorite.objects.create(user=cls.user, recipe=recipe)
+
+    def setUp(self):
+        cache.clear()
+
+    def walk(self, params):
+        ids = []
+        response = self.client.get('/api/recipes/',
+                                   {'cursor': '', 'limit': 3, **params})
+        while True:
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('count', response.data)
+            ids += [recipe['id'] for recipe in response.data['results']]
+            if not response.data['next']:
+                return ids
+            response = self.client.get(response.data['next'])
+
+    def test_walks_all_recipes(self):
+        self.assertEqual(self.walk({}),
+                         list(Recipe.objects.values_list('id', flat=True)))
+
+    def test_with_filter(self):
+        self.client.force_authenticate(self.user)
+        self.assertEqual(
+            sorted(self.walk({'is_favorited': 1})),
+            sorted(recipe.id for recipe in self.recipes[::2])
+        )
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/recipes/', {'cursor': 'bad'})
+        self.assertEqual(response.status_code, 404)
+
+
+class AnonymousRecipeCacheTest(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = create_user('cook')
+        cls.ingredient = Ingredient.objects.create(name='Мука',
+                                                   measurement_unit='г')
+        cls.recipe, = create_recipes(cls.author, 1, (cls.ingredient,))
+
+    def setUp(self):
+        cache.clear()
+
+    def assert_cached(self, url, queries=0):
+        self.client.get(url)
+        with self.assertNumQueries(queries):
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_list_and_detail_are_cached(self):
+        self.assert_cached('/api/recipes/')
+        # Для рецепта остаётся только проверка ETag
+        self.assert_cached(f'/api/recipes/{self.recipe.id}/', queries=1)
+
+    def test_authenticated_requests_bypass_cache(self):
+        self.client.force_authenticate(self.author)
+        self.client.get('/api/recipes/')
+        with CaptureQueriesContext(connection) as context:
+            self.client.get('/api/recipes/')
+        self.assertTrue(context.captured_queries)
+
+    def test_recipe_change_invalidates(self):
+        url = f'/api/recipes/{self.recipe.id}/'
+        self.client.get(url)
+        self.client.get('/api/recipes/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.recipe.name = 'Новое название'
+            self.recipe.save()
+        self.assertEqual(self.client.get(url).data['name'], 'Новое название')
+        self.assertEqual(self.client.get('/api/recipes/')
+                         .data['results'][0]['name'], 'Новое название')
+
+    def test_ingredients_change_invalidates(self):
+        url = f'/api/recipes/{self.recipe.id}/'
+        self.client.get(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            RecipeIngredient.objects.filter(recipe=self.recipe).delete()
+        self.assertEqual(self.client.get(url).data['ingredients'], [])
+
+    def test_author_change_invalidates(self):
+        url = f'/api/recipes/{self.recipe.id}/'
+        self.client.get(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.author.first_name = 'Шеф'
+            self.author.save()
+        self.assertEqual(self.client.get(url).data['author']['first_name'],
+                         'Шеф')
+
+
+class ConditionalRetrieveTest(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = create_user('baker')
+        cls.recipe, = create_recipes(cls.author, 1, ())
+        cls.url = f'/api/recipes/{cls.recipe.id}/'
+
+    def setUp(self):
+        cache.clear()
+
+    def test_not_modified_before_serialization(self):
+        response = self.client.get(self.url)
+        with self.assertNumQueries(1):
+            response = self.client.get(
+                self.url, HTTP_IF_NONE_MATCH=response['ETag']
+            )
+        self.assertEqual(response.status_code, 304)
+
+    def test_if_modified_since(self):
+        last_modified = self.client.get(self.url)['Last-Modified']
+        response = self.client.get(self.url,
+                                   HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+    def test_etag_changes_with_user_flags(self):
+        user = create_user('fan')
+        self.client.force_authenticate(user)
+        etag = self.client.get(self.url)['ETag']
+        Favorite.objects.create(user=user, recipe=self.recipe)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data['is_favorited'])
+
+    def test_etag_changes_with_author_profile(self):
+        etag = self.client.get(f'/api/users/{self.author.id}/')['ETag']
+        self.author.first_name = 'Пекарь'
+        self.author.save()
+        for url in (self.url, f'/api/users/{self.author.id}/'):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+
+    def test_missing_recipe(self):
+        self.assertEqual(self.client.get('/api/recipes/0/').status_code, 404)
+
+    def test_ingredient_changes_touch_recipe_once(self):
+        ingredients = [Ingredient.objects.create(name=f'Дрожжи {number}',
+                                                 measurement_unit='г')
+                       for number in range(3)]
+        RecipeIngredient.objects.bulk_create(
+            RecipeIngredient(recipe=self.recipe, ingredient=ingredient,
+                             amount=1)
+            for ingredient in ingredients
+        )
+        etag = self.client.get(self.url)['ETag']
+        with CaptureQueriesContext(connection) as queries:
+            with self.captureOnCommitCallbacks(execute=True):
+                RecipeIngredient.objects.filter(recipe=self.recipe).delete()
+        touches = [query for query in queries
+                   if query['sql'].startswith('UPDATE "recipes_recipe"')]
+        self.assertEqual(len(touches), 1)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+
+class CountersTest(APITestCase):
+
+    def test_counters_follow_changes(self):
+        author, reader = create_user('writer'), create_user('reader')
+        recipe, _ = create_recipes(author, 2, ())
+        Favorite.objects.create(user=reader, recipe=recipe)
+        Subscription.objects.create(subscriber=reader, author=author)
+        recipe.refresh_from_db()
+        author.refresh_from_db()
+        reader.refresh_from_db()
+        self.assertEqual(recipe.favorites_count, 1)
+        self.assertEqual(author.recipes_count, 2)
+        self.assertEqual(author.subscribers_count, 1)
+        self.assertEqual(reader.subscriptions_count, 1)
+
+        recipe.delete()
+        Subscription.objects.all().delete()
+        author.refresh_from_db()
+        reader.refresh_from_db()
+        self.assertEqual(author.recipes_count, 1)
+        self.assertEqual(author.subscribers_count, 0)
+        self.assertEqual(reader.subscriptions_count, 0)
+
+    def test_recount_fixes_drift(self):
+        author = create_user('drifter')
+        create_recipes(author, 3, ())
+        User.objects.filter(pk=author.pk).update(recipes_count=7)
+        call_command('recount_counters', batch_size=1, stdout=StringIO())
+        author.refresh_from_db()
+        self.assertEqual(author.recipes_count, 3)
+
+    def test_decrement_stops_at_zero(self):
+        author = create_user('drained')
+        recipe, = create_recipes(author, 1, ())
+        shift_counter(Recipe, (recipe.id,), 'favorites_count', -1)
+        recipe.refresh_from_db()
+        self.assertEqual(recipe.favorites_count, 0)
+
+    def test_nested_suspension_keeps_outer_one(self):
+        with suspend_row_handlers():
+            with suspend_row_handlers():
+                pass
+            self.assertTrue(row_handlers_suspended())
+        self.assertFalse(row_handlers_suspended())
+
+    def test_edit_keeps_counters(self):
+        author = create_user('keeper')
+        ingredient = Ingredient.objects.create(name='Мёд',
+                                               measurement_unit='г')
+        recipe, = create_recipes(author, 1, (ingredient,))
+        self.client.force_authenticate(author)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.patch(
+                f'/api/recipes/{recipe.id}/',
+                {'name': 'Медовик',
+                 'ingredients': [{'id': ingredient.id, 'amount': 3}]},
+                format='json'
+            )
+        self.assertEqual(response.status_code, 200)
+        updates = [query['sql'] for query in context.captured_queries
+                   if query['sql'].startswith('UPDATE "recipes_recipe" SET')
+                   and '"name"' in query['sql']]
+        self.assertEqual(len(updates), 1)
+        self.assertNotIn('favorites_count', updates[0])
+
+
+def make_base64_image(size=(1600, 900), format='PNG'):
+    buffer = BytesIO()
+    Image.new('RGB', size, 'orange').save(buffer, format=format)
+    encoded = base64.b64encode(buffer.getvalue()).decode()
+    return f'data:image/{format.lower()};base64,{encoded}'
+
+
+class RecipeImagePipelineTest(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = create_user('photographer')
+        cls.ingredient = Ingredient.objects.create(name='Сыр',
+                                                   measurement_unit='г')
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.client.force_authenticate(self.author)
+
+    def create_recipe(self, image):
+        return self.client.post('/api/recipes/', {
+            'ingredients': [{'id': self.ingredient.id, 'amount': 10}],
+            'image': image,
+            'name': 'Пицца',
+            'text': 'Описание',
+            'cooking_time': 30
+        }, format='json')
+
+    def test_image_is_reencoded_and_renditions_fall_back(self):
+        response = self.create_recipe(make_base64_image())
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(response.data['image'].endswith('.webp'))
+        self.assertEqual(response.data['image_small'], response.data['image'])
+
+        make_renditions(response.data['id'])
+        recipe = Recipe.objects.get(pk=response.data['id'])
+        with Image.open(recipe.image_small) as image:
+            self.assertEqual(max(image.size),
+                             settings.RECIPE_IMAGE_SMALL_SIZE)
+        response = self.client.get(f'/api/recipes/{recipe.id}/')
+        self.assertIn('/small/', response.data['image_small'])
+        self.assertIn('/large/', response.data['image_large'])
+
+    @override_settings(RECIPE_IMAGE_MAX_SIZE=1024)
+    def test_too_large_image_is_rejected(self):
+        response = self.create_recipe(make_base64_image(format='BMP'))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('image', response.data)
+
+    def test_replaced_image_gets_new_renditions(self):
+        response = self.create_recipe(make_base64_image())
+        make_renditions(response.data['id'])
+        recipe = Recipe.objects.get(pk=response.data['id'])
+        stale = recipe.image_small.path
+        # Так картинку меняет админка: сохраняется весь рецепт
+        recipe.image = SimpleUploadedFile('new.png', b'png')
+        with mock.patch('recipes.images.executor') as executor:
+            with self.captureOnCommitCallbacks(execute=True):
+                recipe.save()
+        executor.submit.assert_called_once()
+        recipe.refresh_from_db()
+        self.assertFalse(recipe.image_small)
+        self.assertFalse(recipe.image_large)
+        self.assertFalse(os.path.exists(stale))
+
+
+class AvatarUploadTest(APITestCase):
+    url = '/api/users/me/avatar/'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user('face')
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.client.force_authenticate(self.user)
+
+    def test_base64_upload_replaces_old_file(self):
+        response = self.client.put(
+            self.url, {'avatar': make_base64_image((50, 50))}, format='json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.user.refresh_from_db()
+        old_avatar = self.user.avatar.name
+        self.assertTrue(old_avatar.endswith('.png'))
+
+        self.client.put(self.url, {'avatar': make_base64_image((60, 60))},
+                        format='json')
+        self.user.refresh_from_db()
+        self.assertNotEqual(self.user.avatar.name, old_avatar)
+        self.assertFalse(self.user.avatar.storage.exists(old_avatar))
+
+    def test_multipart_upload(self):
+        buffer = BytesIO()
+        Image.new('RGB', (50, 50)).save(buffer, format='JPEG')
+        upload = SimpleUploadedFile('photo.txt', buffer.getvalue(),
+                                    content_type='text/plain')
+        response = self.client.put(self.url, {'avatar': upload},
+                                   format='multipart')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data['avatar'].endswith('.jpg'))
+
+    def test_not_an_image(self):
+        upload = SimpleUploadedFile('photo.png', b'not an image')
+        response = self.client.put(self.url, {'avatar': upload},
+                                   format='multipart')
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(AVATAR_MAX_SIZE=1024)
+    def test_size_limit(self):
+        for data, format in (
+            ({'avatar': make_base64_image(format='BMP')}, 'json'),
+            ({'avatar': SimpleUploadedFile('a.png', b'0' * 4096)},
+             'multipart'),
+        ):
+            response = self.client.put(self.url, data, format=format)
+            self.assertEqual(response.status_code, 413)
+
+
+class RecipeIngredientsUpdateTest(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = create_user('editor')
+        cls.ingredients = [
+            Ingredient.objects.create(name=f'Специя {number}',
+                                      measurement_unit='г')
+            for number in range(30)
+        ]
+        cls.recipe, = create_recipes(cls.author, 1, cls.ingredients)
+
+    def patch(self, amounts):
+        self.client.force_authenticate(self.author)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.patch(
+                f'/api/recipes/{self.recipe.id}/',
+                {'ingredients': [{'id': pk, 'amount': amount}
+                                 for pk, amount in amounts.items()]},
+                format='json'
+            )
+        return response, [query['sql'] for query in context.captured_queries
+                          if 'recipes_recipeingredient' in query['sql']
+                          or 'FROM "recipes_ingredient"' in query['sql']]
+
+    def test_one_changed_amount_touches_one_row(self):
+        amounts = {ingredient.id: 1 for ingredient in self.ingredients}
+        amounts[self.ingredients[0].id] = 5
+        response, queries = self.patch(amounts)
+        self.assertEqual(response.status_code, 200)
+        writes = [sql for sql in queries
+                  if sql.startswith(('INSERT', 'UPDATE', 'DELETE'))]
+        self.assertEqual(len(writes), 1)
+        self.assertTrue(writes[0].startswith('UPDATE'))
+        self.assertEqual(
+            len([sql for sql in queries
+                 if sql.startswith('SELECT "recipes_ingredient"."id"')]), 1
+        )
+
+    def test_added_and_removed(self):
+        extra = Ingredient.objects.create(name='Лук', measurement_unit='г')
+        amounts = {ingredient.id: 1 for ingredient in self.ingredients[1:]}
+        amounts[extra.id] = 2
+        response, _ = self.patch(amounts)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            set(self.recipe.recipe_ingredients
+                .values_list('ingredient_id', flat=True)),
+            set(amounts)
+        )
+
+    def test_removed_rows_skip_per_row_handlers(self):
+        amounts = {ingredient.id: 1 for ingredient in self.ingredients[10:]}
+        with self.captureOnCommitCallbacks() as callbacks:
+            response, _ = self.patch(amounts)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(flush_changed_recipes, callbacks)
+
+    def test_rolled_back_change_does_not_block_next_one(self):
+        extra = Ingredient.objects.create(name='Лук', measurement_unit='г')
+        updated_at = self.recipe.updated_at
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(RuntimeError):
+                with transaction.atomic():
+                    RecipeIngredient.objects.create(
+                        recipe=self.recipe, ingredient=extra, amount=1
+                    )
+                    raise RuntimeError
+            self.recipe.recipe_ingredients.first().delete()
+        self.assertIn(flush_changed_recipes, callbacks)
+        self.recipe.refresh_from_db()
+        self.assertGreater(self.recipe.updated_at, updated_at)
+
+    def test_unknown_ingredient(self):
+        response, _ = self.patch({0: 1})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('ingredients', response.data)
+
+
+class BulkUserRecipeRelationsTest(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user('planner')
+        cls.recipes = create_recipes(cls.user, 8, ())
+
+    def bulk(self, method, url, ids):
+        self.client.force_authenticate(self.user)
+        with CaptureQueriesContext(connection) as context:
+            response = getattr(self.client, method)(url, {'ids': ids},
+                                                    format='json')
+        self.assertEqual(response.status_code, 200)
+        return response.data['results'], len(context.captured_queries)
+
+    def test_constant_queries(self):
+        ids = [recipe.id for recipe in self.recipes]
+        _, small = self.bulk('post', '/api/recipes/shopping_cart/bulk/',
+                             ids[:2])
+        _, large = self.bulk('post', '/api/recipes/shopping_cart/bulk/',
+                             ids[2:])
+        self.assertEqual(small, large)
+        self.assertEqual(ShoppingCart.objects.count(), 8)
+        _, small = self.bulk('delete', '/api/recipes/shopping_cart/bulk/',
+                             ids[:2])
+        _, large = self.bulk('delete', '/api/recipes/shopping_cart/bulk/',
+                             ids[2:])
+        self.assertEqual(small, large)
+        self.assertFalse(ShoppingCart.objects.exists())
+
+    def test_per_id_results_and_counters(self):
+        first, second = self.recipes[:2]
+        Favorite.objects.create(user=self.user, recipe=first)
+        results, _ = self.bulk('post', '/api/recipes/favorite/bulk/',
+                               [first.id, second.id, 10 ** 6])
+        self.assertEqual([item['status'] for item in results],
+                         ['exists', 'added', 'not_found'])
+        second.refresh_from_db()
+        self.assertEqual(second.favorites_count, 1)
+
+        results, _ = self.bulk('delete', '/api/recipes/favorite/bulk/',
+                               [second.id, self.recipes[2].id])
+        self.assertEqual([item['status'] for item in results],
+                         ['removed', 'absent'])
+        second.refresh_from_db()
+        self.assertEqual(second.favorites_count, 0)
+
+
+class RecipeSearchTest(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        author = create_user('searcher')
+        basil = Ingredient.objects.create(name='Базилик',
+                                          measurement_unit='г')
+        tomato = Ingredient.objects.create(name='Помидоры',
+                                           measurement_unit='г')
+        cls.soup, cls.salad, cls.pasta = create_recipes(author, 3, ())
+        for recipe, name, text, ingredients in (
+            (cls.soup, 'Томатный суп', 'Суп с базиликом', (tomato,)),
+            (cls.salad, 'Салат', 'Летний салат', (tomato, basil)),
+            (cls.pasta, 'Паста с базиликом', 'Быстрый ужин', (basil,)),
+        ):
+            recipe.name, recipe.text = name, text
+            recipe.save()
+            RecipeIngredient.objects.bulk_create(
+                RecipeIngredient(recipe=recipe, ingredient=ingredient,
+                                 amount=1)
+                for ingredient in ingredients
+            )
+
+    def search(self, query, **params):
+        cache.clear()
+        response = self.client.get('/api/recipes/',
+                                   {'search': query, **params})
+        self.assertEqual(response.status_code, 200)
+        return [recipe['id'] for recipe in response.data['results']]
+
+    def test_ranked_by_field_weight(self):
+        self.assertEqual(self.search('базилик'),
+                         [self.pasta.id, self.soup.id, self.salad.id])
+
+    def test_all_terms_must_match(self):
+        self.assertEqual(self.search('суп базилик'), [self.soup.id])
+        self.assertEqual(self.search('помидоры ужин'), [])
+
+    def test_combines_with_filters(self):
+        self.assertEqual(self.search('салат', author=self.salad.author_id),
+                         [self.salad.id])
+
+    def test_word_forms_match_but_prefixes_do_not(self):
+        self.assertEqual(self.search('базиликом'),
+                         [self.pasta.id, self.soup.id, self.salad.id])
+        self.assertEqual(self.search('баз'), [])
+
+    def test_cursor_keeps_rank_order(self):
+        self.assertEqual(self.search('базилик', cursor='', limit=2),
+                         [self.pasta.id, self.soup.id])
+
+
+class IngredientMatchTest(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = create_user('cook')
+        cls.egg, cls.milk, cls.flour, cls.meat = (
+            Ingredient.objects.create(name=name, measurement_unit='г')
+            for name in ('Яйцо', 'Молоко', 'Мука', 'Мясо')
+        )
+        cls.omelette, = create_recipes(cls.author, 1, (cls.egg, cls.milk))
+        cls.pancakes, = create_recipes(cls.author, 1,
+                                       (cls.egg, cls.milk, cls.flour))
+        cls.stew, = create_recipes(cls.author, 1, (cls.meat, cls.milk))
+
+    def setUp(self):
+        recipe_ingredient_index.invalidate()
+
+    def match(self, **params):
+        cache.clear()
+        response = self.client.get('/api/recipes/', params)
+        self.assertEqual(response.status_code, 200)
+        return [recipe['id'] for recipe in response.data['results']]
+
+    def test_ranked_by_coverage(self):
+        self.assertEqual(
+            self.match(ingredients=f'{self.egg.id},{self.milk.id}'),
+            [self.omelette.id, self.pancakes.id, self.stew.id]
+        )
+
+    def test_exclude(self):
+        self.assertEqual(
+            self.match(ingredients=self.milk.id,
+                       exclude_ingredients=self.meat.id),
+            [self.omelette.id, self.pancakes.id]
+        )
+        self.assertEqual(self.match(exclude_ingredients=self.egg.id),
+                         [self.stew.id])
+
+    @override_settings(RECIPE_MATCH_LIMIT=1)
+    def test_limit_applies_after_other_filters(self):
+        other = create_user('baker')
+        bread, = create_recipes(other, 1, (self.flour,))
+        self.assertEqual(self.match(ingredients=self.milk.id,
+                                    author=other.id), [])
+        self.assertEqual(self.match(ingredients=self.flour.id,
+                                    author=self.author.id),
+                         [self.pancakes.id])
+        self.assertEqual(self.match(ingredients=self.flour.id,
+                                    author=other.id), [bread.id])
+
+    def test_index_follows_recipe_changes(self):
+        self.match(ingredients=self.flour.id)
+        self.client.force_authenticate(self.author)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(
+                f'/api/recipes/{self.stew.id}/',
+                {'ingredients': [{'id': self.flour.id, 'amount': 1}]},
+                format='json'
+            )
+        self.assertEqual(response.status_code, 200)
+        with self.assertNumQueries(0):
+            ranked = recipe_ingredient_index.match((self.flour.id,))
+        self.assertEqual([recipe_id for _, _, recipe_id in ranked],
+                         [self.stew.id, self.pancakes.id])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f'/api/recipes/{self.stew.id}/')
+        self.assertEqual(self.match(ingredients=self.flour.id),
+                         [self.pancakes.id])
+
+    def test_stale_copy_rebuilt_after_ttl(self):
+        # Изменение в другом процессе со своим кэшем версию не поднимает
+        recipe_ingredient_index.ensure_fresh()
+        RecipeIngredient.objects.filter(recipe=self.stew).delete()
+        meat = (self.meat.id,)
+        with override_settings(RECIPE_INGREDIENT_INDEX_REFRESH=0):
+            self.assertIn(self.stew.id,
+                          recipe_ingredient_index.recipes_with(meat))
+            with override_settings(RECIPE_INGREDIENT_INDEX_TTL=0):
+                self.assertEqual(recipe_ingredient_index.recipes_with(meat),
+                                 set())
+
+
+class FeedTest(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.reader = create_user('follower')
+        cls.author = create_user('blogger')
+        cls.old_recipe, = create_recipes(cls.author, 1, ())
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_authenticate(self.reader)
+
+    def feed(self):
+        response = self.client.get('/api/recipes/feed/')
+        self.assertEqual(response.status_code, 200)
+        return [recipe['id'] for recipe in response.data['results']]
+
+    def publish(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            recipe, = create_recipes(self.author, 1, ())
+        return recipe
+
+    def test_timeline_follows_subscriptions(self):
+        self.assertEqual(self.feed(), [])
+        self.client.post(f'/api/users/{self.author.id}/subscribe/')
+        self.assertEqual(self.feed(), [self.old_recipe.id])
+        recipe = self.publish()
+        self.assertEqual(FeedEntry.objects.filter(user=self.reader).count(), 2)
+        self.assertEqual(self.feed(), [recipe.id, self.old_recipe.id])
+        self.client.delete(f'/api/users/{self.author.id}/subscribe/')
+        self.assertEqual(self.feed(), [])
+
+    @override_settings(FEED_FANOUT_LIMIT=0)
+    def test_large_author_merged_at_read(self):
+        Subscription.objects.create(subscriber=self.reader, author=self.author)
+        recipe = self.publish()
+        self.assertFalse(FeedEntry.objects.exists())
+        self.assertEqual(self.feed(), [recipe.id, self.old_recipe.id])
+
+    @override_settings(FEED_BATCH_SIZE=1)
+    def test_large_fan_out_leaves_request(self):
+        for user in (self.reader, create_user('second_follower')):
+            Subscription.objects.create(subscriber=user, author=self.author)
+        FeedEntry.objects.all().delete()
+        with mock.patch('recipes.feeds.executor') as executor:
+            recipe = self.publish()
+        self.assertFalse(FeedEntry.objects.exists())
+        executor.submit.assert_called_once()
+        # Поток закрывает своё соединение, поэтому рассылка здесь
+        # запускается напрямую
+        _, *args = executor.submit.call_args.args
+        fan_out_recipe(*args)
+        self.assertEqual(FeedEntry.objects.filter(recipe=recipe).count(), 2)
+
+    def test_anonymous(self):
+        self.client.force_authenticate(None)
+        self.assertEqual(self.client.get('/api/recipes/feed/').status_code,
+                         401)
+
+
+class PopularOrderingTest(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = create_user('popular_author')
+        cls.users = [create_user(f'fan{number}') for number in range(3)]
+        cls.day, cls.week, cls.month, cls.undated = create_recipes(
+            cls.author, 4, ()
+        )
+
+    def setUp(self):
+        cache.clear()
+        self.now = timezone.now()
+        self.add(Favorite, self.users[:1], self.day, timedelta(hours=1))
+        self.add(Favorite, self.users[:1], self.week, timedelta(days=3))
+        self.add(ShoppingCart, self.users[1:2], self.week, timedelta(days=3))
+        self.add(Favorite, self.users, self.month, timedelta(days=30))
+        self.add(Favorite, self.users[:1], self.undated, None)
+        self.refresh()
+
+    def add(self, model, users, recipe, age):
+        for user in users:
+            model.objects.create(user=user, recipe=recipe)
+        model.objects.filter(recipe=recipe).update(
+            created_at=None if age is None else self.now - age
+        )
+
+    def refresh(self, **options):
+        call_command('refresh_popularity', stdout=StringIO(), **options)
+
+    def popular(self, period):
+        response = self.client.get('/api/recipes/',
+                                   {'ordering': 'popular', 'period': period})
+        self.assertEqual(response.status_code, 200)
+        return [recipe['id'] for recipe in response.data['results']]
+
+    def test_windows(self):
+        self.assertEqual(self.popular('day'), [
+            self.day.id, self.undated.id, self.month.id, self.week.id
+        ])
+        self.assertEqual(self.popular('week'), [
+            self.week.id, self.day.id, self.undated.id, self.month.id
+        ])
+        self.assertEqual(self.popular('all'), [
+            self.month.id, self.week.id, self.undated.id, self.day.id
+        ])
+
+    def test_incremental_refresh(self):
+        closed = set(PopularityBucket.objects.filter(
+            recipe=self.month
+        ).values_list('id', flat=True))
+        Favorite.objects.create(user=self.users[1], recipe=self.undated)
+        Favorite.objects.create(user=self.users[2], recipe=self.undated)
+        self.refresh()
+        self.assertEqual(self.popular('day')[:2],
+                         [self.undated.id, self.day.id])
+        self.assertEqual(set(PopularityBucket.objects.filter(
+            recipe=self.month
+        ).values_list('id', flat=True)), closed)
+
+        with mock.patch('recipes.popularity.timezone.now',
+                        return_value=self.now + timedelta(days=2)):
+            self.refresh()
+        self.day.refresh_from_db()
+        self.assertEqual(
+            (self.day.popularity_day, self.day.popularity_week,
+             self.day.popularity_total),
+            (0, 1, 1)
+        )
+
+    def test_full_refresh_matches_incremental(self):
+        Favorite.objects.create(user=self.users[1], recipe=self.day)
+        self.refresh()
+        incremental = self.popular('all')
+        self.refresh(full=True)
+        self.assertEqual(self.popular('all'), incremental)
+
+    def test_removed_links_leave_closed_buckets(self):
+        Favorite.objects.filter(user=self.users[1], recipe=self.month).delete()
+        self.client.force_authenticate(self.users[2])
+        self.client.delete('/api/recipes/favorite/bulk/',
+                           {'ids': [self.month.id]}, format='json')
+        self.refresh()
+        self.month.refresh_from_db()
+        self.assertEqual(self.month.popularity_total, 1)
+        incremental = self.popular('all')
+        self.refresh(full=True)
+        self.assertEqual(self.popular('all'), incremental)
+
+    def test_invalid_ordering(self):
+        response = self.client.get('/api/recipes/', {'ordering': 'random'})
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(ROOT_URLCONF='foodgram_backend.asgi_urls',
+                   SHORT_LINK_FLUSH_INTERVAL=3600)
+class AsyncViewsTest(TransactionTestCase):
+    # Async-views читают базу из пула потоков, поэтому данные должны
+    # быть закоммичены
+
+    def setUp(self):
+        cache.clear()
+        ingredient_index.invalidate()
+        recipe_ids.invalidate()
+        # Переходы записываются до очистки базы, а не при выходе
+        self.addCleanup(clicks.flush)
+        author = create_user('async')
+        self.ingredient = Ingredient.objects.create(name='Кабачок',
+                                                    measurement_unit='г')
+        self.recipe, = create_recipes(author, 1, (self.ingredient,))
+
+    async def test_ingredient_lookup(self):
+        response = await self.async_client.get('/api/ingredients/',
+                                               {'name': 'каб'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[0]['id'], self.ingredient.id)
+        response = await self.async_client.get('/api/ingredients/')
+        response = await self.async_client.get(
+            '/api/ingredients/', **{'If-None-Match': response['ETag']}
+        )
+        self.assertEqual(response.status_code, 304)
+
+    async def test_recipe_retrieve(self):
+        response = await self.async_client.get(
+            f'/api/recipes/{self.recipe.id}/'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['ingredients'][0]['id'],
+                         self.ingredient.id)
+        response = await self.async_client.delete(
+            f'/api/recipes/{self.recipe.id}/'
+        )
+        self.assertEqual(response.status_code, 401)
+
+    async def test_thread_queries_are_counted(self):
+        response = await self.async_client.get(
+            f'/api/recipes/{self.recipe.id}/'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.query_stats.view,
+                         'api.async_views.recipe_detail')
+        self.assertGreater(response.query_stats.count, 0)
+
+    def test_middleware_stays_async(self):
+        async def get_response(request):
+            pass
+        self.assertTrue(asyncio.iscoroutinefunction(
+            QueryStatsMiddleware(get_response)
+        ))
+
+    async def test_short_link(self):
+        response = await self.async_client.get(
+            f'/r/{encode(self.recipe.id)}/'
+        )
+        self.assertRedirects(response, f'/recipes/{self.recipe.id}/',
+                             fetch_redirect_response=False)
+
+
+@override_settings(SHORT_LINK_FLUSH_SIZE=1000, SHORT_LINK_FLUSH_INTERVAL=3600)
+class ShortLinkTest(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = create_user('linker')
+        cls.recipe, = create_recipes(cls.author, 1, ())
+
+    def setUp(self):
+        recipe_ids.invalidate()
+        clicks.flush()
+        self.addCleanup(clicks.flush)
+
+    def get_link(self, recipe_id):
+        response = self.client.get(f'/api/recipes/{recipe_id}/get-link/')
+        self.assertEqual(response.status_code, 200)
+        return response.data['short-link']
+
+    def test_redirect_without_queries(self):
+        link = self.get_link(self.recipe.id)
+        self.assertTrue(link.endswith(f'/r/{encode(self.recipe.id)}/'))
+        with self.assertNumQueries(0):
+            response = self.client.get(link)
+        self.assertRedirects(response, f'/recipes/{self.recipe.id}/',
+                             fetch_redirect_response=False)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get('/r/zzzzz/').status_code, 404)
+        self.assertEqual(self.client.get('/r/a-b/').status_code, 404)
+        self.assertEqual(
+            self.client.get(f'/s/{self.recipe.id}/').status_code, 302
+        )
+
+    def test_new_and_deleted_recipes(self):
+        self.get_link(self.recipe.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            recipe, = create_recipes(self.author, 1, ())
+        with self.assertNumQueries(0):
+            response = self.client.get(f'/r/{encode(recipe.id)}/')
+        self.assertEqual(response.status_code, 302)
+        recipe_id = recipe.id
+        with self.captureOnCommitCallbacks(execute=True):
+            recipe.delete()
+        self.assertEqual(
+            self.client.get(f'/r/{encode(recipe_id)}/').status_code, 404
+        )
+        self.assertEqual(
+            self.client.get(f'/api/recipes/{recipe_id}/get-link/').status_code,
+            400
+        )
+
+    def test_clicks_are_flushed_in_batches(self):
+        link = f'/r/{encode(self.recipe.id)}/'
+        for _ in range(3):
+            self.client.get(link)
+        self.recipe.refresh_from_db()
+        self.assertEqual(self.recipe.short_link_clicks, 0)
+        with self.assertNumQueries(3):
+            clicks.flush()
+        self.recipe.refresh_from_db()
+        self.assertEqual(self.recipe.short_link_clicks, 3)
+
+    def test_viral_ordering(self):
+        quiet, = create_recipes(self.author, 1, ())
+        self.client.get(f'/r/{encode(self.recipe.id)}/')
+        clicks.flush()
+        response = self.client.get('/api/recipes/', {'ordering': 'viral'})
+        self.assertEqual([recipe['id'] for recipe in response.data['results']],
+                         [self.recipe.id, quiet.id])
+
+    def test_missing_recipe_rebuilds_stale_set(self):
+        # Рецепт создан в другом процессе, версия в этом кэше не менялась
+        recipe_ids.ensure_fresh()
+        recipe, = create_recipes(self.author, 1, ())
+        recipe_ids.discard(recipe.id)
+        with override_settings(SHORT_LINK_INDEX_REFRESH=0):
+            self.assertIn(recipe.id, recipe_ids)
+
+
+class CachedTokenAuthenticationTest(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = create_user('token')
+        response = self.client.post('/api/auth/token/login/', {
+            'email': self.user.email, 'password': 'password'
+        })
+        self.client.credentials(
+            HTTP_AUTHORIZATION=f'Token {response.data["auth_token"]}'
+        )
+
+    def me(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/api/users/me/')
+        return response.status_code, [
+            query['sql'] for query in context.captured_queries
+        ]
+
+    def test_anonymous_me(self):
+        self.client.credentials()
+        self.assertEqual(self.me()[0], 401)
+
+    def test_token_resolved_from_cache(self):
+        queries = self.me()[1]
+        self.assertEqual(
+            len([sql for sql in queries if 'authtoken_token' in sql]), 1
+        )
+        status_code, cached_queries = self.me()
+        self.assertEqual(status_code, 200)
+        self.assertEqual(len(cached_queries), len(queries) - 1)
+        self.assertFalse([sql for sql in cached_queries
+                          if 'authtoken_token' in sql
+                          or 'recipes_customuser' in sql])
+
+    def test_logout(self):
+        self.me()
+        self.assertEqual(
+            self.client.post('/api/auth/token/logout/').status_code, 204
+        )
+        self.assertEqual(self.me()[0], 401)
+
+    def test_password_change_keeps_counters(self):
+        self.me()
+        User.objects.filter(pk=self.user.pk).update(recipes_count=5)
+        response = self.client.post('/api/users/set_password/', {
+            'current_password': 'password', 'new_password': 'Secret-123-pass'
+        })
+        self.assertEqual(response.status_code, 204)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.recipes_count, 5)
+
+    def test_avatar_upload_keeps_counters(self):
+        self.me()
+        User.objects.filter(pk=self.user.pk).update(subscribers_count=2)
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        with override_settings(MEDIA_ROOT=media_root):
+            response = self.client.put(
+                '/api/users/me/avatar/',
+                {'avatar': make_base64_image((50, 50))}, format='json'
+            )
+        self.assertEqual(response.status_code, 200)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.subscribers_count, 2)
+
+    def test_deactivation(self):
+        self.me()
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.me()[0], 401)
+
+
+class EndpointQueryBudgetTest(QueryBudgetMixin, APITestCase):
+    # Бюджеты GET-запросов ко всем views из api.urls. Данных столько,
+    # чтобы N+1 проявился повторами: несколько авторов, рецептов и продуктов
+    BUDGETS = {
+        'RecipeViewSet.list': ('/api/recipes/', 4),
+        'RecipeViewSet.retrieve': ('/api/recipes/{recipe}/', 4),
+        'RecipeViewSet.feed': ('/api/recipes/feed/', 5),
+        'RecipeViewSet.get_link': ('/api/recipes/{recipe}/get-link/', 0),
+        'RecipeViewSet.download_cart': (
+            '/api/recipes/download_shopping_cart/', 1
+        ),
+        'RecipeViewSet.shopping_list': ('/api/recipes/shopping_list/', 1),
+        'IngredientViewSet.list': ('/api/ingredients/?name=со', 0),
+        'IngredientViewSet.retrieve': ('/api/ingredients/{ingredient}/', 1),
+        'UserViewSet.list': ('/api/users/', 2),
+        'UserViewSet.me': ('/api/users/me/', 1),
+        'UserViewSet.retrieve': ('/api/users/{author}/', 2),
+        'UserViewSet.subscriptions': ('/api/users/subscriptions/', 3),
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user('budget')
+        cls.ingredients = [
+            Ingredient.objects.create(name=f'Соль {number}',
+                                      measurement_unit='г')
+            for number in range(3)
+        ]
+        for number in range(3):
+            author = create_user(f'budget_author{number}')
+            Subscription.objects.create(subscriber=cls.user, author=author)
+            for recipe in create_recipes(author, 2, cls.ingredients):
+                Favorite.objects.create(user=cls.user, recipe=recipe)
+                ShoppingCart.objects.create(user=cls.user, recipe=recipe)
+        call_command('rebuild_feeds', stdout=StringIO())
+        cls.recipe = recipe
+        cls.author = author
+
+    def setUp(self):
+        cache.clear()
+        ingredient_index.invalidate()
+        recipe_ids.invalidate()
+        self.client.force_authenticate(self.user)
+
+    def test_all_get_endpoints_have_budgets(self):
+        tags = {
+            f'{pattern.callback.cls.__name__}.{action}'
+            for pattern in router.urls
+            for method, action in pattern.callback.actions.items()
+            if method == 'get'
+        }
+        self.assertEqual(tags, set(self.BUDGETS))
+
+    def test_budgets(self):
+        # Индексы в памяти прогреваются заранее, их перестройка
+        # не относится к запросу
+        ingredient_index.ensure_fresh()
+        recipe_ids.ensure_fresh()
+        for tag, (url, budget) in self.BUDGETS.items():
+            with self.subTest(tag):
+                response = self.client.get(url.format(
+                    recipe=self.recipe.id, author=self.author.id,
+                    ingredient=self.ingredients[0].id
+                ))
+                self.assertEqual(response.status_code, 200)
+                if response.streaming:
+                    b''.join(response.streaming_content)
+                self.assertEqual(response.query_stats.view, tag)
+                self.assert_query_budget(response, budget)
+
+
+class QueryStatsMiddlewareTest(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_repeated_queries_are_fingerprinted(self):
+        self.assertEqual(
+            fingerprint('SELECT * FROM t WHERE id IN (%s, %s) AND x = 5'),
+            fingerprint('SELECT * FROM t WHERE id IN (%s) AND x = 7')
+        )
+
+    @override_settings(DEBUG=True)
+    def test_debug_headers(self):
+        response = self.client.get('/api/recipes/')
+        self.assertEqual(response['X-SQL-View'], 'RecipeViewSet.list')
+        self.assertEqual(int(response['X-SQL-Queries']),
+                         response.query_stats.count)
+
+    @override_settings(SQL_BUDGETS={'RecipeViewSet.list': {'queries': 0}})
+    def test_over_budget_is_logged(self):
+        with self.assertLogs('api.sql', 'WARNING') as logs:
+            self.client.get('/api/recipes/')
+        self.assertIn('RecipeViewSet.list', logs.output[0])
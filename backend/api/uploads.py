@@ -0,0 +1,103 @@
+import base64
+import binascii
+import tempfile
+import uuid
+import filetype
+from django.conf import settings
+from django.core.files import File
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from django.http.multipartparser import (MultiPartParser as
+                                         DjangoMultiPartParser,
+                                         MultiPartParserError)
+from rest_framework import status
+from rest_framework.exceptions import APIException, ParseError
+from rest_framework.parsers import DataAndFiles, MultiPartParser
+
+
+IMAGE_EXTENSIONS = ('jpg', 'png', 'gif', 'webp')
+# Запас на заголовки частей multipart сверх размера самого файла
+MULTIPART_OVERHEAD = 64 * 1024
+# Кратно 4, чтобы каждый кусок base64 декодировался независимо
+BASE64_CHUNK_SIZE = 64 * 1024
+
+
+class FileTooLarge(APIException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = 'Файл слишком большой.'
+    default_code = 'file_too_large'
+
+
+class LimitedUploadHandler(TemporaryFileUploadHandler):
+    # Файл пишется на диск по частям; загрузка прерывается,
+    # как только заявленный или полученный размер превышает предел
+
+    def __init__(self, request=None, max_size=None):
+        super().__init__(request)
+        self.max_size = max_size
+
+    def handle_raw_input(self, input_data, META, content_length, boundary,
+                         encoding=None):
+        if content_length > self.max_size + MULTIPART_OVERHEAD:
+            raise FileTooLarge()
+
+    def receive_data_chunk(self, raw_data, start):
+        if start + len(raw_data) > self.max_size:
+            raise FileTooLarge()
+        return super().receive_data_chunk(raw_data, start)
+
+
+class AvatarMultiPartParser(MultiPartParser):
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        request = parser_context['request']
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        meta = request.META.copy()
+        meta['CONTENT_TYPE'] = media_type
+        upload_handlers = [
+            LimitedUploadHandler(request, settings.AVATAR_MAX_SIZE)
+        ]
+
+        try:
+            parser = DjangoMultiPartParser(meta, stream, upload_handlers,
+                                           encoding)
+            data, files = parser.parse()
+            return DataAndFiles(data, files)
+        except MultiPartParserError as exc:
+            raise ParseError(f'Ошибка разбора multipart: {exc}')
+
+
+def decode_base64_file(data, max_size):
+    # Строка декодируется кусками во временный файл, чтобы в памяти
+    # не оказалось одновременно и base64, и полное содержимое файла
+    encoded = data.partition(';base64,')[2] if ';base64,' in data else data
+    if len(encoded) * 3 // 4 > max_size:
+        raise FileTooLarge()
+
+    file = tempfile.TemporaryFile()
+    try:
+        for start in range(0, len(encoded), BASE64_CHUNK_SIZE):
+            file.write(base64.b64decode(
+                encoded[start:start + BASE64_CHUNK_SIZE], validate=True
+            ))
+    except (binascii.Error, ValueError):
+        file.close()
+        raise
+    file.seek(0)
+    return File(file)
+
+
+def sniff_image_extension(file):
+    # Тип определяется по сигнатуре содержимого, а не по заявленному
+    # Content-Type или расширению
+    file.seek(0)
+    kind = filetype.guess(file.read(261))
+    file.seek(0)
+    if kind is None:
+        return None
+    extension = 'jpg' if kind.extension == 'jpeg' else kind.extension
+    return extension if extension in IMAGE_EXTENSIONS else None
+
+
+def image_file_name(extension):
+    return f'{uuid.uuid4()}.{extension}'
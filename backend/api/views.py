@@ -2,39 +2,81 @@ from rest_framework import viewsets, status
 from rest_framework.response import Response
 from rest_framework.permissions import AllowAny, IsAuthenticated, SAFE_METHODS
 from rest_framework.decorators import action
+from rest_framework.parsers import JSONParser
 from rest_framework.exceptions import ValidationError
-from django.shortcuts import get_object_or_404, render
+from django.shortcuts import get_object_or_404
+from django.http import HttpResponse, StreamingHttpResponse
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Subquery
 from django.urls import reverse
-from django.core.files.base import ContentFile
+from django.conf import settings
+from django.core.files import File
 from django.contrib.auth import get_user_model
+from django.utils.cache import get_conditional_response
 from django_filters.rest_framework import DjangoFilterBackend
 from djoser.views import UserViewSet as DjoserUserViewSet
-from recipes.models import (Recipe, Ingredient, Favorite,
-                            ShoppingCart, Subscription)
+from recipes.counters import shift_counter, suspend_row_handlers
+from recipes.feeds import feed_recipes
+from recipes.ingredient_index import ingredient_index
+from recipes.popularity import forget_links
+from recipes.shopping_lists import (add_recipes, remove_recipes,
+                                    shopping_list_items)
+from recipes.short_links import encode, recipe_ids
+from recipes.models import (Recipe, Ingredient, Favorite, ShoppingCart,
+                            Subscription)
 from api.serializers import (RecipeReadSerializer,
                              RecipeCreateUpdateSerializer,
                              ShortRecipeSerializer,
                              IngredientSerializer,
-                             UserWithRecipesSerializer)
+                             UserWithRecipesSerializer,
+                             RecipeIdsSerializer,
+                             ShoppingListItemSerializer,
+                             get_recipes_limit)
+from api.mixins import AnonymousCacheMixin, ConditionalRetrieveMixin
+from api.paginators import RecipePagination
 from api.permissions import IsAuthorOrReadOnly
-from api.filters import RecipeFilter, IngredientFilter
-import uuid
-import base64
+from api.filters import RecipeFilter
+from api.renderers import (ShoppingCartHTMLRenderer,
+                           ShoppingCartTextRenderer,
+                           ShoppingCartCSVRenderer)
+from api.uploads import (AvatarMultiPartParser, decode_base64_file,
+                         image_file_name, sniff_image_extension)
+from collections import defaultdict
+import binascii
 
 
 User = get_user_model()
 
 
-class RecipeViewSet(viewsets.ModelViewSet):
-    queryset = Recipe.objects.all()
+def lock_user_links(user):
+    # Избранное и корзина пользователя меняются под блокировкой его
+    # строки: параллельные запросы идут по очереди, и каждый видит
+    # связи, записанные предыдущим. Вызывается внутри транзакции
+    list(User.objects.select_for_update().filter(pk=user.pk)
+         .values_list('pk', flat=True))
+
+
+class RecipeViewSet(ConditionalRetrieveMixin, AnonymousCacheMixin,
+                    viewsets.ModelViewSet):
     filter_backends = (DjangoFilterBackend,)
     filterset_class = RecipeFilter
+    pagination_class = RecipePagination
 
     def get_permissions(self):
+        if self.action in ('feed', 'download_cart', 'shopping_list'):
+            return (IsAuthenticated(),)
         if self.request.method not in SAFE_METHODS:
             return (IsAuthenticated(), IsAuthorOrReadOnly())
         return (IsAuthorOrReadOnly(),)
 
+    def get_queryset(self):
+        user = self.request.user
+        if self.action in ('list', 'retrieve'):
+            return Recipe.objects.for_read(user)
+        if self.action == 'feed':
+            return feed_recipes(user).for_read(user)
+        return Recipe.objects.all()
+
     def get_serializer_class(self):
         if self.action in ('create', 'update', 'partial_update'):
             return RecipeCreateUpdateSerializer
@@ -42,21 +84,57 @@ class RecipeViewSet(viewsets.ModelViewSet):
             return ShortRecipeSerializer
         return RecipeReadSerializer
 
+    def get_retrieve_validators(self):
+        user = self.request.user
+        try:
+            validators = (
+                Recipe.objects.with_user_flags(user)
+                .filter(pk=self.kwargs['pk'])
+                .annotate(author_is_subscribed=Exists(
+                    Subscription.objects.filter(subscriber=user.id,
+                                                author=OuterRef('author'))
+                ))
+                .values_list('id', 'updated_at', 'author__updated_at',
+                             'is_favorited', 'is_in_shopping_cart',
+                             'author_is_subscribed')
+                .order_by()
+                .first()
+            )
+        except ValueError:
+            return None
+        if validators is None:
+            return None
+        return validators, max(validators[1:3])
+
     def perform_create(self, serializer):
         serializer.save(author=self.request.user)
 
+    @action(detail=False)
+    def feed(self, request):
+        recipes = self.paginate_queryset(self.get_queryset())
+        serializer = self.get_serializer(recipes, many=True)
+        return self.get_paginated_response(serializer.data)
+
     @action(detail=True, methods=['get'], url_path='get-link')
     def get_link(self, request, pk=None):
-        if not Recipe.objects.filter(pk=pk).exists():
+        try:
+            recipe_id = int(pk)
+        except ValueError:
+            recipe_id = None
+        if recipe_id is None or recipe_id not in recipe_ids:
             raise ValidationError(f'Рецепт с id={pk} не найден')
 
-        short_path = reverse('short-link', kwargs={'recipe_id': pk})
+        short_path = reverse('short-link',
+                             kwargs={'code': encode(recipe_id)})
         short_link = request.build_absolute_uri(short_path)
         return Response({'short-link': short_link}, status=status.HTTP_200_OK)
 
     def _add_user_recipe_relation(self, model, user, recipe_pk):
         recipe = get_object_or_404(Recipe, pk=recipe_pk)
-        obj, created = model.objects.get_or_create(user=user, recipe=recipe)
+        with transaction.atomic():
+            lock_user_links(user)
+            obj, created = model.objects.get_or_create(user=user,
+                                                       recipe=recipe)
         if not created:
             place = 'избранном' if model is Favorite else 'корзине'
             return Response({'errors': f'Рецепт с id={recipe_pk} в {place}'},
@@ -66,7 +144,10 @@ class RecipeViewSet(viewsets.ModelViewSet):
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
     def _delete_user_recipe_relation(self, model, user, recipe_pk):
-        get_object_or_404(model, user=user, recipe_id=recipe_pk).delete()
+        with transaction.atomic():
+            lock_user_links(user)
+            get_object_or_404(model, user=user,
+                              recipe_id=recipe_pk).delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     @action(
@@ -95,68 +176,226 @@ class RecipeViewSet(viewsets.ModelViewSet):
         return self._delete_user_recipe_relation(ShoppingCart, request.user,
                                                  pk)
 
+    def _bulk_user_recipe_relations(self, model, request):
+        # Число запросов не зависит от размера пачки: блокировка,
+        # выборка существующих рецептов и связей, затем одна вставка
+        # или одно удаление и один сдвиг счётчиков. Связи читаются
+        # под блокировкой, поэтому вставляются и удаляются ровно те
+        # строки, на которые сдвигаются счётчики
+        serializer = RecipeIdsSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        ids = list(dict.fromkeys(serializer.validated_data['ids']))
+
+        with transaction.atomic(), suspend_row_handlers():
+            lock_user_links(request.user)
+            links = model.objects.filter(user=request.user,
+                                         recipe_id__in=ids)
+            linked_at = dict(links.values_list('recipe_id', 'created_at'))
+            linked = set(linked_at)
+            if request.method == 'POST':
+                existing = set(Recipe.objects.filter(id__in=ids)
+                               .values_list('id', flat=True))
+                added = [pk for pk in ids
+                         if pk in existing and pk not in linked]
+                model.objects.bulk_create(
+                    model(user=request.user, recipe_id=pk) for pk in added
+                )
+                if model is Favorite:
+                    shift_counter(Recipe, added, 'favorites_count', 1)
+                else:
+                    add_recipes(request.user.id, added)
+            else:
+                links.filter(recipe_id__in=linked).delete()
+                if model is Favorite:
+                    shift_counter(Recipe, linked, 'favorites_count', -1)
+                else:
+                    remove_recipes(request.user.id, linked)
+                forget_links(model, linked_at.items())
+
+        if request.method == 'POST':
+            results = [
+                {'id': pk, 'status': 'not_found' if pk not in existing
+                 else 'exists' if pk in linked else 'added'}
+                for pk in ids
+            ]
+        else:
+            results = [
+                {'id': pk, 'status': 'removed' if pk in linked else 'absent'}
+                for pk in ids
+            ]
+        return Response({'results': results}, status=status.HTTP_200_OK)
+
+    @action(
+        methods=['post', 'delete'],
+        detail=False,
+        permission_classes=[IsAuthenticated],
+        url_path='favorite/bulk'
+    )
+    def bulk_favorite(self, request):
+        return self._bulk_user_recipe_relations(Favorite, request)
+
+    @action(
+        methods=['post', 'delete'],
+        detail=False,
+        permission_classes=[IsAuthenticated],
+        url_path='shopping_cart/bulk'
+    )
+    def bulk_cart(self, request):
+        return self._bulk_user_recipe_relations(ShoppingCart, request)
+
     @action(detail=False, methods=['get'], url_path='download_shopping_cart',
-            permission_classes=[IsAuthenticated])
+            renderer_classes=[ShoppingCartHTMLRenderer,
+                              ShoppingCartTextRenderer,
+                              ShoppingCartCSVRenderer])
     def download_cart(self, request):
-        user = request.user
-        recipe_ids = user.shopping_carts.values_list('recipe', flat=True)
-        recipes = Recipe.objects.filter(id__in=recipe_ids)
-        cart = dict()
-        for recipe in recipes:
-            for recipe_ingredient in recipe.recipe_ingredients.all():
-                ingredient = recipe_ingredient.ingredient
-                amount = recipe_ingredient.amount
-                if ingredient.name in cart:
-                    cart[ingredient.name][0] += amount
-                else:
-                    cart[ingredient.name] = [amount,
-                                             ingredient.measurement_unit]
-        return render(request, 'shopping_cart.html', {'cart': cart})
+        # Суммы уже лежат в списке покупок, он читается по индексу,
+        # а файл отдаётся клиенту по мере чтения строк
+        items = shopping_list_items(request.user).values(
+            'ingredient_id',
+            name=F('ingredient__name'),
+            measurement_unit=F('ingredient__measurement_unit'),
+            amount_total=F('amount')
+        )
+        renderer = request.accepted_renderer
+        response = StreamingHttpResponse(
+            renderer.stream(items.iterator()),
+            content_type=renderer.get_content_type()
+        )
+        response['Content-Disposition'] = (
+            f'attachment; filename="shopping_list.{renderer.format}"'
+        )
+        return response
+
+    @action(detail=False, url_path='shopping_list')
+    def shopping_list(self, request):
+        serializer = ShoppingListItemSerializer(
+            shopping_list_items(request.user), many=True
+        )
+        return Response(serializer.data)
+
+
+def ingredient_index_response(request):
+    # Полный список продуктов, заранее сериализованный в индексе
+    _, _, payload, etag = ingredient_index.snapshot
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = HttpResponse(payload, content_type='application/json')
+    response['ETag'] = etag
+    return response
 
 
 class IngredientViewSet(viewsets.ReadOnlyModelViewSet):
     queryset = Ingredient.objects.all()
     serializer_class = IngredientSerializer
-    filter_backends = (DjangoFilterBackend,)
-    filterset_class = IngredientFilter
     permission_classes = (AllowAny,)
     pagination_class = None
 
+    def list(self, request, *args, **kwargs):
+        # Поиск по началу названия и полный список отдаются из индекса
+        # в памяти процесса, без запросов к базе
+        name = request.query_params.get('name')
+        if name:
+            return Response(ingredient_index.search(name))
+
+        ingredient_index.ensure_fresh()
+        return ingredient_index_response(request)
+
 
-class UserViewSet(DjoserUserViewSet):
+class UserViewSet(ConditionalRetrieveMixin, DjoserUserViewSet):
     @action(detail=False, methods=['put', 'delete'],
-            permission_classes=[IsAuthenticated], url_path='me/avatar')
+            permission_classes=[IsAuthenticated], url_path='me/avatar',
+            parser_classes=[JSONParser, AvatarMultiPartParser])
     def avatar(self, request):
         user = request.user
 
         if request.method == 'PUT':
-            avatar_b64 = request.data.get('avatar')
-            if not avatar_b64:
+            avatar = request.data.get('avatar')
+            if not avatar:
                 return Response({'avatar': ['Обязательное поле']},
                                 status=status.HTTP_400_BAD_REQUEST)
-            try:
-                format, imgstr = avatar_b64.split(';base64,')
-                ext = format.split('/')[-1]
-                name = f'{uuid.uuid4()}.{ext}'
-                data = ContentFile(base64.b64decode(imgstr), name=name)
-
-                user.avatar.save(data.name, data, save=True)
-                return Response({'avatar':
-                                 request.build_absolute_uri(user.avatar.url)})
-            except Exception:
-                return Response({'error': 'Неправильные данные'},
+            if isinstance(avatar, str):
+                try:
+                    avatar = decode_base64_file(avatar,
+                                                settings.AVATAR_MAX_SIZE)
+                except (binascii.Error, ValueError):
+                    return Response(
+                        {'avatar': ['Неправильная строка base64']},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+            elif not isinstance(avatar, File):
+                return Response({'avatar': ['Ожидается файл или base64']},
                                 status=status.HTTP_400_BAD_REQUEST)
+
+            with avatar:
+                extension = sniff_image_extension(avatar)
+                if extension is None:
+                    return Response(
+                        {'avatar': ['Файл не является изображением']},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+                old_avatar = user.avatar.name
+                user.avatar.save(image_file_name(extension), avatar,
+                                 save=True)
+            if old_avatar:
+                user.avatar.storage.delete(old_avatar)
+            return Response({'avatar':
+                             request.build_absolute_uri(user.avatar.url)})
         elif request.method == 'DELETE':
             user.avatar.delete(save=True)
             return Response(status=status.HTTP_204_NO_CONTENT)
 
-    @action(detail=False, methods=['get'], url_path='subscriptions')
+    def get_permissions(self):
+        # djoser 2.1 не применяет PERMISSIONS['current_user'] к /me/
+        if self.action == 'me':
+            return (IsAuthenticated(),)
+        return super().get_permissions()
+
+    def get_queryset(self):
+        return super().get_queryset().with_is_subscribed(self.request.user)
+
+    def get_retrieve_validators(self):
+        user = self.request.user
+        if self.action == 'me':
+            return (user.id, user.updated_at), user.updated_at
+        try:
+            validators = (User.objects.with_is_subscribed(user)
+                          .filter(pk=self.kwargs['id'])
+                          .values_list('id', 'updated_at', 'is_subscribed')
+                          .first())
+        except ValueError:
+            return None
+        if validators is None:
+            return None
+        return validators, validators[1]
+
+    def _with_recipes_preview(self, authors):
+        # Последние recipes_limit рецептов каждого автора страницы
+        # выбираются одним запросом: коррелированный подзапрос с LIMIT
+        # отбирает id рецептов внутри каждого автора
+        recipes = Recipe.objects.filter(author__in=authors)
+        recipes_limit = get_recipes_limit(self.request)
+        if recipes_limit:
+            recipes = recipes.filter(id__in=Subquery(
+                Recipe.objects.filter(author=OuterRef('author'))
+                .values('id')[:recipes_limit]
+            ))
+
+        previews = defaultdict(list)
+        for recipe in recipes:
+            previews[recipe.author_id].append(recipe)
+        for author in authors:
+            author.recipes_preview = previews[author.id]
+        return authors
+
+    @action(detail=False, methods=['get'], url_path='subscriptions',
+            permission_classes=[IsAuthenticated])
     def subscriptions(self, request):
-        subscriptions = Subscription.objects.filter(subscriber=request.user)
-        authors = User.objects.filter(id__in=subscriptions
-                                      .values_list('author_id', flat=True))
+        authors = (User.objects
+                   .filter(subscriptions_to__subscriber=request.user)
+                   .with_is_subscribed(request.user)
+                   .order_by('subscriptions_to__id'))
 
-        page = self.paginate_queryset(authors)
+        page = self._with_recipes_preview(self.paginate_queryset(authors))
         context = self.get_serializer_context()
         serializer = UserWithRecipesSerializer(page, many=True,
                                                context=context)
@@ -187,6 +426,8 @@ class UserViewSet(DjoserUserViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
+        author.is_subscribed = True
+        self._with_recipes_preview([author])
         context = self.get_serializer_context()
         serializer = UserWithRecipesSerializer(author, context=context)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
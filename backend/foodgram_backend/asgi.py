@@ -12,5 +12,8 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'foodgram_backend.settings')
+# Короткие ссылки, поиск продуктов и просмотр рецепта обслуживаются
+# async-views, остальные адреса — как в WSGI
+os.environ.setdefault('ROOT_URLCONF', 'foodgram_backend.asgi_urls')
 
 application = get_asgi_application()
@@ -0,0 +1,13 @@
+from django.urls import path, include
+from api.async_views import ingredient_list, recipe_detail
+from recipes.async_views import (recipe_id_redirect_async_view,
+                                 short_recipe_async_view)
+
+
+urlpatterns = [
+    path('api/recipes/<int:pk>/', recipe_detail),
+    path('api/ingredients/', ingredient_list),
+    path('r/<str:code>/', short_recipe_async_view, name='short-link'),
+    path('s/<int:recipe_id>/', recipe_id_redirect_async_view),
+    path('', include('foodgram_backend.urls')),
+]
@@ -44,6 +44,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'rest_framework',
     'rest_framework.authtoken',
     'django_filters',
@@ -60,9 +61,11 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'api.middleware.QueryStatsMiddleware',
 ]
 
-ROOT_URLCONF = 'foodgram_backend.urls'
+# В режиме ASGI asgi.py подменяет URLconf на вариант с async-views
+ROOT_URLCONF = os.getenv('ROOT_URLCONF', 'foodgram_backend.urls')
 
 TEMPLATES = [
     {
@@ -98,6 +101,27 @@ DATABASES = {
 }
 
 
+# Кэш: CACHE_BACKEND — locmem, file или полный путь к классу бэкенда
+CACHE_BACKENDS = {
+    'locmem': 'django.core.cache.backends.locmem.LocMemCache',
+    'file': 'django.core.cache.backends.filebased.FileBasedCache',
+}
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'locmem')
+
+CACHES = {
+    'default': {
+        'BACKEND': CACHE_BACKENDS.get(CACHE_BACKEND, CACHE_BACKEND),
+        'LOCATION': os.getenv(
+            'CACHE_LOCATION',
+            str(BASE_DIR / 'cache') if CACHE_BACKEND == 'file' else ''
+        ),
+    }
+}
+
+# Время жизни закэшированных ответов для анонимных пользователей
+RECIPE_CACHE_TIMEOUT = int(os.getenv('RECIPE_CACHE_TIMEOUT', 300))
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -128,10 +152,18 @@ REST_FRAMEWORK = {
     ],
 
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'api.authentication.CachedTokenAuthentication',
     ],
 }
 
+# Сколько секунд пользователь, найденный по токену, хранится в кэше
+AUTH_TOKEN_CACHE_TTL = int(os.getenv('AUTH_TOKEN_CACHE_TTL', 300))
+
+
+# Наибольшее число рецептов в одном запросе массового добавления
+# в избранное или корзину
+BULK_RECIPES_MAX_IDS = 500
+
 
 DJOSER = {
     'SERIALIZERS': {
@@ -170,7 +202,78 @@ STATIC_ROOT = BASE_DIR / 'staticfiles/static'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media/'
 
+# Изображения рецептов: предел размера загрузки, формат хранения
+# и наибольшая сторона копий для списка и страницы рецепта
+RECIPE_IMAGE_MAX_SIZE = int(os.getenv('RECIPE_IMAGE_MAX_SIZE',
+                                      5 * 1024 * 1024))
+RECIPE_IMAGE_MAX_PIXELS = 40_000_000
+RECIPE_IMAGE_MAX_SIDE = 2048
+RECIPE_IMAGE_FORMAT = 'WEBP'
+RECIPE_IMAGE_QUALITY = 85
+RECIPE_IMAGE_SMALL_SIZE = 400
+RECIPE_IMAGE_LARGE_SIZE = 1200
+AVATAR_MAX_SIZE = int(os.getenv('AVATAR_MAX_SIZE', 2 * 1024 * 1024))
+IMAGE_PROCESSING_WORKERS = int(os.getenv('IMAGE_PROCESSING_WORKERS', 2))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Как часто индекс продуктов в памяти процесса сверяет версию с кэшем
+# и через сколько перестраивается в любом случае, в секундах
+INGREDIENT_INDEX_REFRESH = int(os.getenv('INGREDIENT_INDEX_REFRESH', 30))
+INGREDIENT_INDEX_TTL = int(os.getenv('INGREDIENT_INDEX_TTL', 300))
+
+# Как часто индекс «продукт -> рецепты» сверяет версию с кэшем и через
+# сколько перестраивается в любом случае, в секундах, и сколько рецептов
+# максимум отдаёт подбор по имеющимся продуктам
+RECIPE_INGREDIENT_INDEX_REFRESH = int(
+    os.getenv('RECIPE_INGREDIENT_INDEX_REFRESH', 30)
+)
+RECIPE_INGREDIENT_INDEX_TTL = int(
+    os.getenv('RECIPE_INGREDIENT_INDEX_TTL', 300)
+)
+RECIPE_MATCH_LIMIT = int(os.getenv('RECIPE_MATCH_LIMIT', 500))
+
+# Лента подписок: рецепты авторов, у которых подписчиков больше
+# FEED_FANOUT_LIMIT, не раскладываются по лентам, а подмешиваются при чтении
+FEED_FANOUT_LIMIT = int(os.getenv('FEED_FANOUT_LIMIT', 10000))
+FEED_BACKFILL_SIZE = int(os.getenv('FEED_BACKFILL_SIZE', 50))
+FEED_BATCH_SIZE = 1000
+FEED_LARGE_AUTHORS_TTL = 60
+
+# Короткие ссылки: как часто набор id рецептов сверяет версию с кэшем
+# и когда буфер переходов записывается в базу
+SHORT_LINK_INDEX_REFRESH = int(os.getenv('SHORT_LINK_INDEX_REFRESH', 30))
+SHORT_LINK_INDEX_TTL = int(os.getenv('SHORT_LINK_INDEX_TTL', 300))
+SHORT_LINK_FLUSH_SIZE = int(os.getenv('SHORT_LINK_FLUSH_SIZE', 100))
+SHORT_LINK_FLUSH_INTERVAL = int(os.getenv('SHORT_LINK_FLUSH_INTERVAL', 10))
+
+# Размер пачки при вставке строк списков покупок
+SHOPPING_LIST_BATCH_SIZE = 1000
+
+# Сколько секунд админка кэширует границы и счётчики фильтров
+# и сколько самых активных авторов показывает фильтр рецептов
+ADMIN_FILTER_CACHE_TTL = int(os.getenv('ADMIN_FILTER_CACHE_TTL', 60))
+ADMIN_AUTHOR_FILTER_LIMIT = 50
+
+# Бюджеты запросов к базе на один HTTP-запрос: превышение пишется
+# в лог api.sql. SQL_BUDGETS переопределяет их для отдельных views,
+# ключ — 'ViewSet.action', например 'RecipeViewSet.list'
+SQL_QUERY_BUDGET = int(os.getenv('SQL_QUERY_BUDGET', 20))
+SQL_TIME_BUDGET_MS = int(os.getenv('SQL_TIME_BUDGET_MS', 200))
+SQL_REPEATED_QUERY_THRESHOLD = 3
+SQL_BUDGETS = {}
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'api.sql': {'handlers': ['console'], 'level': 'WARNING'},
+    },
+}
@@ -1,40 +1,65 @@
+from django.conf import settings
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
+from django.core.cache import cache
 from django.utils.safestring import mark_safe
-from django.db.models import Count
+from django.db.models import (Count, Exists, IntegerField, OuterRef,
+                              Prefetch, Q, Subquery)
+from django.db.models.functions import Coalesce
 from recipes.models import (CustomUser, Recipe, Ingredient, RecipeIngredient,
                             Favorite, ShoppingCart, Subscription)
 from django.contrib.admin import SimpleListFilter
 
 
+COOKING_TIME_BORDERS_CACHE_KEY = 'admin:cooking_time_borders'
+TOP_AUTHORS_CACHE_KEY = 'admin:top_authors'
+
+
+def compute_cooking_time_borders():
+    # Границы — значения на трети и двух третях упорядоченного списка
+    # различных времён готовки. Берутся в базе через OFFSET, число
+    # рецептов в каждой группе считается одним запросом
+    times = (Recipe.objects.order_by('cooking_time')
+             .values_list('cooking_time', flat=True).distinct())
+    total = times.count()
+    if total < 3:
+        return None
+    shortest, longest = times[total // 3], times[(2 * total) // 3]
+    counts = Recipe.objects.aggregate(
+        fast=Count('id', filter=Q(cooking_time__lt=shortest)),
+        medium=Count('id', filter=Q(cooking_time__gte=shortest,
+                                    cooking_time__lt=longest)),
+        long=Count('id', filter=Q(cooking_time__gte=longest)),
+    )
+    return shortest, longest, counts
+
+
+def cooking_time_borders():
+    return cache.get_or_set(COOKING_TIME_BORDERS_CACHE_KEY,
+                            compute_cooking_time_borders,
+                            settings.ADMIN_FILTER_CACHE_TTL)
+
+
 class CookingTimeFilter(SimpleListFilter):
     title = 'Время готовки'
     parameter_name = 'cooking_time_range'
+    borders = None
 
     def lookups(self, request, model_admin):
-        times = Recipe.objects.all().values_list('cooking_time',
-                                                 flat=True).distinct()
-        if len(times) < 3:
+        self.borders = cooking_time_borders()
+        if self.borders is None:
             return list()
 
-        sorted_times = sorted(times)
-        total = len(sorted_times)
-
-        self.shortest_border = sorted_times[total // 3]
-        self.longest_border = sorted_times[(2 * total) // 3]
-
-        fast = Recipe.objects.filter(cooking_time__lt=self.shortest_border)
-        medium = Recipe.objects.filter(cooking_time__gte=self.shortest_border,
-                                       cooking_time__lt=self.longest_border)
-        long = Recipe.objects.filter(cooking_time__gte=self.longest_border)
-
+        self.shortest_border, self.longest_border, counts = self.borders
         return [
-            ('<', f'Быстрее {self.shortest_border} мин ({fast.count()})'),
-            ('<>', f'Быстрее {self.longest_border} мин ({medium.count()})'),
-            ('>', f'Долго ({long.count()})')
+            ('<', f'Быстрее {self.shortest_border} мин ({counts["fast"]})'),
+            ('<>', f'Быстрее {self.longest_border} мин ({counts["medium"]})'),
+            ('>', f'Долго ({counts["long"]})')
         ]
 
     def queryset(self, request, recipes_queryset):
+        if self.borders is None:
+            return recipes_queryset
         if self.value() == '<':
             return recipes_queryset.filter(
                 cooking_time__lt=self.shortest_border
@@ -51,6 +76,28 @@ class CookingTimeFilter(SimpleListFilter):
         return recipes_queryset
 
 
+class AuthorFilter(SimpleListFilter):
+    title = 'Автор'
+    parameter_name = 'author'
+
+    def lookups(self, request, model_admin):
+        # Все авторы на большой базе — десятки тысяч ссылок на странице,
+        # поэтому показываются самые активные, остальные находятся поиском
+        authors = cache.get_or_set(
+            TOP_AUTHORS_CACHE_KEY,
+            lambda: list(CustomUser.objects.order_by('-recipes_count', 'id')
+                         .values_list('id', 'email')
+                         [:settings.ADMIN_AUTHOR_FILTER_LIMIT]),
+            settings.ADMIN_FILTER_CACHE_TTL
+        )
+        return [(str(pk), email) for pk, email in authors]
+
+    def queryset(self, request, recipes_queryset):
+        if self.value() and self.value().isdigit():
+            return recipes_queryset.filter(author_id=self.value())
+        return recipes_queryset
+
+
 class IsUsedInRecipesFilter(SimpleListFilter):
     title = 'Есть в рецептах'
     parameter_name = 'is_used_in_recipes'
@@ -63,10 +110,13 @@ class IsUsedInRecipesFilter(SimpleListFilter):
         return self.LOOKUP_CHOICES
 
     def queryset(self, request, ingredients_queryset):
+        is_used = Exists(
+            RecipeIngredient.objects.filter(ingredient=OuterRef('pk'))
+        )
         if self.value() == 'yes':
-            return ingredients_queryset.filter(recipes_count__gt=0)
+            return ingredients_queryset.filter(is_used)
         if self.value() == 'no':
-            return ingredients_queryset.filter(recipes_count=0)
+            return ingredients_queryset.filter(~is_used)
         return ingredients_queryset
 
 
@@ -87,13 +137,7 @@ class CustomUserAdmin(UserAdmin):
 
     def get_queryset(self, request):
         self.request = request
-        qs = super().get_queryset(request)
-        qs = qs.annotate(
-            recipes_count=Count('recipes', distinct=True),
-            subscriptions_count=Count('subscriptions_from', distinct=True),
-            subscribers_count=Count('subscriptions_to', distinct=True)
-        )
-        return qs
+        return super().get_queryset(request)
 
     @admin.display(description='ФИО')
     def full_name(self, user):
@@ -107,37 +151,25 @@ class CustomUserAdmin(UserAdmin):
             return f'<img src="{avatar_url}" width="50" height="50"/>'
         return '-'
 
-    @admin.display(description='Рецептов')
-    def recipes_count(self, user):
-        return user.recipes_count
-
-    @admin.display(description='Подписок')
-    def subscriptions_count(self, user):
-        return user.subscriptions_count
-
-    @admin.display(description='Подписчиков')
-    def subscribers_count(self, user):
-        return user.subscribers_count
-
 
 @admin.register(Recipe)
 class RecipeAdmin(admin.ModelAdmin):
-    readonly_fields = ('favorites_count',)
+    readonly_fields = ('favorites_count', 'short_link_clicks')
     search_fields = ('name', 'author__email',
                      'author__first_name', 'author__last_name')
     list_display = ('id', 'name', 'cooking_time', 'author',
-                    'favorites_count', 'ingredients_list', 'image_preview')
-    list_filter = ('author', CookingTimeFilter)
+                    'favorites_count', 'short_link_clicks', 'ingredients_list',
+                    'image_preview')
+    list_filter = (AuthorFilter, CookingTimeFilter)
+    list_select_related = ('author',)
 
     def get_queryset(self, request):
         self.request = request
-        qs = super().get_queryset(request)
-        qs = qs.annotate(favorites_count=Count('favorites'))
-        return qs
-
-    @admin.display(description='В избранном')
-    def favorites_count(self, recipe):
-        return recipe.favorites_count
+        return super().get_queryset(request).prefetch_related(Prefetch(
+            'recipe_ingredients',
+            queryset=(RecipeIngredient.objects.select_related('ingredient')
+                      .order_by('ingredient__name'))
+        ))
 
     @admin.display(description='Продукты')
     @mark_safe
@@ -162,11 +194,18 @@ class IngredientAdmin(admin.ModelAdmin):
     list_filter = ('measurement_unit', IsUsedInRecipesFilter)
 
     def get_queryset(self, request):
-        qs = super().get_queryset(request)
-        qs = qs.annotate(recipes_count=Count('recipes'))
-        return qs
+        # Коррелированный подзапрос вместо JOIN с GROUP BY: считается
+        # только для строк страницы и опирается на индекс ingredient_id
+        recipes_count = (RecipeIngredient.objects
+                         .filter(ingredient=OuterRef('pk')).order_by()
+                         .values('ingredient').annotate(total=Count('id'))
+                         .values('total'))
+        return super().get_queryset(request).annotate(
+            recipes_count=Coalesce(Subquery(recipes_count), 0,
+                                   output_field=IntegerField())
+        )
 
-    @admin.display(description='Рецептов')
+    @admin.display(description='Рецептов', ordering='recipes_count')
     def recipes_count(self, ingredient):
         return ingredient.recipes_count
 
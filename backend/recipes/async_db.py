@@ -0,0 +1,18 @@
+from functools import wraps
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+
+
+def run_in_thread(func):
+    # В Django 3.2 sync_to_async(thread_sensitive=True) выполняет весь
+    # синхронный код в одном потоке, и запросы к базе идут по очереди.
+    # Здесь вызов уходит в пул потоков, а соединение потока
+    # закрывается по CONN_MAX_AGE так же, как в конце WSGI-запроса
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return sync_to_async(wrapper, thread_sensitive=False)
@@ -0,0 +1,14 @@
+from recipes.async_db import run_in_thread
+from recipes.views import recipe_id_redirect_view, short_recipe_view
+
+
+# Проверка id идёт по набору в памяти, но изредка сверяет версию
+# с кэшем и перестраивает набор, поэтому вызов уходит в пул потоков
+
+
+async def short_recipe_async_view(request, code):
+    return await run_in_thread(short_recipe_view)(request, code)
+
+
+async def recipe_id_redirect_async_view(request, recipe_id):
+    return await run_in_thread(recipe_id_redirect_view)(request, recipe_id)
@@ -0,0 +1,13 @@
+def percentile(latencies, share):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * share))]
+
+
+def latency_summary(latencies):
+    # Перцентили в миллисекундах по списку длительностей в секундах
+    latencies = sorted(latencies)
+    return {
+        f'p{round(share * 100)}_ms': round(
+            percentile(latencies, share) * 1000, 2
+        )
+        for share in (0.5, 0.95, 0.99)
+    }
@@ -0,0 +1,92 @@
+import threading
+import time
+from abc import ABCMeta, abstractmethod
+from django.conf import settings
+from django.core.cache import cache
+
+
+RECIPES_LIST_VERSION_KEY = 'recipes_list_version'
+
+
+def recipe_version_key(recipe_id):
+    return f'recipe_version:{recipe_id}'
+
+
+def get_version(key):
+    # Ключ версии может быть вытеснен из кэша. Новый счётчик
+    # начинается с текущего времени в наносекундах, а не с 1, поэтому
+    # он больше любой прежней версии и старые ответы не оживают
+    return cache.get_or_set(key, time.time_ns, None)
+
+
+def bump_version(key):
+    # Старые записи, собранные с прежней версией в ключе, просто
+    # перестают запрашиваться и вытесняются по таймауту
+    try:
+        return cache.incr(key)
+    except ValueError:
+        version = time.time_ns()
+        cache.set(key, version, None)
+        return version
+
+
+def bump_recipe_versions(recipe_ids):
+    for recipe_id in recipe_ids:
+        bump_version(recipe_version_key(recipe_id))
+    bump_version(RECIPES_LIST_VERSION_KEY)
+
+
+class VersionedIndex(metaclass=ABCMeta):
+    # Данные в памяти процесса с версией в кэше. Процесс, внёсший
+    # изменение, правит свою копию сразу и поднимает версию; остальные
+    # замечают новую версию и перестраивают копию, сверяясь с кэшем
+    # не чаще refresh_setting секунд. Кэш может быть свой у каждого
+    # процесса, поэтому копия старше ttl_setting секунд перестраивается
+    # в любом случае
+    version_key = None
+    refresh_setting = None
+    ttl_setting = None
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._version = None
+        self._checked_at = 0
+        self._built_at = 0
+
+    @abstractmethod
+    def _build(self):
+        # Собирает данные из базы заново
+        pass
+
+    def ensure_fresh(self, force=False):
+        # force: данных в копии не нашлось. Тогда она перестраивается,
+        # если старше refresh_setting секунд, а не ttl_setting
+        now = time.monotonic()
+        refresh = getattr(settings, self.refresh_setting)
+        if (not force and self._version is not None
+                and now - self._checked_at < refresh):
+            return
+        ttl = refresh if force else getattr(settings, self.ttl_setting)
+        with self._lock:
+            if (self._version is None or now - self._built_at >= ttl
+                    or cache.get(self.version_key) != self._version):
+                version = get_version(self.version_key)
+                self._build()
+                self._version = version
+                self._built_at = now
+            self._checked_at = now
+
+    def _apply(self, change):
+        with self._lock:
+            version = bump_version(self.version_key)
+            # Если до этого версию поднял другой процесс, копия
+            # устарела целиком и будет перестроена при следующем запросе
+            if self._version is None or version != self._version + 1:
+                self._version = None
+                return
+            change()
+            self._version = version
+
+    def invalidate(self):
+        bump_version(self.version_key)
+        self._version = None
@@ -0,0 +1,34 @@
+import threading
+from contextlib import contextmanager
+from django.db.models import F
+from django.db.models.functions import Greatest
+
+
+_state = threading.local()
+
+
+def row_handlers_suspended():
+    return getattr(_state, 'suspended', False)
+
+
+@contextmanager
+def suspend_row_handlers():
+    # Массовые операции отключают построчную обработку в сигналах
+    # (счётчики, списки покупок, популярность, обновление рецепта)
+    # и выполняют её сами одним запросом. Вложенный вызов возвращает
+    # прежнее значение, а не снимает отключение внешнего
+    suspended = row_handlers_suspended()
+    _state.suspended = True
+    try:
+        yield
+    finally:
+        _state.suspended = suspended
+
+
+def shift_counter(model, pks, field, delta):
+    # Счётчики беззнаковые: расхождение не должно уводить их ниже нуля
+    if pks:
+        value = F(field) + delta
+        if delta < 0:
+            value = Greatest(value, 0)
+        model.objects.filter(pk__in=pks).update(**{field: value})
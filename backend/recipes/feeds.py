@@ -0,0 +1,115 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Q
+from recipes.models import CustomUser, FeedEntry, Recipe, Subscription
+
+
+logger = logging.getLogger(__name__)
+
+LARGE_AUTHORS_CACHE_KEY = 'feed_large_authors'
+
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='feed-fanout')
+
+
+def subscribers_count(author_id):
+    return CustomUser.objects.filter(pk=author_id).values_list(
+        'subscribers_count', flat=True
+    ).first() or 0
+
+
+def is_large_author(author_id):
+    return subscribers_count(author_id) > settings.FEED_FANOUT_LIMIT
+
+
+def large_author_ids():
+    # Авторов с огромным числом подписчиков мало, их id кэшируются
+    # целиком, и ленту не нужно соединять с таблицей подписок
+    return cache.get_or_set(
+        LARGE_AUTHORS_CACHE_KEY,
+        lambda: set(CustomUser.objects.filter(
+            subscribers_count__gt=settings.FEED_FANOUT_LIMIT
+        ).values_list('id', flat=True)),
+        settings.FEED_LARGE_AUTHORS_TTL
+    )
+
+
+def insert_entries(entries):
+    FeedEntry.objects.bulk_create(entries, batch_size=settings.FEED_BATCH_SIZE,
+                                  ignore_conflicts=True)
+
+
+def fan_out_recipe(recipe_id, author_id, created_at):
+    subscriber_ids = Subscription.objects.filter(
+        author=author_id
+    ).values_list('subscriber_id', flat=True)
+    batch = []
+    for subscriber_id in subscriber_ids.iterator(
+            chunk_size=settings.FEED_BATCH_SIZE):
+        batch.append(FeedEntry(user_id=subscriber_id, recipe_id=recipe_id,
+                               created_at=created_at))
+        if len(batch) >= settings.FEED_BATCH_SIZE:
+            insert_entries(batch)
+            batch = []
+    insert_entries(batch)
+
+
+def _fan_out_in_thread(recipe_id, author_id, created_at):
+    try:
+        fan_out_recipe(recipe_id, author_id, created_at)
+    except Exception:
+        logger.exception('Не удалось разложить рецепт %s по лентам, '
+                         'их исправит rebuild_feeds', recipe_id)
+    finally:
+        connection.close()
+
+
+def publish_recipe(recipe_id, author_id, created_at):
+    # Вызывается после коммита. Рецепты больших авторов в ленты не
+    # раскладываются, они подмешиваются при чтении в feed_recipes.
+    # Рассылка в одну пачку делается сразу, большая уходит в фоновый
+    # поток, чтобы не задерживать ответ автору
+    count = subscribers_count(author_id)
+    if count > settings.FEED_FANOUT_LIMIT:
+        return
+    if count <= settings.FEED_BATCH_SIZE:
+        fan_out_recipe(recipe_id, author_id, created_at)
+    else:
+        executor.submit(_fan_out_in_thread, recipe_id, author_id,
+                        created_at)
+
+
+def backfill_subscription(subscriber_id, author_id):
+    if is_large_author(author_id):
+        return
+    recipes = Recipe.objects.filter(author=author_id).values_list(
+        'id', 'created_at'
+    )[:settings.FEED_BACKFILL_SIZE]
+    insert_entries(FeedEntry(user_id=subscriber_id, recipe_id=recipe_id,
+                             created_at=created_at)
+                   for recipe_id, created_at in recipes)
+
+
+def drop_subscription(subscriber_id, author_id):
+    FeedEntry.objects.filter(user=subscriber_id,
+                             recipe__author=author_id).delete()
+
+
+def feed_recipes(user):
+    large_authors = large_author_ids()
+    followed_large = []
+    if large_authors:
+        followed_large = list(Subscription.objects.filter(
+            subscriber=user, author__in=large_authors
+        ).values_list('author_id', flat=True))
+    if not followed_large:
+        # Порядок по полям записи ленты, чтобы читался её индекс
+        return Recipe.objects.filter(feed_entries__user=user).order_by(
+            '-feed_entries__created_at', '-id'
+        )
+    return Recipe.objects.filter(
+        Q(id__in=FeedEntry.objects.filter(user=user).values('recipe_id'))
+        | Q(author__in=followed_large)
+    )
@@ -0,0 +1,103 @@
+import logging
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.utils import timezone
+from PIL import Image, ImageOps
+from recipes.cache import bump_recipe_versions
+from recipes.models import Recipe
+
+
+logger = logging.getLogger(__name__)
+
+# Поле рецепта с уменьшенной копией и её наибольшая сторона
+RENDITIONS = {
+    'image_small': settings.RECIPE_IMAGE_SMALL_SIZE,
+    'image_large': settings.RECIPE_IMAGE_LARGE_SIZE,
+}
+
+executor = ThreadPoolExecutor(
+    max_workers=settings.IMAGE_PROCESSING_WORKERS,
+    thread_name_prefix='recipe-images'
+)
+
+
+def encode(image, max_side=None):
+    image = ImageOps.exif_transpose(image)
+    if max_side:
+        image.thumbnail((max_side, max_side))
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+    buffer = BytesIO()
+    image.save(buffer, format=settings.RECIPE_IMAGE_FORMAT,
+               quality=settings.RECIPE_IMAGE_QUALITY)
+    extension = settings.RECIPE_IMAGE_FORMAT.lower()
+    return ContentFile(buffer.getvalue(), name=f'{uuid.uuid4()}.{extension}')
+
+
+def reencode(file):
+    # Оригинал пересохраняется в компактном формате
+    # с ограничением наибольшей стороны
+    file.seek(0)
+    with Image.open(file) as image:
+        return encode(image, settings.RECIPE_IMAGE_MAX_SIDE)
+
+
+def make_renditions(recipe_id):
+    recipe = Recipe.objects.filter(pk=recipe_id).only('image').first()
+    if recipe is None or not recipe.image:
+        return
+    original = recipe.image.name
+    files = {}
+    with recipe.image.open('rb') as file, Image.open(file) as image:
+        image.load()
+        for field, max_side in RENDITIONS.items():
+            rendition = encode(image, max_side)
+            upload_to = Recipe._meta.get_field(field).upload_to
+            files[field] = default_storage.save(
+                os.path.join(upload_to, rendition.name), rendition
+            )
+    # Если пока считались копии, картинку заменили, результат не нужен
+    updated = Recipe.objects.filter(pk=recipe_id, image=original).update(
+        updated_at=timezone.now(), **files
+    )
+    if updated:
+        bump_recipe_versions((recipe_id,))
+    else:
+        for name in files.values():
+            default_storage.delete(name)
+
+
+def _run(recipe_id):
+    try:
+        make_renditions(recipe_id)
+    except Exception:
+        logger.exception('Не удалось подготовить копии изображения '
+                         'рецепта %s', recipe_id)
+    finally:
+        connection.close()
+
+
+def schedule_renditions(recipe_id):
+    # Копии считаются в фоновом потоке после фиксации транзакции;
+    # пока их нет, API отдаёт оригинал
+    transaction.on_commit(lambda: executor.submit(_run, recipe_id))
+
+
+def replace_renditions(recipe_id, stale):
+    # Картинку заменили: старые копии сразу перестают отдаваться,
+    # их файлы удаляются после фиксации транзакции
+    Recipe.objects.filter(pk=recipe_id).update(
+        **{field: '' for field in RENDITIONS}
+    )
+    stale = [name for name in stale if name]
+    if stale:
+        transaction.on_commit(
+            lambda: [default_storage.delete(name) for name in stale]
+        )
+    schedule_renditions(recipe_id)
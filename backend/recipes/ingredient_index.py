@@ -0,0 +1,46 @@
+import hashlib
+from bisect import bisect_left
+from rest_framework.renderers import JSONRenderer
+from recipes.cache import VersionedIndex
+from recipes.models import Ingredient
+
+
+class IngredientIndex(VersionedIndex):
+    # Отсортированный по name.casefold() список продуктов в памяти
+    # процесса. Поиск по префиксу — два бинарных поиска, без базы
+    version_key = 'ingredient_index_version'
+    refresh_setting = 'INGREDIENT_INDEX_REFRESH'
+    ttl_setting = 'INGREDIENT_INDEX_TTL'
+
+    def __init__(self):
+        super().__init__()
+        # Ключи, продукты, готовый JSON и его ETag публикуются одним
+        # присваиванием, чтобы читатели без блокировки не смешали
+        # данные двух сборок
+        self.snapshot = ([], [], b'[]', '')
+
+    def _build(self):
+        items = sorted(
+            ({'id': pk, 'name': name, 'measurement_unit': unit}
+             for pk, name, unit in Ingredient.objects.values_list(
+                 'id', 'name', 'measurement_unit').iterator()),
+            key=lambda item: (item['name'].casefold(), item['id'])
+        )
+        payload = JSONRenderer().render(items)
+        self.snapshot = ([item['name'].casefold() for item in items], items,
+                         payload, f'"{hashlib.md5(payload).hexdigest()}"')
+
+    def search(self, prefix):
+        self.ensure_fresh()
+        return self.lookup(prefix)
+
+    def lookup(self, prefix):
+        # Поиск без проверки свежести, ensure_fresh вызывается отдельно
+        prefix = prefix.casefold()
+        keys, items, _, _ = self.snapshot
+        start = bisect_left(keys, prefix)
+        end = bisect_left(keys, prefix + '\U0010ffff', start)
+        return items[start:end]
+
+
+ingredient_index = IngredientIndex()
@@ -0,0 +1,175 @@
+import json
+import platform
+import time
+import tracemalloc
+from urllib.parse import quote
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client, override_settings
+from rest_framework.authtoken.models import Token
+from api.urls import router
+from recipes.benchmarks import latency_summary
+from recipes.models import CustomUser, Ingredient, Recipe
+
+
+# Параметры запроса для списков, как их передаёт фронтенд
+QUERY_STRINGS = {
+    'RecipeViewSet.list': '?limit=6',
+    'RecipeViewSet.feed': '?limit=6',
+    'UserViewSet.list': '?limit=6',
+    'UserViewSet.subscriptions': '?limit=6&recipes_limit=3',
+}
+MEMORY_ITERATIONS = 5
+
+
+class Command(BaseCommand):
+    help = ('Замер GET-адресов api.urls внутри процесса для анонимного '
+            'и авторизованного пользователя: перцентили задержки, '
+            'пропускная способность, число запросов к базе и пик памяти. '
+            'Сравнение с сохранённым базовым результатом')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=200)
+        parser.add_argument('--warmup', type=int, default=10)
+        parser.add_argument('--output', help='Файл для результатов в JSON')
+        parser.add_argument('--baseline',
+                            help='JSON прошлого запуска для сравнения')
+        parser.add_argument('--max-latency-regression', type=float,
+                            default=0.2,
+                            help='Допустимый рост p95, доля')
+        parser.add_argument('--max-throughput-regression', type=float,
+                            default=0.2,
+                            help='Допустимое падение rps, доля')
+        parser.add_argument('--max-query-increase', type=int, default=0)
+
+    def get_fixtures(self):
+        # Пользователь с подписками и корзиной, чтобы авторизованные
+        # адреса отдавали непустые данные
+        user = CustomUser.objects.order_by('-subscriptions_count',
+                                           'id').first()
+        recipe = Recipe.objects.order_by('-favorites_count', 'id').first()
+        ingredient = Ingredient.objects.order_by('id').first()
+        if user is None or recipe is None or ingredient is None:
+            raise CommandError('База пуста, сначала выполните '
+                               'load_ingredients и generate_dataset')
+        return user, {
+            'pk': recipe.id,
+            'id': recipe.author_id,
+            'ingredient': ingredient.id,
+            'name': quote(ingredient.name[:2]),
+        }
+
+    def get_routes(self, values):
+        routes = {}
+        for pattern in router.urls:
+            action = pattern.callback.actions.get('get')
+            if action is None:
+                continue
+            tag = f'{pattern.callback.cls.__name__}.{action}'
+            path = '/api/' + str(pattern.pattern).strip('^$')
+            for name in pattern.pattern.regex.groupindex:
+                value = (values['ingredient']
+                         if tag.startswith('Ingredient') else values[name])
+                path = path.replace(f'(?P<{name}>[^/.]+)', str(value))
+            if tag == 'IngredientViewSet.list':
+                path += f'?name={values["name"]}'
+            routes[tag] = path + QUERY_STRINGS.get(tag, '')
+        return routes
+
+    def request(self, client, path):
+        response = client.get(path)
+        if response.streaming:
+            b''.join(response.streaming_content)
+        return response
+
+    def measure(self, client, path, options):
+        for _ in range(options['warmup']):
+            self.request(client, path)
+        latencies = []
+        started = time.perf_counter()
+        for _ in range(options['iterations']):
+            request_started = time.perf_counter()
+            response = self.request(client, path)
+            latencies.append(time.perf_counter() - request_started)
+        elapsed = time.perf_counter() - started
+
+        # Память меряется отдельным проходом: tracemalloc замедляет
+        # выполнение и исказил бы задержки
+        tracemalloc.start()
+        try:
+            base = tracemalloc.get_traced_memory()[0]
+            for _ in range(MEMORY_ITERATIONS):
+                self.request(client, path)
+            peak = tracemalloc.get_traced_memory()[1] - base
+        finally:
+            tracemalloc.stop()
+        return {
+            'status': response.status_code,
+            **latency_summary(latencies),
+            'rps': round(options['iterations'] / elapsed, 1),
+            'queries': response.query_stats.count,
+            'peak_memory_kb': round(peak / 1024, 1),
+        }
+
+    def compare(self, results, baseline, options):
+        regressions = []
+        for key, result in results.items():
+            old = baseline.get(key)
+            if old is None:
+                continue
+            checks = (
+                ('p95_ms', result['p95_ms']
+                 > old['p95_ms'] * (1 + options['max_latency_regression'])),
+                ('rps', result['rps']
+                 < old['rps'] * (1 - options['max_throughput_regression'])),
+                ('queries', result['queries']
+                 > old['queries'] + options['max_query_increase']),
+            )
+            regressions.extend(
+                f'{key}: {metric} {old[metric]} -> {result[metric]}'
+                for metric, failed in checks if failed
+            )
+        return regressions
+
+    def handle(self, *args, **options):
+        user, values = self.get_fixtures()
+        routes = self.get_routes(values)
+        token, _ = Token.objects.get_or_create(user=user)
+        clients = {
+            'anonymous': Client(),
+            'authenticated': Client(HTTP_AUTHORIZATION=f'Token {token.key}'),
+        }
+        results = {}
+        with override_settings(ALLOWED_HOSTS=['testserver']):
+            for role, client in clients.items():
+                for tag, path in routes.items():
+                    if self.request(client, path).status_code in (401, 403):
+                        continue
+                    result = self.measure(client, path, options)
+                    results[f'{role} {tag}'] = {'path': path, **result}
+                    self.stdout.write(
+                        f'{role:13} {tag:28} {result["status"]} '
+                        f'p50 {result["p50_ms"]:>7} p95 {result["p95_ms"]:>7} '
+                        f'p99 {result["p99_ms"]:>7} мс, '
+                        f'{result["rps"]:>7} rps, '
+                        f'{result["queries"]:>2} запр., '
+                        f'{result["peak_memory_kb"]:>8} КБ'
+                    )
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as file:
+                json.dump({
+                    'python': platform.python_version(),
+                    'iterations': options['iterations'],
+                    'results': results,
+                }, file, ensure_ascii=False, indent=2)
+
+        if options['baseline']:
+            with open(options['baseline'], encoding='utf-8') as file:
+                baseline = json.load(file)['results']
+            regressions = self.compare(results, baseline, options)
+            if regressions:
+                raise CommandError('Ухудшения относительно базового '
+                                   'результата:\n' + '\n'.join(regressions))
+            self.stdout.write(self.style.SUCCESS(
+                'Ухудшений относительно базового результата нет'
+            ))
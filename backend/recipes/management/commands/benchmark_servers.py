@@ -0,0 +1,149 @@
+import http.client
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from recipes.benchmarks import latency_summary
+from recipes.models import Ingredient, Recipe
+from recipes.short_links import encode
+
+
+SERVERS = {
+    'wsgi': ('foodgram_backend.wsgi:application',),
+    'asgi': ('foodgram_backend.asgi:application',
+             '--worker-class', 'uvicorn.workers.UvicornWorker'),
+}
+STARTUP_TIMEOUT = 30
+
+
+class Command(BaseCommand):
+    help = ('Сравнение пропускной способности и задержек WSGI и ASGI '
+            'на коротких ссылках, поиске продуктов и просмотре рецепта. '
+            'Серверы gunicorn запускаются на текущей базе данных')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--modes', nargs='+', choices=SERVERS,
+                            default=list(SERVERS))
+        parser.add_argument('--concurrency', nargs='+', type=int,
+                            default=[1, 8, 32, 64])
+        parser.add_argument('--requests', type=int, default=1000,
+                            help='Запросов на адрес и уровень параллельности')
+        parser.add_argument('--workers', type=int, default=2)
+        parser.add_argument('--port', type=int, default=8100)
+        parser.add_argument('--output', help='Файл для результатов в JSON')
+
+    def get_paths(self):
+        recipe_id = Recipe.objects.values_list('id', flat=True).first()
+        name = Ingredient.objects.values_list('name', flat=True).first()
+        if recipe_id is None or name is None:
+            raise CommandError('Для замера нужны хотя бы один рецепт '
+                               'и один продукт в базе')
+        return {
+            'short-link': f'/r/{encode(recipe_id)}/',
+            'ingredients': f'/api/ingredients/?name={quote(name[:2])}',
+            'recipe': f'/api/recipes/{recipe_id}/',
+        }
+
+    def start_server(self, mode, port, workers):
+        server = subprocess.Popen(
+            (sys.executable, '-m', 'gunicorn', *SERVERS[mode],
+             '--bind', f'127.0.0.1:{port}', '--workers', str(workers),
+             '--log-level', 'warning'),
+            cwd=settings.BASE_DIR, env=os.environ.copy()
+        )
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise CommandError(f'Сервер {mode} не запустился')
+            try:
+                connection = http.client.HTTPConnection('127.0.0.1', port)
+                connection.request('GET', '/api/ingredients/')
+                connection.getresponse().read()
+                return server
+            except OSError:
+                time.sleep(0.2)
+        server.terminate()
+        raise CommandError(f'Сервер {mode} не ответил за '
+                           f'{STARTUP_TIMEOUT} с')
+
+    def run_load(self, port, path, concurrency, total):
+        # У каждого потока своё keep-alive соединение, потоки забирают
+        # запросы из общего счётчика, пока не наберётся total
+        remaining = iter(range(total))
+        lock = threading.Lock()
+        latencies, errors = [], 0
+
+        def worker():
+            nonlocal errors
+            connection = http.client.HTTPConnection('127.0.0.1', port)
+            local = []
+            while True:
+                with lock:
+                    if next(remaining, None) is None:
+                        break
+                started = time.perf_counter()
+                try:
+                    connection.request('GET', path)
+                    response = connection.getresponse()
+                    response.read()
+                    failed = response.status >= 400
+                except (OSError, http.client.HTTPException):
+                    connection.close()
+                    failed = True
+                local.append(time.perf_counter() - started)
+                if failed:
+                    with lock:
+                        errors += 1
+            with lock:
+                latencies.extend(local)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            for _ in range(concurrency):
+                executor.submit(worker)
+        elapsed = time.perf_counter() - started
+        return {
+            'rps': round(total / elapsed, 1),
+            **latency_summary(latencies),
+            'errors': errors,
+        }
+
+    def handle(self, *args, **options):
+        paths = self.get_paths()
+        results = []
+        self.stdout.write(f'{"режим":6} {"адрес":12} {"пар.":>5} '
+                          f'{"rps":>9} {"p50":>8} {"p95":>8} {"p99":>8} '
+                          f'{"ошибки":>7}')
+        for mode in options['modes']:
+            server = self.start_server(mode, options['port'],
+                                       options['workers'])
+            try:
+                for name, path in paths.items():
+                    # Прогрев: кэши и индексы в каждом воркере
+                    self.run_load(options['port'], path, options['workers'],
+                                  options['workers'] * 20)
+                    for concurrency in options['concurrency']:
+                        result = self.run_load(options['port'], path,
+                                               concurrency,
+                                               options['requests'])
+                        results.append({'mode': mode, 'endpoint': name,
+                                        'concurrency': concurrency,
+                                        **result})
+                        self.stdout.write(
+                            f'{mode:6} {name:12} {concurrency:>5} '
+                            f'{result["rps"]:>9} {result["p50_ms"]:>8} '
+                            f'{result["p95_ms"]:>8} {result["p99_ms"]:>8} '
+                            f'{result["errors"]:>7}'
+                        )
+            finally:
+                server.terminate()
+                server.wait()
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as file:
+                json.dump(results, file, ensure_ascii=False, indent=2)
@@ -0,0 +1,269 @@
+import random
+from bisect import insort
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import timedelta
+from io import BytesIO
+from itertools import accumulate, islice
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+from PIL import Image
+from recipes.cache import RECIPES_LIST_VERSION_KEY, bump_version
+from recipes.models import (CustomUser, FeedEntry, Favorite, Ingredient,
+                            Recipe, RecipeIngredient, ShoppingCart,
+                            Subscription)
+from recipes.recipe_index import recipe_ingredient_index
+from recipes.search import update_search_vectors
+from recipes.short_links import recipe_ids as short_link_ids
+
+
+PLACEHOLDER_IMAGE = 'recipes/images/placeholder.png'
+PLACEHOLDER_SIZE = (600, 400)
+PASSWORD = 'password'
+
+
+def zipf_weights(count, skew):
+    return list(accumulate(1 / rank ** skew for rank in range(1, count + 1)))
+
+
+def ensure_placeholder():
+    # Картинка общая для всех рецептов и создаётся в хранилище при
+    # первом запуске: медиафайлы живут в томе, а не в репозитории
+    if default_storage.exists(PLACEHOLDER_IMAGE):
+        return
+    buffer = BytesIO()
+    Image.new('RGB', PLACEHOLDER_SIZE, 'lightgray').save(buffer, format='PNG')
+    default_storage.save(PLACEHOLDER_IMAGE, ContentFile(buffer.getvalue()))
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+@contextmanager
+def manual_timestamps(model, *names):
+    # Даты публикации раскладываются по прошлому, поэтому auto_now
+    # и auto_now_add на время вставки отключаются
+    fields = [model._meta.get_field(name) for name in names]
+    saved = [(field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, (auto_now, auto_now_add) in zip(fields, saved):
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+class Command(BaseCommand):
+    help = ('Генерация воспроизводимого набора данных для нагрузочного '
+            'тестирования: пользователи, рецепты из каталога продуктов, '
+            'избранное, корзины и подписки со степенным распределением')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--recipes', type=int, default=5000)
+        parser.add_argument('--favorites', type=int, default=20000)
+        parser.add_argument('--cart', type=int, default=5000)
+        parser.add_argument('--subscriptions', type=int, default=10000)
+        parser.add_argument('--min-ingredients', type=int, default=3)
+        parser.add_argument('--max-ingredients', type=int, default=12)
+        parser.add_argument('--skew', type=float, default=1.1,
+                            help='Показатель степенного распределения')
+        parser.add_argument('--days', type=int, default=365,
+                            help='За сколько дней распределить рецепты')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def insert(self, model, objects):
+        # Django 3.2 не возвращает id из bulk_create на SQLite, поэтому
+        # id новых строк читаются обратно; команда рассчитана на то,
+        # что одновременно в таблицу никто не пишет
+        last_id = model.objects.aggregate(last=Max('id'))['last'] or 0
+        model.objects.bulk_create(objects, batch_size=self.batch_size)
+        return list(model.objects.filter(id__gt=last_id).order_by('id')
+                    .values_list('id', flat=True))
+
+    def insert_pairs(self, model, pairs, fields):
+        for batch in batches(pairs, self.batch_size):
+            model.objects.bulk_create(
+                (model(**dict(zip(fields, pair))) for pair in batch),
+                batch_size=self.batch_size
+            )
+
+    def skewed_pairs(self, count, left, right, right_weights,
+                     distinct=False):
+        # Левая сторона выбирается равномерно, правая — по степенному
+        # закону. Повторы отбрасываются, при distinct — и пары вида (x, x)
+        pairs = set()
+        attempts = 0
+        while len(pairs) < count and attempts < count * 10:
+            needed = count - len(pairs)
+            attempts += needed
+            for first, second in zip(
+                    self.rng.choices(left, k=needed),
+                    self.rng.choices(right, cum_weights=right_weights,
+                                     k=needed)):
+                if not distinct or first != second:
+                    pairs.add((first, second))
+        return sorted(pairs)
+
+    def create_users(self, count):
+        prefix = f'load{self.seed}_'
+        if CustomUser.objects.filter(username__startswith=prefix).exists():
+            raise CommandError(f'Пользователи с префиксом {prefix} уже есть, '
+                               f'выберите другой --seed')
+        password = make_password(PASSWORD)
+        return self.insert(CustomUser, (
+            CustomUser(username=f'{prefix}{number}',
+                       email=f'{prefix}{number}@example.com',
+                       first_name='Тест', last_name=f'Пользователь {number}',
+                       password=password)
+            for number in range(count)
+        ))
+
+    def create_recipes(self, count, user_ids, options):
+        catalog = list(Ingredient.objects.order_by('id')
+                       .values_list('id', 'name'))
+        if not catalog:
+            raise CommandError('Каталог продуктов пуст, сначала выполните '
+                               'load_ingredients')
+        # Популярные продукты и авторы встречаются чаще остальных
+        self.rng.shuffle(catalog)
+        catalog_weights = zipf_weights(len(catalog), options['skew'])
+        authors = user_ids[:]
+        self.rng.shuffle(authors)
+        author_weights = zipf_weights(len(authors), options['skew'])
+        max_ingredients = min(options['max_ingredients'], len(catalog))
+        min_ingredients = min(options['min_ingredients'], max_ingredients)
+
+        now = timezone.now()
+        ages = sorted((self.rng.random() * options['days']
+                       for _ in range(count)), reverse=True)
+        recipes_by_author = defaultdict(list)
+        all_ids = []
+        for batch in batches(ages, self.batch_size):
+            recipes, ingredients = [], []
+            for age in batch:
+                size = self.rng.randint(min_ingredients, max_ingredients)
+                chosen = {}
+                while len(chosen) < size:
+                    pk, name = self.rng.choices(
+                        catalog, cum_weights=catalog_weights
+                    )[0]
+                    chosen[pk] = name
+                names = list(chosen.values())
+                created_at = now - timedelta(days=age)
+                recipes.append(Recipe(
+                    author_id=self.rng.choices(
+                        authors, cum_weights=author_weights
+                    )[0],
+                    name=f'{names[0].capitalize()} по-домашнему',
+                    image=PLACEHOLDER_IMAGE,
+                    text='Понадобится: ' + ', '.join(names) + '.',
+                    cooking_time=self.rng.randint(5, 180),
+                    created_at=created_at,
+                    updated_at=created_at
+                ))
+                ingredients.append(list(chosen))
+            with manual_timestamps(Recipe, 'created_at', 'updated_at'):
+                ids = self.insert(Recipe, recipes)
+            RecipeIngredient.objects.bulk_create(
+                (RecipeIngredient(recipe_id=recipe_id, ingredient_id=pk,
+                                  amount=self.rng.randint(1, 500))
+                 for recipe_id, pks in zip(ids, ingredients) for pk in pks),
+                batch_size=self.batch_size
+            )
+            update_search_vectors(Recipe.objects.filter(id__in=ids))
+            for recipe_id, recipe in zip(ids, recipes):
+                insort(recipes_by_author[recipe.author_id],
+                       (recipe.created_at, recipe_id))
+            all_ids.extend(ids)
+        return all_ids, recipes_by_author
+
+    def create_feeds(self, subscriptions, recipes_by_author):
+        # То же, что backfill_subscription при подписке, но без запроса
+        # к базе на каждую подписку
+        subscribers = Counter(author for _, author in subscriptions)
+        entries = (
+            FeedEntry(user_id=subscriber, recipe_id=recipe_id,
+                      created_at=created_at)
+            for subscriber, author in subscriptions
+            if subscribers[author] <= settings.FEED_FANOUT_LIMIT
+            for created_at, recipe_id in
+            recipes_by_author[author][-settings.FEED_BACKFILL_SIZE:]
+        )
+        for batch in batches(entries, self.batch_size):
+            FeedEntry.objects.bulk_create(batch, ignore_conflicts=True)
+
+    def handle(self, *args, **options):
+        self.seed = options['seed']
+        self.rng = random.Random(self.seed)
+        self.batch_size = options['batch_size']
+
+        ensure_placeholder()
+        with transaction.atomic():
+            user_ids = self.create_users(options['users'])
+            recipe_ids, recipes_by_author = self.create_recipes(
+                options['recipes'], user_ids, options
+            )
+            popular_recipes = recipe_ids[:]
+            self.rng.shuffle(popular_recipes)
+            recipe_weights = zipf_weights(len(popular_recipes),
+                                          options['skew'])
+            # Рецепт добавляют в избранное и корзину в случайный
+            # момент после публикации
+            published = {recipe_id: created_at
+                         for recipes in recipes_by_author.values()
+                         for created_at, recipe_id in recipes}
+            now = timezone.now()
+            for model, count in ((Favorite, options['favorites']),
+                                 (ShoppingCart, options['cart'])):
+                pairs = self.skewed_pairs(count, user_ids, popular_recipes,
+                                          recipe_weights)
+                with manual_timestamps(model, 'created_at'):
+                    self.insert_pairs(
+                        model,
+                        ((user_id, recipe_id, published[recipe_id]
+                          + (now - published[recipe_id]) * self.rng.random())
+                         for user_id, recipe_id in pairs),
+                        ('user_id', 'recipe_id', 'created_at')
+                    )
+            popular_authors = user_ids[:]
+            self.rng.shuffle(popular_authors)
+            subscriptions = self.skewed_pairs(
+                options['subscriptions'], user_ids, popular_authors,
+                zipf_weights(len(popular_authors), options['skew']),
+                distinct=True
+            )
+            self.insert_pairs(Subscription, subscriptions,
+                              ('subscriber_id', 'author_id'))
+            self.create_feeds(subscriptions, recipes_by_author)
+
+        # bulk_create обходит сигналы: счётчики, списки покупок
+        # и популярность пересчитываются, индексы в памяти и кэш
+        # ответов сбрасываются
+        call_command('recount_counters', batch_size=self.batch_size,
+                     stdout=self.stdout)
+        call_command('rebuild_shopping_lists', batch_size=self.batch_size,
+                     stdout=self.stdout)
+        call_command('refresh_popularity', full=True,
+                     batch_size=self.batch_size, stdout=self.stdout)
+        recipe_ingredient_index.invalidate()
+        short_link_ids.invalidate()
+        bump_version(RECIPES_LIST_VERSION_KEY)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Создано пользователей: {len(user_ids)}, рецептов: '
+            f'{len(recipe_ids)}, подписок: {len(subscriptions)}. '
+            f'Пароль пользователей: {PASSWORD}'
+        ))
@@ -1,23 +1,145 @@
+import csv
 import json
+from pathlib import Path
 from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.functions import Lower
+from recipes.ingredient_index import ingredient_index
 from recipes.models import Ingredient
 
 
+READ_CHUNK_SIZE = 64 * 1024
+
+
+def normalize(value):
+    return ' '.join(str(value).split())
+
+
+def read_csv(file):
+    for row in csv.reader(file):
+        if not row:
+            continue
+        if len(row) != 2:
+            raise CommandError(f'Ожидалось 2 поля в строке: {row}')
+        yield row
+
+
+def read_json(file):
+    # Массив объектов читается по частям: каждый объект разбирается
+    # raw_decode, как только целиком оказался в буфере
+    decoder = json.JSONDecoder()
+    buffer = ''
+    started = False
+    while True:
+        chunk = file.read(READ_CHUNK_SIZE)
+        buffer += chunk
+        while True:
+            buffer = buffer.lstrip()
+            if not started:
+                if not buffer:
+                    break
+                if buffer[0] != '[':
+                    raise CommandError('Ожидался JSON-массив продуктов')
+                buffer = buffer[1:]
+                started = True
+                continue
+            if buffer[:1] == ']':
+                return
+            if buffer[:1] == ',':
+                buffer = buffer[1:]
+                continue
+            if not buffer:
+                break
+            try:
+                item, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                if not chunk:
+                    raise CommandError('Некорректный JSON')
+                break
+            buffer = buffer[end:]
+            # Объект без нужных ключей попадает в пропущенные
+            if not isinstance(item, dict):
+                item = {}
+            yield item.get('name') or '', item.get('measurement_unit') or ''
+        if not chunk:
+            raise CommandError('Некорректный JSON')
+
+
+READERS = {
+    'csv': read_csv,
+    'json': read_json,
+}
+
+
 class Command(BaseCommand):
-    help = 'Импорт ингредиентов из файла ingredients.json'
+    help = ('Импорт и обновление продуктов из CSV (название, единица) '
+            'или JSON-массива')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default='ingredients.json')
+        parser.add_argument('--format', choices=READERS)
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def load_batch(self, batch):
+        # Названия сравниваются без учёта регистра, сохранённые
+        # не переписываются. LOWER выбирает кандидатов (в SQLite он
+        # понижает только латиницу), окончательно сверяет casefold
+        names = [name for name, _ in batch.values()]
+        existing = {
+            ingredient.name.casefold(): ingredient
+            for ingredient in Ingredient.objects.annotate(
+                lowered=Lower('name')
+            ).filter(Q(lowered__in=[name.lower() for name in names])
+                     | Q(name__in=names))
+        }
+        new, changed = [], []
+        for key, (name, unit) in batch.items():
+            ingredient = existing.get(key)
+            if ingredient is None:
+                new.append(Ingredient(name=name, measurement_unit=unit))
+            elif ingredient.measurement_unit != unit:
+                ingredient.measurement_unit = unit
+                changed.append(ingredient)
+        with transaction.atomic():
+            Ingredient.objects.bulk_create(new)
+            Ingredient.objects.bulk_update(changed, ('measurement_unit',))
+        self.inserted += len(new)
+        self.updated += len(changed)
+        self.skipped += len(batch) - len(new) - len(changed)
 
     def handle(self, *args, **options):
+        path = Path(options['path'])
+        file_format = options['format'] or path.suffix.lstrip('.').lower()
+        if file_format not in READERS:
+            raise CommandError(f'Неизвестный формат файла: {path}')
+
+        self.inserted = self.updated = self.skipped = 0
         try:
-            with open('ingredients.json', 'r', encoding='utf-8') as file:
-                data = json.load(file)
+            with open(path, encoding='utf-8', newline='') as file:
+                # Повторы внутри пачки схлопываются, побеждает последний,
+                # а предыдущие считаются пропущенными
+                batch = {}
+                for name, unit in READERS[file_format](file):
+                    name, unit = normalize(name), normalize(unit)
+                    if not name or not unit:
+                        self.skipped += 1
+                        continue
+                    key = name.casefold()
+                    if key in batch:
+                        self.skipped += 1
+                    batch[key] = name, unit
+                    if len(batch) >= options['batch_size']:
+                        self.load_batch(batch)
+                        batch = {}
+                if batch:
+                    self.load_batch(batch)
         except FileNotFoundError:
-            raise CommandError('Файл ingredients.json не найден')
-
-        new_ingredients = [Ingredient(**ingredient) for ingredient in data]
-
-        before = Ingredient.objects.count()
-        Ingredient.objects.bulk_create(new_ingredients, ignore_conflicts=True)
-        after = Ingredient.objects.count()
+            raise CommandError(f'Файл {path} не найден')
+        finally:
+            ingredient_index.invalidate()
 
-        self.stdout.write(self.style.SUCCESS(f'Импортировано {after - before} '
-                                             f'ингредиентов'))
+        self.stdout.write(self.style.SUCCESS(
+            f'Добавлено {self.inserted}, обновлено {self.updated}, '
+            f'пропущено {self.skipped} продуктов'
+        ))
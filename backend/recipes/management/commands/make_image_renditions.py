@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from recipes.images import make_renditions
+from recipes.models import Recipe
+
+
+class Command(BaseCommand):
+    help = 'Создание уменьшенных копий изображений рецептов, где их нет'
+
+    def handle(self, *args, **options):
+        recipe_ids = list(Recipe.objects
+                          .filter(Q(image_small='') | Q(image_large=''))
+                          .values_list('id', flat=True))
+        processed = 0
+        for recipe_id in recipe_ids:
+            try:
+                make_renditions(recipe_id)
+            except OSError as error:
+                self.stderr.write(f'Рецепт {recipe_id}: {error}')
+                continue
+            processed += 1
+        self.stdout.write(self.style.SUCCESS(
+            f'Обработано рецептов: {processed}'
+        ))
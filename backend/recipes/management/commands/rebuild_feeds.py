@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from recipes.feeds import backfill_subscription
+from recipes.models import FeedEntry, Subscription
+
+
+class Command(BaseCommand):
+    help = ('Перестроение лент подписок, например после изменения '
+            'FEED_FANOUT_LIMIT')
+
+    def handle(self, *args, **options):
+        subscriptions = Subscription.objects.order_by(
+            'subscriber'
+        ).values_list('subscriber_id', 'author_id')
+        count = 0
+        with transaction.atomic():
+            FeedEntry.objects.all().delete()
+            for subscriber_id, author_id in subscriptions.iterator():
+                backfill_subscription(subscriber_id, author_id)
+                count += 1
+        self.stdout.write(self.style.SUCCESS(
+            f'Ленты перестроены для {count} подписок'
+        ))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from recipes.models import CustomUser
+from recipes.shopping_lists import rebuild
+
+
+class Command(BaseCommand):
+    help = ('Сверка списков покупок с корзинами и пересборка '
+            'разошедшихся списков')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        fixed = 0
+        last_pk = 0
+        while True:
+            batch = list(CustomUser.objects.filter(pk__gt=last_pk)
+                         .order_by('pk')
+                         .values_list('pk', flat=True)[:options['batch_size']])
+            if not batch:
+                break
+            last_pk = batch[-1]
+            with transaction.atomic():
+                fixed += rebuild(batch)
+        self.stdout.write(self.style.SUCCESS(
+            f'Списков покупок исправлено: {fixed}'
+        ))
@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from recipes.models import CustomUser, Favorite, Recipe, Subscription
+
+
+# Модель со счётчиком, поле счётчика, модель строк и её ссылка на владельца
+COUNTERS = (
+    (Recipe, 'favorites_count', Favorite, 'recipe'),
+    (CustomUser, 'recipes_count', Recipe, 'author'),
+    (CustomUser, 'subscriptions_count', Subscription, 'subscriber'),
+    (CustomUser, 'subscribers_count', Subscription, 'author'),
+)
+
+
+def count_subquery(model, field):
+    return Coalesce(
+        Subquery(model.objects.filter(**{field: OuterRef('pk')})
+                 .order_by().values(field)
+                 .annotate(count=Count('pk')).values('count')),
+        0
+    )
+
+
+class Command(BaseCommand):
+    help = 'Пересчёт сохранённых счётчиков избранного, рецептов и подписок'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def recount(self, model, field, rows_model, rows_field, batch_size):
+        fixed = 0
+        last_pk = 0
+        while True:
+            batch = list(model.objects.filter(pk__gt=last_pk).order_by('pk')
+                         .values_list('pk', flat=True)[:batch_size])
+            if not batch:
+                return fixed
+            last_pk = batch[-1]
+            actual = count_subquery(rows_model, rows_field)
+            with transaction.atomic():
+                drifted = list(model.objects.filter(pk__in=batch)
+                               .annotate(actual=actual)
+                               .exclude(**{field: F('actual')})
+                               .values_list('pk', flat=True))
+                if drifted:
+                    model.objects.filter(pk__in=drifted).update(
+                        **{field: actual}
+                    )
+            fixed += len(drifted)
+
+    def handle(self, *args, **options):
+        for model, field, rows_model, rows_field in COUNTERS:
+            fixed = self.recount(model, field, rows_model, rows_field,
+                                 options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(
+                f'{model._meta.verbose_name_plural}.{field}: '
+                f'исправлено {fixed}'
+            ))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from recipes.popularity import refresh
+
+
+class Command(BaseCommand):
+    help = ('Обновление почасовых сводок добавлений в избранное и корзину '
+            'и популярности рецептов за день, неделю и всё время. '
+            'Рассчитана на запуск по расписанию')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true',
+                            help='Собрать все сводки заново')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        written, recipes = refresh(options['full'], options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Сводок записано: {written}, рецептов пересчитано: {recipes}'
+        ))
@@ -0,0 +1,20 @@
+# Generated by Django 3.2.3 on 2026-10-18 18:45
+
+from django.db import migrations
+import recipes.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0003_auto_20250627_1420'),
+    ]
+
+    operations = [
+        migrations.AlterModelManagers(
+            name='customuser',
+            managers=[
+                ('objects', recipes.models.CustomUserManager()),
+            ],
+        ),
+    ]
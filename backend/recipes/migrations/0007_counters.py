@@ -0,0 +1,58 @@
+# Generated by Django 3.2.3 on 2026-10-18 18:52
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_subquery(model, field):
+    return Coalesce(
+        Subquery(model.objects.filter(**{field: OuterRef('pk')})
+                 .order_by().values(field)
+                 .annotate(count=Count('pk')).values('count')),
+        0
+    )
+
+
+def fill_counters(apps, schema_editor):
+    CustomUser = apps.get_model('recipes', 'CustomUser')
+    Recipe = apps.get_model('recipes', 'Recipe')
+    Favorite = apps.get_model('recipes', 'Favorite')
+    Subscription = apps.get_model('recipes', 'Subscription')
+    Recipe.objects.update(favorites_count=count_subquery(Favorite, 'recipe'))
+    CustomUser.objects.update(
+        recipes_count=count_subquery(Recipe, 'author'),
+        subscriptions_count=count_subquery(Subscription, 'subscriber'),
+        subscribers_count=count_subquery(Subscription, 'author')
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0006_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='recipes_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Рецептов'),
+        ),
+        migrations.AddField(
+            model_name='customuser',
+            name='subscribers_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Подписчиков'),
+        ),
+        migrations.AddField(
+            model_name='customuser',
+            name='subscriptions_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Подписок'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='favorites_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='В избранном'),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
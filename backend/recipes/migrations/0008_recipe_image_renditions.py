@@ -0,0 +1,23 @@
+# Generated by Django 3.2.3 on 2026-10-18 18:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0007_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='image_large',
+            field=models.ImageField(blank=True, editable=False, upload_to='recipes/images/large/', verbose_name='Изображение для страницы рецепта'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='image_small',
+            field=models.ImageField(blank=True, editable=False, upload_to='recipes/images/small/', verbose_name='Изображение для списка'),
+        ),
+    ]
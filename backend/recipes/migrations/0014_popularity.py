@@ -0,0 +1,88 @@
+# Generated by Django 3.2.3 on 2026-10-18 19:26
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0013_shopping_list_items'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PopularityBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField(db_index=True, verbose_name='Начало часа')),
+                ('favorites', models.PositiveIntegerField(default=0, verbose_name='В избранное')),
+                ('carts', models.PositiveIntegerField(default=0, verbose_name='В корзину')),
+            ],
+            options={
+                'verbose_name': 'сводка популярности',
+                'verbose_name_plural': 'Сводки популярности',
+                'default_related_name': 'popularity_buckets',
+            },
+        ),
+        # Столбец добавляется без auto_now_add, иначе существующие
+        # связи получили бы дату миграции вместо пустой
+        migrations.AddField(
+            model_name='favorite',
+            name='created_at',
+            field=models.DateTimeField(db_index=True, null=True, verbose_name='Дата добавления'),
+        ),
+        migrations.AlterField(
+            model_name='favorite',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True, null=True, verbose_name='Дата добавления'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='popularity_day',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Популярность за день'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='popularity_total',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Популярность за всё время'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='popularity_week',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Популярность за неделю'),
+        ),
+        # Столбец добавляется без auto_now_add, иначе существующие
+        # связи получили бы дату миграции вместо пустой
+        migrations.AddField(
+            model_name='shoppingcart',
+            name='created_at',
+            field=models.DateTimeField(db_index=True, null=True, verbose_name='Дата добавления'),
+        ),
+        migrations.AlterField(
+            model_name='shoppingcart',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True, null=True, verbose_name='Дата добавления'),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['-popularity_day', '-id'], name='recipe_popularity_day_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['-popularity_week', '-id'], name='recipe_popularity_week_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['-popularity_total', '-id'], name='recipe_popularity_total_idx'),
+        ),
+        migrations.AddField(
+            model_name='popularitybucket',
+            name='recipe',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='popularity_buckets', to='recipes.recipe', verbose_name='Рецепт'),
+        ),
+        migrations.AddConstraint(
+            model_name='popularitybucket',
+            constraint=models.UniqueConstraint(fields=('recipe', 'bucket'), name='unique_recipe_bucket_popularitybucket'),
+        ),
+    ]
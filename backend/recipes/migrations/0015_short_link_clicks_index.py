@@ -0,0 +1,17 @@
+# Generated by Django 3.2.3 on 2026-10-18 19:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0014_popularity'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['-short_link_clicks', '-id'], name='recipe_short_link_clicks_idx'),
+        ),
+    ]
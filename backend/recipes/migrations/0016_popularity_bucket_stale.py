@@ -0,0 +1,22 @@
+# Generated by Django 3.2.3 on 2026-10-18 20:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0015_short_link_clicks_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='popularitybucket',
+            name='stale',
+            field=models.BooleanField(default=False, verbose_name='Требует пересчёта'),
+        ),
+        migrations.AddIndex(
+            model_name='popularitybucket',
+            index=models.Index(condition=models.Q(('stale', True)), fields=['recipe'], name='popularity_bucket_stale_idx'),
+        ),
+    ]
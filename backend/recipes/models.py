@@ -1,6 +1,9 @@
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
+from django.db.models import Exists, OuterRef, Value
 from django.core.validators import MinValueValidator
-from django.contrib.auth.models import AbstractUser
+from django.contrib.auth.models import AbstractUser, UserManager
 from django.core.validators import RegexValidator
 
 
@@ -10,6 +13,22 @@ username_validator = RegexValidator(
             'только буквы, цифры и символы @/./+/-/_'
 )
 
+FALSE = Value(False, output_field=models.BooleanField())
+
+
+class UserQuerySet(models.QuerySet):
+    def with_is_subscribed(self, user):
+        if not user or not user.is_authenticated:
+            return self.annotate(is_subscribed=FALSE)
+        return self.annotate(is_subscribed=Exists(
+            Subscription.objects.filter(subscriber=user,
+                                        author=OuterRef('pk'))
+        ))
+
+
+class CustomUserManager(UserManager.from_queryset(UserQuerySet)):
+    pass
+
 
 class CustomUser(AbstractUser):
     username = models.CharField('Логин (никнейм)', max_length=150,
@@ -22,13 +41,39 @@ class CustomUser(AbstractUser):
         "Аватар", upload_to="users/",
         blank=True, null=True
     )
+    updated_at = models.DateTimeField('Дата изменения', auto_now=True)
+    recipes_count = models.PositiveIntegerField('Рецептов', default=0,
+                                                editable=False)
+    subscriptions_count = models.PositiveIntegerField('Подписок', default=0,
+                                                      editable=False)
+    subscribers_count = models.PositiveIntegerField('Подписчиков', default=0,
+                                                    editable=False)
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ('username', 'first_name', 'last_name')
 
+    objects = CustomUserManager()
+
+    # Счётчики меняются только UPDATE ... SET field = field ± 1, обычное
+    # сохранение (в том числе копии из кэша токенов) их не перезаписывает
+    COUNTER_FIELDS = frozenset(
+        ('recipes_count', 'subscriptions_count', 'subscribers_count')
+    )
+
     def __str__(self):
         return self.email
 
+    def save(self, force_insert=False, force_update=False, using=None,
+             update_fields=None):
+        if update_fields is None and not (force_insert
+                                          or self._state.adding):
+            update_fields = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key
+                and field.name not in self.COUNTER_FIELDS
+            ]
+        super().save(force_insert, force_update, using, update_fields)
+
 
 class Subscription(models.Model):
     subscriber = models.ForeignKey(
@@ -52,6 +97,35 @@ class Subscription(models.Model):
                 f'{self.author.first_name} {self.author.last_name}')
 
 
+class RecipeQuerySet(models.QuerySet):
+    def with_user_flags(self, user):
+        if not user or not user.is_authenticated:
+            return self.annotate(is_favorited=FALSE,
+                                 is_in_shopping_cart=FALSE)
+        return self.annotate(
+            is_favorited=Exists(Favorite.objects.filter(
+                user=user, recipe=OuterRef('pk'))),
+            is_in_shopping_cart=Exists(ShoppingCart.objects.filter(
+                user=user, recipe=OuterRef('pk')))
+        )
+
+    def for_read(self, user):
+        # Автор с флагом подписки и продукты подгружаются отдельными
+        # запросами на всю страницу, поэтому их число не зависит от
+        # количества рецептов
+        return self.with_user_flags(user).prefetch_related(
+            models.Prefetch(
+                'author',
+                queryset=CustomUser.objects.with_is_subscribed(user)
+            ),
+            models.Prefetch(
+                'recipe_ingredients',
+                queryset=(RecipeIngredient.objects.select_related('ingredient')
+                          .order_by('ingredient__name'))
+            )
+        )
+
+
 class Recipe(models.Model):
     author = models.ForeignKey(
         CustomUser, on_delete=models.CASCADE,
@@ -65,6 +139,14 @@ class Recipe(models.Model):
         'Изображение', upload_to='recipes/images/',
         blank=False, null=False
     )
+    image_small = models.ImageField(
+        'Изображение для списка', upload_to='recipes/images/small/',
+        blank=True, editable=False
+    )
+    image_large = models.ImageField(
+        'Изображение для страницы рецепта',
+        upload_to='recipes/images/large/', blank=True, editable=False
+    )
     text = models.TextField('Описание')
     ingredients = models.ManyToManyField(
         'Ingredient',
@@ -72,15 +154,50 @@ class Recipe(models.Model):
         verbose_name='Продукты'
     )
     cooking_time = models.PositiveIntegerField('Время приготовления',
+                                               db_index=True,
                                                validators=(
                                                    MinValueValidator(1),))
     created_at = models.DateTimeField('Дата публикации', auto_now_add=True)
+    updated_at = models.DateTimeField('Дата изменения', auto_now=True)
+    favorites_count = models.PositiveIntegerField('В избранном', default=0,
+                                                  editable=False)
+    short_link_clicks = models.PositiveIntegerField(
+        'Переходов по короткой ссылке', default=0, editable=False
+    )
+    # Добавления в избранное и корзину за окно, пересчитываются
+    # командой refresh_popularity из почасовых сводок
+    popularity_day = models.PositiveIntegerField(
+        'Популярность за день', default=0, editable=False
+    )
+    popularity_week = models.PositiveIntegerField(
+        'Популярность за неделю', default=0, editable=False
+    )
+    popularity_total = models.PositiveIntegerField(
+        'Популярность за всё время', default=0, editable=False
+    )
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    objects = RecipeQuerySet.as_manager()
 
     class Meta:
-        ordering = ('-created_at',)
+        ordering = ('-created_at', '-id')
         verbose_name = 'рецепт'
         verbose_name_plural = 'Рецепты'
         default_related_name = 'recipes'
+        indexes = (
+            models.Index(fields=('-created_at', '-id'),
+                         name='recipe_created_at_id_idx'),
+            GinIndex(fields=('search_vector',),
+                     name='recipe_search_vector_idx'),
+            models.Index(fields=('-popularity_day', '-id'),
+                         name='recipe_popularity_day_idx'),
+            models.Index(fields=('-popularity_week', '-id'),
+                         name='recipe_popularity_week_idx'),
+            models.Index(fields=('-popularity_total', '-id'),
+                         name='recipe_popularity_total_idx'),
+            models.Index(fields=('-short_link_clicks', '-id'),
+                         name='recipe_short_link_clicks_idx'),
+        )
 
     def __str__(self):
         return (f'{self.name} - '
@@ -142,6 +259,9 @@ class UserRecipeLink(models.Model):
         on_delete=models.CASCADE,
         verbose_name='Рецепт'
     )
+    # У связей, созданных до появления поля, даты нет
+    created_at = models.DateTimeField('Дата добавления', auto_now_add=True,
+                                      null=True, db_index=True)
 
     class Meta:
         abstract = True
@@ -176,3 +296,87 @@ class ShoppingCart(UserRecipeLink):
                 name='unique_user_recipe_shoppingcart'
             ),
         )
+
+
+class FeedEntry(UserRecipeLink):
+    # Лента подписок, заполняемая при публикации рецепта. Дата
+    # копируется из рецепта, чтобы лента сортировалась по своему индексу
+    created_at = models.DateTimeField('Дата публикации')
+
+    class Meta:
+        verbose_name = 'запись ленты'
+        verbose_name_plural = 'Лента подписок'
+        default_related_name = 'feed_entries'
+        constraints = (
+            models.UniqueConstraint(
+                fields=('user', 'recipe'),
+                name='unique_user_recipe_feedentry'
+            ),
+        )
+        indexes = (
+            models.Index(fields=('user', '-created_at', '-recipe'),
+                         name='feed_user_created_at_idx'),
+        )
+
+
+class ShoppingListItem(models.Model):
+    # Список покупок, который обновляется вместе с корзиной: сумма
+    # количества продукта по всем рецептам в корзине пользователя
+    user = models.ForeignKey(
+        CustomUser,
+        on_delete=models.CASCADE,
+        verbose_name='Пользователь'
+    )
+    ingredient = models.ForeignKey(
+        Ingredient,
+        on_delete=models.CASCADE,
+        verbose_name='Продукт'
+    )
+    amount = models.PositiveIntegerField('Количество')
+
+    class Meta:
+        verbose_name = 'строка списка покупок'
+        verbose_name_plural = 'Списки покупок'
+        default_related_name = 'shopping_list_items'
+        constraints = (
+            models.UniqueConstraint(
+                fields=('user', 'ingredient'),
+                name='unique_user_ingredient_shoppinglistitem'
+            ),
+        )
+
+    def __str__(self):
+        return f'{self.user} - {self.ingredient}: {self.amount}'
+
+
+class PopularityBucket(models.Model):
+    # Почасовая сводка добавлений рецепта в избранное и корзину.
+    # Связи без даты попадают в сводку с началом эпохи
+    recipe = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        verbose_name='Рецепт'
+    )
+    bucket = models.DateTimeField('Начало часа', db_index=True)
+    favorites = models.PositiveIntegerField('В избранное', default=0)
+    carts = models.PositiveIntegerField('В корзину', default=0)
+    # Из сводки вычли удалённые связи, счёт рецепта нужно пересчитать
+    stale = models.BooleanField('Требует пересчёта', default=False)
+
+    class Meta:
+        verbose_name = 'сводка популярности'
+        verbose_name_plural = 'Сводки популярности'
+        default_related_name = 'popularity_buckets'
+        constraints = (
+            models.UniqueConstraint(
+                fields=('recipe', 'bucket'),
+                name='unique_recipe_bucket_popularitybucket'
+            ),
+        )
+        indexes = (
+            models.Index(fields=('recipe',), condition=models.Q(stale=True),
+                         name='popularity_bucket_stale_idx'),
+        )
+
+    def __str__(self):
+        return f'{self.recipe_id} {self.bucket}: {self.favorites}/{self.carts}'
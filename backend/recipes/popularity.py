@@ -0,0 +1,155 @@
+from collections import Counter, defaultdict
+from functools import reduce
+from operator import or_
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.db import transaction
+from django.db.models import (Case, Count, F, IntegerField, Max, OuterRef,
+                              Q, Subquery, Sum, Value, When)
+from django.db.models.functions import Coalesce, Greatest, TruncHour
+from django.utils import timezone
+from recipes.cache import RECIPES_LIST_VERSION_KEY, bump_version
+from recipes.models import Favorite, PopularityBucket, Recipe, ShoppingCart
+
+
+# Связи без даты добавления учитываются только за всё время
+UNKNOWN_BUCKET = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+BUCKET_SIZE = timedelta(hours=1)
+
+# Поле рецепта и длина окна; None — за всё время
+PERIODS = {
+    'day': ('popularity_day', timedelta(days=1)),
+    'week': ('popularity_week', timedelta(days=7)),
+    'all': ('popularity_total', None),
+}
+
+# Модель связи и поле сводки, в которое она попадает
+SOURCES = ((Favorite, 'favorites'), (ShoppingCart, 'carts'))
+
+
+def bucket_of(created_at):
+    # То же округление, что у TruncHour в текущем часовом поясе
+    if created_at is None:
+        return UNKNOWN_BUCKET
+    return timezone.localtime(created_at).replace(minute=0, second=0,
+                                                  microsecond=0)
+
+
+def forget_links(model, links):
+    # Счёт в обоих режимах refresh — число существующих сейчас связей.
+    # Удалённые связи вычитаются из уже собранных сводок, а сводки
+    # помечаются, чтобы следующий refresh пересчитал счёт рецепта.
+    # links: пары (id рецепта, дата добавления); все сводки
+    # сдвигаются одним UPDATE
+    field = dict(SOURCES)[model]
+    removed = Counter((recipe_id, bucket_of(created_at))
+                      for recipe_id, created_at in links)
+    if not removed:
+        return
+    PopularityBucket.objects.filter(
+        reduce(or_, (Q(recipe_id=recipe_id, bucket=bucket)
+                     for recipe_id, bucket in removed))
+    ).update(stale=True, **{field: Greatest(F(field) - Case(
+        *(When(recipe_id=recipe_id, bucket=bucket, then=Value(count))
+          for (recipe_id, bucket), count in removed.items()),
+        default=Value(0), output_field=IntegerField()
+    ), 0)})
+
+
+def collect_buckets(since):
+    buckets = defaultdict(lambda: defaultdict(int))
+    for model, field in SOURCES:
+        links = model.objects.order_by()
+        if since is None:
+            for recipe_id, total in (links.filter(created_at__isnull=True)
+                                     .values('recipe_id')
+                                     .annotate(total=Count('id'))
+                                     .values_list('recipe_id', 'total')):
+                buckets[recipe_id, UNKNOWN_BUCKET][field] = total
+            links = links.filter(created_at__isnull=False)
+        else:
+            links = links.filter(created_at__gte=since)
+        for recipe_id, bucket, total in (
+                links.annotate(bucket=TruncHour('created_at'))
+                .values('recipe_id', 'bucket')
+                .annotate(total=Count('id'))
+                .values_list('recipe_id', 'bucket', 'total')):
+            buckets[recipe_id, bucket][field] = total
+    return buckets
+
+
+def refresh_buckets(since, batch_size):
+    # Сводки начиная с since собираются заново, более ранние часы
+    # закрыты и не меняются. Возвращает id рецептов, чьи сводки
+    # изменились, и число записанных сводок
+    stale = PopularityBucket.objects.all()
+    if since is not None:
+        stale = stale.filter(bucket__gte=since)
+    changed = set(stale.values_list('recipe_id', flat=True))
+    stale.delete()
+    buckets = collect_buckets(since)
+    PopularityBucket.objects.bulk_create(
+        (PopularityBucket(recipe_id=recipe_id, bucket=bucket, **counts)
+         for (recipe_id, bucket), counts in buckets.items()),
+        batch_size=batch_size
+    )
+    changed.update(recipe_id for recipe_id, _ in buckets)
+    # Сбрасывается до пересчёта счёта: удаление, пришедшее позже,
+    # снова пометит сводку
+    stale = PopularityBucket.objects.filter(stale=True)
+    changed.update(stale.values_list('recipe_id', flat=True))
+    stale.filter(favorites=0, carts=0).delete()
+    stale.update(stale=False)
+    return changed, len(buckets)
+
+
+def score_subquery(start):
+    buckets = PopularityBucket.objects.filter(recipe=OuterRef('pk'))
+    if start is not None:
+        buckets = buckets.filter(bucket__gte=start)
+    return Coalesce(
+        Subquery(buckets.order_by().values('recipe')
+                 .annotate(score=Sum(F('favorites') + F('carts')))
+                 .values('score')),
+        0, output_field=IntegerField()
+    )
+
+
+def update_scores(recipe_ids, batch_size):
+    now = timezone.now()
+    scores = {
+        field: score_subquery(None if length is None else now - length)
+        for field, length in PERIODS.values()
+    }
+    for start in range(0, len(recipe_ids), batch_size):
+        Recipe.objects.filter(
+            id__in=recipe_ids[start:start + batch_size]
+        ).update(**scores)
+
+
+def refresh(full=False, batch_size=1000):
+    # Пересобирается последний час из уже собранных и всё, что после
+    # него: связи, добавленные транзакциями, закончившимися позже,
+    # успевают попасть в сводку. Окна день и неделя сдвигаются,
+    # поэтому пересчитываются и все рецепты с ненулевым недельным счётом
+    last = None if full else (
+        PopularityBucket.objects.exclude(bucket=UNKNOWN_BUCKET)
+        .aggregate(last=Max('bucket'))['last']
+    )
+    since = None if last is None else last - BUCKET_SIZE
+    with transaction.atomic():
+        changed, written = refresh_buckets(since, batch_size)
+        if since is None:
+            recipe_ids = list(Recipe.objects.order_by('id')
+                              .values_list('id', flat=True))
+        else:
+            changed.update(Recipe.objects.filter(popularity_week__gt=0)
+                           .values_list('id', flat=True))
+            recipe_ids = sorted(changed)
+        update_scores(recipe_ids, batch_size)
+    bump_version(RECIPES_LIST_VERSION_KEY)
+    return written, len(recipe_ids)
+
+
+def order_by_popularity(recipes, period):
+    field, _ = PERIODS[period]
+    return recipes.order_by(f'-{field}', '-id')
@@ -0,0 +1,87 @@
+import heapq
+from array import array
+from bisect import bisect_left, insort
+from collections import Counter
+from django.conf import settings
+from recipes.cache import VersionedIndex
+from recipes.models import RecipeIngredient
+
+
+class RecipeIngredientIndex(VersionedIndex):
+    # Обратный индекс «продукт -> рецепты» в памяти процесса.
+    # Списки рецептов хранятся отсортированными массивами целых чисел
+    version_key = 'recipe_ingredient_index_version'
+    refresh_setting = 'RECIPE_INGREDIENT_INDEX_REFRESH'
+    ttl_setting = 'RECIPE_INGREDIENT_INDEX_TTL'
+
+    def __init__(self):
+        super().__init__()
+        self._postings = {}
+        self._recipes = {}
+
+    def _build(self):
+        postings = {}
+        recipes = {}
+        rows = (RecipeIngredient.objects.order_by('recipe_id')
+                .values_list('recipe_id', 'ingredient_id')
+                .iterator(chunk_size=10000))
+        for recipe_id, ingredient_id in rows:
+            postings.setdefault(ingredient_id, array('q')).append(recipe_id)
+            recipes.setdefault(recipe_id, array('q')).append(ingredient_id)
+        self._postings = postings
+        self._recipes = recipes
+
+    def _remove(self, recipe_id):
+        for ingredient_id in self._recipes.pop(recipe_id, ()):
+            posting = self._postings[ingredient_id]
+            position = bisect_left(posting, recipe_id)
+            if position < len(posting) and posting[position] == recipe_id:
+                del posting[position]
+
+    def refresh_recipe(self, recipe_id):
+        ingredient_ids = array('q', RecipeIngredient.objects.filter(
+            recipe_id=recipe_id
+        ).values_list('ingredient_id', flat=True))
+
+        def change():
+            self._remove(recipe_id)
+            for ingredient_id in ingredient_ids:
+                insort(self._postings.setdefault(ingredient_id, array('q')),
+                       recipe_id)
+            if ingredient_ids:
+                self._recipes[recipe_id] = ingredient_ids
+
+        self._apply(change)
+
+    def recipes_with(self, ingredient_ids):
+        self.ensure_fresh()
+        found = set()
+        with self._lock:
+            for ingredient_id in ingredient_ids:
+                found.update(self._postings.get(ingredient_id, ()))
+        return found
+
+    def match(self, include, exclude=(), limit=None, allowed=None):
+        # Рецепты с хотя бы одним продуктом из include и без продуктов
+        # из exclude. Сортировка по доле продуктов рецепта, которые
+        # уже есть, затем по их числу и по новизне (id). allowed
+        # сужает кандидатов до ограничения limit. Индекс читается
+        # под блокировкой: перестройка или правка рецепта в другом
+        # потоке не должна менять его посреди подсчёта
+        self.ensure_fresh()
+        limit = limit or settings.RECIPE_MATCH_LIMIT
+        with self._lock:
+            hits = Counter()
+            for ingredient_id in set(include):
+                hits.update(self._postings.get(ingredient_id, ()))
+            excluded = self.recipes_with(exclude)
+            ranked = (
+                (count / len(self._recipes[recipe_id]), count, recipe_id)
+                for recipe_id, count in hits.items()
+                if recipe_id not in excluded
+                and (allowed is None or recipe_id in allowed)
+            )
+            return heapq.nlargest(limit, ranked)
+
+
+recipe_ingredient_index = RecipeIngredientIndex()
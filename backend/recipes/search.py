@@ -0,0 +1,110 @@
+import re
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.search import (SearchQuery, SearchRank,
+                                            SearchVector)
+from django.db import connection
+from django.db.models import Case, F, FloatField, OuterRef, Subquery, When
+from recipes.models import RecipeIngredient
+
+
+SEARCH_CONFIG = 'russian'
+# Веса совпадений в названии, описании и продуктах — как веса A, B, C
+# в ts_rank по умолчанию
+WEIGHTS = {'name': 1.0, 'text': 0.4, 'ingredients': 0.2}
+# Окончания, которые отбрасывает упрощённый стемминг запасного поиска,
+# от длинных к коротким
+ENDINGS = sorted((
+    'иями', 'ями', 'ами', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими',
+    'ой', 'ей', 'ий', 'ый', 'ая', 'яя', 'ое', 'ее', 'ые', 'ие', 'ую', 'юю',
+    'ом', 'ем', 'ам', 'ям', 'ах', 'ях', 'ов', 'ев', 'ью',
+    'ы', 'и', 'а', 'я', 'о', 'е', 'у', 'ю', 'ь', 'й',
+), key=len, reverse=True)
+MIN_STEM_LENGTH = 3
+
+
+def is_postgres():
+    return connection.vendor == 'postgresql'
+
+
+def update_search_vectors(recipes):
+    # Вектор собирается в базе из названия, описания и названий
+    # продуктов; на других СУБД поиск работает без вектора
+    if not is_postgres():
+        return
+    ingredient_names = Subquery(
+        RecipeIngredient.objects.filter(recipe=OuterRef('pk'))
+        .order_by().values('recipe')
+        .annotate(names=StringAgg('ingredient__name', ' '))
+        .values('names')
+    )
+    recipes.update(search_vector=(
+        SearchVector('name', weight='A', config=SEARCH_CONFIG)
+        + SearchVector('text', weight='B', config=SEARCH_CONFIG)
+        + SearchVector(ingredient_names, weight='C', config=SEARCH_CONFIG)
+    ))
+
+
+def tokenize(value):
+    return re.findall(r'\w+', value.casefold())
+
+
+def stem(word):
+    for ending in ENDINGS:
+        if (word.endswith(ending)
+                and len(word) - len(ending) >= MIN_STEM_LENGTH):
+            return word[:-len(ending)]
+    return word
+
+
+def stems(value):
+    return {stem(word) for word in tokenize(value)}
+
+
+def search_recipes(recipes, query):
+    if is_postgres():
+        search_query = SearchQuery(query, config=SEARCH_CONFIG,
+                                   search_type='websearch')
+        return (recipes.filter(search_vector=search_query)
+                .annotate(rank=SearchRank(F('search_vector'), search_query))
+                .order_by('-rank', '-created_at', '-id'))
+    return fallback_search(recipes, query)
+
+
+def fallback_search(recipes, query):
+    # Для SQLite и разработки. Как и в PostgreSQL, слова запроса
+    # и рецепта сравниваются целиком после стемминга, но стемминг
+    # упрощённый (отбрасываются окончания), поэтому выдача близка
+    # к PostgreSQL, а не совпадает с ней. Ранг — сумма весов полей
+    # с совпадениями. Рецепты перебираются в Python, поэтому
+    # для больших каталогов нужен PostgreSQL
+    terms = stems(query)
+    if not terms:
+        return recipes
+    documents = {}
+    for recipe_id, name, text in recipes.values_list('id', 'name', 'text'):
+        documents[recipe_id] = {'name': stems(name), 'text': stems(text),
+                                'ingredients': set()}
+    for recipe_id, name in RecipeIngredient.objects.filter(
+        recipe_id__in=documents
+    ).values_list('recipe_id', 'ingredient__name'):
+        documents[recipe_id]['ingredients'] |= stems(name)
+
+    ranks = {}
+    for recipe_id, fields in documents.items():
+        rank = 0
+        for term in terms:
+            matched = [field for field, words in fields.items()
+                       if term in words]
+            if not matched:
+                break
+            rank += sum(WEIGHTS[field] for field in matched)
+        else:
+            ranks[recipe_id] = rank
+
+    return (recipes.filter(id__in=ranks)
+            .annotate(rank=Case(
+                *(When(id=recipe_id, then=rank)
+                  for recipe_id, rank in ranks.items()),
+                default=0, output_field=FloatField()
+            ))
+            .order_by('-rank', '-created_at', '-id'))
@@ -0,0 +1,99 @@
+from collections import defaultdict
+from django.conf import settings
+from django.db.models import Case, F, IntegerField, Sum, Value, When
+from recipes.models import RecipeIngredient, ShoppingCart, ShoppingListItem
+
+
+def recipe_amounts(recipe_ids):
+    return dict(RecipeIngredient.objects.filter(recipe_id__in=recipe_ids)
+                .order_by().values('ingredient_id')
+                .annotate(total=Sum('amount'))
+                .values_list('ingredient_id', 'total'))
+
+
+def by_ingredient(values):
+    return Case(*(When(ingredient_id=pk, then=Value(value))
+                  for pk, value in values.items()),
+                default=Value(0), output_field=IntegerField())
+
+
+def shift_items(user_ids, deltas):
+    # deltas: продукт -> изменение количества, одинаковое для всех
+    # пользователей. Недостающие строки вставляются с нулём, затем
+    # обнулившиеся удаляются, а остальные сдвигаются одним UPDATE
+    user_ids = list(user_ids)
+    deltas = {pk: delta for pk, delta in deltas.items() if delta}
+    if not user_ids or not deltas:
+        return
+    added = [pk for pk, delta in deltas.items() if delta > 0]
+    if added:
+        ShoppingListItem.objects.bulk_create(
+            (ShoppingListItem(user_id=user_id, ingredient_id=ingredient_id,
+                              amount=0)
+             for user_id in user_ids for ingredient_id in added),
+            batch_size=settings.SHOPPING_LIST_BATCH_SIZE,
+            ignore_conflicts=True
+        )
+    items = ShoppingListItem.objects.filter(user_id__in=user_ids)
+    removed = {pk: -delta for pk, delta in deltas.items() if delta < 0}
+    if removed:
+        items.filter(ingredient_id__in=removed,
+                     amount__lte=by_ingredient(removed)).delete()
+    items.filter(ingredient_id__in=deltas).update(
+        amount=F('amount') + by_ingredient(deltas)
+    )
+
+
+def add_recipes(user_id, recipe_ids):
+    shift_items((user_id,), recipe_amounts(recipe_ids))
+
+
+def remove_recipes(user_id, recipe_ids):
+    shift_items((user_id,), {ingredient_id: -total for ingredient_id, total
+                             in recipe_amounts(recipe_ids).items()})
+
+
+def shift_recipe_ingredients(recipe_id, deltas):
+    # Изменение состава рецепта расходится по спискам всех,
+    # у кого он в корзине
+    shift_items(ShoppingCart.objects.filter(recipe_id=recipe_id)
+                .values_list('user_id', flat=True), deltas)
+
+
+def expected_items(user_ids):
+    return (RecipeIngredient.objects
+            .filter(recipe__shopping_carts__user__in=user_ids)
+            .order_by()
+            .values_list('recipe__shopping_carts__user', 'ingredient_id')
+            .annotate(total=Sum('amount')))
+
+
+def rebuild(user_ids):
+    # Списки пересобираются из корзин, только если отличаются
+    # от сохранённых. Возвращает число исправленных списков
+    expected = defaultdict(dict)
+    for user_id, ingredient_id, total in expected_items(user_ids):
+        expected[user_id][ingredient_id] = total
+    stored = defaultdict(dict)
+    for user_id, ingredient_id, amount in ShoppingListItem.objects.filter(
+            user_id__in=user_ids).values_list('user_id', 'ingredient_id',
+                                              'amount'):
+        stored[user_id][ingredient_id] = amount
+    drifted = [user_id for user_id in user_ids
+               if expected[user_id] != stored[user_id]]
+    if drifted:
+        ShoppingListItem.objects.filter(user_id__in=drifted).delete()
+        ShoppingListItem.objects.bulk_create(
+            (ShoppingListItem(user_id=user_id, ingredient_id=ingredient_id,
+                              amount=amount)
+             for user_id in drifted
+             for ingredient_id, amount in expected[user_id].items()),
+            batch_size=settings.SHOPPING_LIST_BATCH_SIZE
+        )
+    return len(drifted)
+
+
+def shopping_list_items(user):
+    return (ShoppingListItem.objects.filter(user=user)
+            .select_related('ingredient')
+            .order_by('ingredient__name', 'ingredient__measurement_unit'))
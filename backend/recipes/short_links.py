@@ -0,0 +1,157 @@
+import atexit
+import logging
+import string
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, transaction
+from django.db.models import F
+from recipes.cache import VersionedIndex
+from recipes.models import Recipe
+
+
+logger = logging.getLogger(__name__)
+
+ALPHABET = string.digits + string.ascii_letters
+BASE = len(ALPHABET)
+DIGITS = {char: value for value, char in enumerate(ALPHABET)}
+
+
+def encode(number):
+    code = ''
+    while True:
+        number, digit = divmod(number, BASE)
+        code = ALPHABET[digit] + code
+        if not number:
+            return code
+
+
+def decode(code):
+    number = 0
+    for char in code:
+        if char not in DIGITS:
+            raise ValueError(f'Недопустимый символ в коде: {char}')
+        number = number * BASE + DIGITS[char]
+    return number
+
+
+class RecipeIdSet(VersionedIndex):
+    # Битовая карта существующих id рецептов: редирект по короткой
+    # ссылке проверяет рецепт без запроса к базе
+    version_key = 'recipe_id_set_version'
+    refresh_setting = 'SHORT_LINK_INDEX_REFRESH'
+    ttl_setting = 'SHORT_LINK_INDEX_TTL'
+
+    def __init__(self):
+        super().__init__()
+        self._bits = bytearray()
+
+    def _build(self):
+        bits = bytearray()
+        for recipe_id in Recipe.objects.values_list('id', flat=True).order_by(
+                'id').iterator(chunk_size=10000):
+            self._set(bits, recipe_id)
+        self._bits = bits
+
+    @staticmethod
+    def _set(bits, recipe_id):
+        byte = recipe_id >> 3
+        if byte >= len(bits):
+            bits.extend(bytes(byte - len(bits) + 1))
+        bits[byte] |= 1 << (recipe_id & 7)
+
+    def _has(self, recipe_id):
+        byte = recipe_id >> 3
+        return (0 <= byte < len(self._bits)
+                and bool(self._bits[byte] & 1 << (recipe_id & 7)))
+
+    def __contains__(self, recipe_id):
+        self.ensure_fresh()
+        if self._has(recipe_id):
+            return True
+        # Рецепт мог только что появиться в другом процессе. Промахи
+        # перестраивают набор не чаще раза в SHORT_LINK_INDEX_REFRESH
+        self.ensure_fresh(force=True)
+        return self._has(recipe_id)
+
+    def add(self, recipe_id):
+        self._apply(lambda: self._set(self._bits, recipe_id))
+
+    def discard(self, recipe_id):
+        def change():
+            if self._has(recipe_id):
+                self._bits[recipe_id >> 3] &= ~(1 << (recipe_id & 7))
+        self._apply(change)
+
+
+class ClickBuffer:
+    # Переходы копятся в памяти и записываются пачкой в фоновом потоке,
+    # когда их набралось SHORT_LINK_FLUSH_SIZE или прошло
+    # SHORT_LINK_FLUSH_INTERVAL секунд. Переходы, не записанные до
+    # падения процесса, теряются: это допустимо для рейтинга
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clicks = Counter()
+        self._pending = 0
+        self._flushed_at = time.monotonic()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def record(self, recipe_id):
+        with self._lock:
+            self._clicks[recipe_id] += 1
+            self._pending += 1
+            due = (self._pending >= settings.SHORT_LINK_FLUSH_SIZE
+                   or time.monotonic() - self._flushed_at
+                   >= settings.SHORT_LINK_FLUSH_INTERVAL)
+            if due:
+                self._flushed_at = time.monotonic()
+        if due:
+            self._executor.submit(self._flush_in_thread)
+
+    def _flush_in_thread(self):
+        close_old_connections()
+        try:
+            self.flush()
+        finally:
+            close_old_connections()
+
+    def flush(self):
+        with self._lock:
+            clicks, self._clicks = self._clicks, Counter()
+            self._pending = 0
+        if not clicks:
+            return
+        # Одно UPDATE на каждое встретившееся число переходов
+        by_count = defaultdict(list)
+        for recipe_id, count in clicks.items():
+            by_count[count].append(recipe_id)
+        with transaction.atomic():
+            for count, recipe_ids in by_count.items():
+                Recipe.objects.filter(id__in=recipe_ids).update(
+                    short_link_clicks=F('short_link_clicks') + count
+                )
+
+
+def order_by_clicks(recipes):
+    # Рейтинг вирусных рецептов по записанным переходам
+    return recipes.order_by('-short_link_clicks', '-id')
+
+
+recipe_ids = RecipeIdSet()
+clicks = ClickBuffer()
+
+
+def flush_clicks_at_exit():
+    # К выходу база может быть уже закрыта или удалена (как тестовая),
+    # тогда переходы теряются так же, как при падении процесса
+    try:
+        clicks.flush()
+    except DatabaseError:
+        logger.warning('Не удалось записать переходы по коротким ссылкам '
+                       'при завершении процесса')
+
+
+atexit.register(flush_clicks_at_exit)
@@ -0,0 +1,253 @@
+import threading
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+from recipes.cache import bump_recipe_versions
+from recipes.counters import row_handlers_suspended, shift_counter
+from recipes.feeds import (backfill_subscription, drop_subscription,
+                           publish_recipe)
+from recipes.images import RENDITIONS, replace_renditions, schedule_renditions
+from recipes.ingredient_index import ingredient_index
+from recipes.recipe_index import recipe_ingredient_index
+from recipes.search import update_search_vectors
+from recipes import popularity, shopping_lists, short_links
+from recipes.models import (CustomUser, Favorite, Ingredient, Recipe,
+                            RecipeIngredient, ShoppingCart, Subscription)
+
+
+@receiver((post_save, post_delete), sender=Ingredient)
+def invalidate_ingredient_index(**kwargs):
+    transaction.on_commit(ingredient_index.invalidate)
+
+
+@receiver((post_save, post_delete), sender=Recipe)
+def invalidate_recipe_cache(instance, **kwargs):
+    recipe_id = instance.id
+    transaction.on_commit(lambda: bump_recipe_versions((recipe_id,)))
+
+
+# Рецепты, продукты которых менялись в текущей транзакции. Сколько бы
+# строк ни изменилось, после коммита каждый рецепт обновляется один раз
+_changed_recipes = threading.local()
+
+
+def flush_changed_recipes():
+    recipe_ids = getattr(_changed_recipes, 'ids', set())
+    _changed_recipes.ids = set()
+    if not recipe_ids:
+        return
+    Recipe.objects.filter(id__in=recipe_ids).update(
+        updated_at=timezone.now()
+    )
+    bump_recipe_versions(recipe_ids)
+    update_search_vectors(Recipe.objects.filter(id__in=recipe_ids))
+    for recipe_id in recipe_ids:
+        recipe_ingredient_index.refresh_recipe(recipe_id)
+
+
+@receiver((post_save, post_delete), sender=RecipeIngredient)
+def collect_recipe_ingredients_change(instance, **kwargs):
+    # Сброс регистрируется на каждое изменение: откат транзакции или
+    # точки сохранения отменяет зарегистрированный ранее, а id остаются
+    # в наборе. Повторные вызовы после первого ничего не делают.
+    # Массовые изменения обновляют рецепт сами, одним сохранением
+    if row_handlers_suspended():
+        return
+    recipe_ids = getattr(_changed_recipes, 'ids', None)
+    if recipe_ids is None:
+        recipe_ids = _changed_recipes.ids = set()
+    recipe_ids.add(instance.recipe_id)
+    transaction.on_commit(flush_changed_recipes)
+
+
+@receiver(post_save, sender=Recipe)
+def refresh_search_vector(instance, **kwargs):
+    recipe_id = instance.id
+    transaction.on_commit(lambda: update_search_vectors(
+        Recipe.objects.filter(id=recipe_id)
+    ))
+
+
+@receiver((post_save, post_delete), sender=Recipe)
+def refresh_recipe_ingredient_index(instance, **kwargs):
+    recipe_id = instance.id
+    transaction.on_commit(
+        lambda: recipe_ingredient_index.refresh_recipe(recipe_id)
+    )
+
+
+@receiver(pre_save, sender=Recipe)
+def remember_stored_image(instance, update_fields=None, **kwargs):
+    # Сохранённая картинка читается, только если её могут заменить:
+    # из API, админки или кода, сохраняющего рецепт целиком
+    if instance.pk is None or (update_fields is not None
+                               and 'image' not in update_fields):
+        return
+    instance._stored_images = Recipe.objects.filter(
+        pk=instance.pk
+    ).values_list('image', *RENDITIONS).first()
+
+
+@receiver(post_save, sender=Recipe)
+def refresh_renditions(instance, created, **kwargs):
+    stored = instance.__dict__.pop('_stored_images', None)
+    if created:
+        if instance.image:
+            schedule_renditions(instance.id)
+    elif stored is not None and stored[0] != instance.image.name:
+        for field in RENDITIONS:
+            setattr(instance, field, None)
+        replace_renditions(instance.id, stored[1:])
+
+
+@receiver(post_save, sender=Recipe)
+def add_short_link(instance, created, **kwargs):
+    if created:
+        transaction.on_commit(lambda: short_links.recipe_ids.add(instance.id))
+
+
+@receiver(post_delete, sender=Recipe)
+def remove_short_link(instance, **kwargs):
+    # После удаления instance.id становится None, id запоминается сразу
+    recipe_id = instance.id
+    transaction.on_commit(lambda: short_links.recipe_ids.discard(recipe_id))
+
+
+@receiver(post_save, sender=Recipe)
+def publish_to_feeds(instance, created, **kwargs):
+    if created:
+        transaction.on_commit(lambda: publish_recipe(
+            instance.id, instance.author_id, instance.created_at
+        ))
+
+
+@receiver(post_save, sender=Ingredient)
+def refresh_search_vectors_on_rename(instance, created, **kwargs):
+    if not created:
+        transaction.on_commit(lambda: update_search_vectors(
+            Recipe.objects.filter(ingredients=instance)
+        ))
+
+
+@receiver(post_save, sender=CustomUser)
+def invalidate_author_recipes_cache(instance, created, update_fields=None,
+                                    **kwargs):
+    # Вход в систему меняет только last_login, в ответах его нет
+    if created or update_fields and set(update_fields) <= {'last_login'}:
+        return
+    recipe_ids = list(instance.recipes.values_list('id', flat=True))
+    if recipe_ids:
+        transaction.on_commit(lambda: bump_recipe_versions(recipe_ids))
+
+
+# Счётчики меняются одним UPDATE ... SET field = field ± 1, поэтому
+# параллельные запросы не теряют изменения. Расхождения, если они
+# появятся, исправляет команда recount_counters
+
+
+@receiver(post_save, sender=Favorite)
+def increase_favorites_count(instance, created, **kwargs):
+    if created and not row_handlers_suspended():
+        shift_counter(Recipe, (instance.recipe_id,), 'favorites_count', 1)
+
+
+@receiver(post_delete, sender=Favorite)
+def decrease_favorites_count(instance, **kwargs):
+    if not row_handlers_suspended():
+        shift_counter(Recipe, (instance.recipe_id,), 'favorites_count', -1)
+
+
+@receiver(post_delete, sender=Favorite)
+@receiver(post_delete, sender=ShoppingCart)
+def forget_popularity(sender, instance, **kwargs):
+    if not row_handlers_suspended():
+        popularity.forget_links(sender, ((instance.recipe_id,
+                                          instance.created_at),))
+
+
+@receiver(post_save, sender=Recipe)
+def increase_recipes_count(instance, created, **kwargs):
+    if created and not row_handlers_suspended():
+        shift_counter(CustomUser, (instance.author_id,), 'recipes_count', 1)
+
+
+@receiver(post_delete, sender=Recipe)
+def decrease_recipes_count(instance, **kwargs):
+    if not row_handlers_suspended():
+        shift_counter(CustomUser, (instance.author_id,), 'recipes_count', -1)
+
+
+@receiver(post_save, sender=Subscription)
+def increase_subscription_counts(instance, created, **kwargs):
+    if created and not row_handlers_suspended():
+        shift_counter(CustomUser, (instance.subscriber_id,),
+                      'subscriptions_count', 1)
+        shift_counter(CustomUser, (instance.author_id,),
+                      'subscribers_count', 1)
+
+
+@receiver(post_delete, sender=Subscription)
+def decrease_subscription_counts(instance, **kwargs):
+    if row_handlers_suspended():
+        return
+    shift_counter(CustomUser, (instance.subscriber_id,),
+                  'subscriptions_count', -1)
+    shift_counter(CustomUser, (instance.author_id,), 'subscribers_count', -1)
+
+
+# Список покупок обновляется в той же транзакции, что и корзина.
+# Массовые операции так же, как со счётчиками, отключают эти
+# обработчики и сдвигают список сами
+
+
+@receiver(post_save, sender=ShoppingCart)
+def add_to_shopping_list(instance, created, **kwargs):
+    if created and not row_handlers_suspended():
+        shopping_lists.add_recipes(instance.user_id, (instance.recipe_id,))
+
+
+@receiver(post_delete, sender=ShoppingCart)
+def remove_from_shopping_list(instance, **kwargs):
+    if not row_handlers_suspended():
+        shopping_lists.remove_recipes(instance.user_id,
+                                      (instance.recipe_id,))
+
+
+@receiver(post_save, sender=RecipeIngredient)
+def update_shopping_lists_on_save(instance, created, **kwargs):
+    if row_handlers_suspended():
+        return
+    if created:
+        shopping_lists.shift_recipe_ingredients(
+            instance.recipe_id, {instance.ingredient_id: instance.amount}
+        )
+    else:
+        # Прежнее количество неизвестно, списки пересобираются
+        shopping_lists.rebuild(list(
+            ShoppingCart.objects.filter(recipe_id=instance.recipe_id)
+            .values_list('user_id', flat=True)
+        ))
+
+
+@receiver(post_delete, sender=RecipeIngredient)
+def update_shopping_lists_on_delete(instance, **kwargs):
+    if not row_handlers_suspended():
+        shopping_lists.shift_recipe_ingredients(
+            instance.recipe_id, {instance.ingredient_id: -instance.amount}
+        )
+
+
+# Обработчики лент подключены после счётчиков: при подписке
+# subscribers_count автора уже учитывает нового подписчика
+
+
+@receiver(post_save, sender=Subscription)
+def fill_feed_on_subscribe(instance, created, **kwargs):
+    if created:
+        backfill_subscription(instance.subscriber_id, instance.author_id)
+
+
+@receiver(post_delete, sender=Subscription)
+def clear_feed_on_unsubscribe(instance, **kwargs):
+    drop_subscription(instance.subscriber_id, instance.author_id)
@@ -1,3 +1,284 @@
-# from django.test import TestCase
+import json
+import shutil
+import tempfile
+from io import StringIO
+from pathlib import Path
+from unittest import mock
+from django.core.management import call_command
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.models import Count, Sum
+from PIL import Image
+from recipes.cache import bump_version, get_version
+from recipes.management.commands.generate_dataset import PLACEHOLDER_SIZE
+from recipes.models import (CustomUser, Favorite, FeedEntry, Ingredient,
+                            Recipe, RecipeIngredient, Subscription)
+from recipes.short_links import decode, encode
 
-# Create your tests here.
+
+def use_temporary_media(test):
+    # generate_dataset создаёт картинку-заглушку в хранилище
+    media_root = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, media_root)
+    settings_override = override_settings(MEDIA_ROOT=media_root)
+    settings_override.enable()
+    test.addCleanup(settings_override.disable)
+
+
+class LoadIngredientsTest(TestCase):
+
+    def setUp(self):
+        self.directory = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def write(self, name, content):
+        path = self.directory / name
+        path.write_text(content, encoding='utf-8')
+        return str(path)
+
+    def load(self, path, **options):
+        out = StringIO()
+        call_command('load_ingredients', path, stdout=out, **options)
+        return out.getvalue()
+
+    def test_csv_upserts(self):
+        Ingredient.objects.create(name='мука', measurement_unit='кг')
+        path = self.write('ingredients.csv',
+                          'мука,г\n  Сахар   песок ,г\n"соль, морская",г\n')
+        output = self.load(path, batch_size=2)
+        self.assertIn('Добавлено 2, обновлено 1, пропущено 0', output)
+        self.assertEqual(
+            dict(Ingredient.objects.values_list('name', 'measurement_unit')),
+            {'мука': 'г', 'Сахар песок': 'г', 'соль, морская': 'г'}
+        )
+        self.assertIn('пропущено 3', self.load(path))
+
+    def test_names_match_regardless_of_case(self):
+        Ingredient.objects.create(name='Tabasco', measurement_unit='г')
+        path = self.write('ingredients.json', json.dumps([
+            {'name': 'TABASCO', 'measurement_unit': 'мл'},
+            {'name': 'tabasco', 'measurement_unit': 'мл'},
+            {'name': 'Соль'},
+            {'measurement_unit': 'г'},
+            {'name': 'Перец', 'measurement_unit': 'г'},
+        ]))
+        output = self.load(path)
+        self.assertIn('Добавлено 1, обновлено 1, пропущено 3', output)
+        self.assertEqual(
+            dict(Ingredient.objects.values_list('name', 'measurement_unit')),
+            {'Tabasco': 'мл', 'Перец': 'г'}
+        )
+        self.assertIn('Добавлено 0, обновлено 0, пропущено 5',
+                      self.load(path))
+
+    def test_json_is_read_in_chunks(self):
+        items = [{'name': f'продукт {number}', 'measurement_unit': 'г'}
+                 for number in range(50)]
+        path = self.write('ingredients.json', json.dumps(items))
+        with mock.patch('recipes.management.commands.load_ingredients.'
+                        'READ_CHUNK_SIZE', 7):
+            output = self.load(path, batch_size=16)
+        self.assertIn('Добавлено 50', output)
+        self.assertEqual(Ingredient.objects.count(), 50)
+
+
+class ShortLinkCodeTest(TestCase):
+
+    def test_round_trip(self):
+        for number in (0, 1, 61, 62, 3843, 3844, 10 ** 12):
+            self.assertEqual(decode(encode(number)), number)
+        self.assertEqual(encode(61), 'Z')
+        self.assertEqual(encode(62), '10')
+        with self.assertRaises(ValueError):
+            decode('a-b')
+
+
+class VersionTest(TestCase):
+
+    def test_evicted_version_does_not_restart(self):
+        cache.clear()
+        first = get_version('test_version')
+        bumped = bump_version('test_version')
+        self.assertEqual(bumped, first + 1)
+        cache.delete('test_version')
+        self.assertGreater(get_version('test_version'), bumped)
+        cache.delete('test_version')
+        self.assertGreater(bump_version('test_version'), bumped)
+
+
+class GenerateDatasetTest(TestCase):
+
+    def setUp(self):
+        use_temporary_media(self)
+        Ingredient.objects.bulk_create(
+            Ingredient(name=f'продукт {number}', measurement_unit='г')
+            for number in range(40)
+        )
+
+    def generate(self, **options):
+        options = {'users': 30, 'recipes': 60, 'favorites': 100, 'cart': 20,
+                   'subscriptions': 80, 'batch_size': 25, **options}
+        call_command('generate_dataset', stdout=StringIO(), **options)
+
+    def test_dataset(self):
+        self.generate(seed=7, min_ingredients=2, max_ingredients=5)
+        self.assertEqual(CustomUser.objects.count(), 30)
+        self.assertEqual(Recipe.objects.count(), 60)
+        self.assertEqual(Favorite.objects.count(), 100)
+        self.assertEqual(Subscription.objects.count(), 80)
+        counts = RecipeIngredient.objects.order_by().values('recipe').annotate(
+            total=Count('id')
+        ).values_list('total', flat=True)
+        self.assertTrue(all(2 <= total <= 5 for total in counts))
+        self.assertEqual(
+            CustomUser.objects.aggregate(total=Sum('recipes_count'))['total'],
+            60
+        )
+        self.assertEqual(
+            Recipe.objects.aggregate(total=Sum('favorites_count'))['total'],
+            100
+        )
+        self.assertTrue(FeedEntry.objects.exists())
+        with Recipe.objects.first().image.open() as file:
+            self.assertEqual(Image.open(file).size, PLACEHOLDER_SIZE)
+        with self.assertRaises(CommandError):
+            self.generate(seed=7)
+
+    def test_reproducible(self):
+        def snapshot():
+            return sorted(Subscription.objects.values_list(
+                'subscriber__username', 'author__username'
+            ))
+        self.generate(seed=3)
+        first = snapshot()
+        CustomUser.objects.all().delete()
+        self.generate(seed=3)
+        self.assertEqual(snapshot(), first)
+
+
+class BenchmarkApiTest(TestCase):
+
+    def setUp(self):
+        use_temporary_media(self)
+        Ingredient.objects.bulk_create(
+            Ingredient(name=f'продукт {number}', measurement_unit='г')
+            for number in range(20)
+        )
+        call_command('generate_dataset', users=10, recipes=20, favorites=30,
+                     cart=10, subscriptions=20, seed=1, stdout=StringIO())
+        self.directory = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def benchmark(self, **options):
+        call_command('benchmark_api', iterations=2, warmup=0,
+                     stdout=StringIO(), **options)
+
+    def test_output_and_baseline(self):
+        path = self.directory / 'baseline.json'
+        self.benchmark(output=str(path))
+        results = json.loads(path.read_text(encoding='utf-8'))['results']
+        self.assertEqual(results['authenticated RecipeViewSet.feed']['status'],
+                         200)
+        self.assertNotIn('anonymous RecipeViewSet.feed', results)
+        self.benchmark(baseline=str(path), max_latency_regression=100,
+                       max_throughput_regression=1)
+
+        for result in results.values():
+            result['queries'] = -1
+        path.write_text(json.dumps({'results': results}), encoding='utf-8')
+        with self.assertRaises(CommandError):
+            self.benchmark(baseline=str(path), max_latency_regression=100,
+                           max_throughput_regression=1)
+
+
+class AdminChangelistTest(TestCase):
+    URLS = ('/admin/recipes/recipe/',
+            '/admin/recipes/recipe/?cooking_time_range=%3C&author=1',
+            '/admin/recipes/ingredient/?is_used_in_recipes=yes&o=3',
+            '/admin/recipes/customuser/')
+
+    def setUp(self):
+        cache.clear()
+        use_temporary_media(self)
+        Ingredient.objects.bulk_create(
+            Ingredient(name=f'продукт {number}', measurement_unit='г')
+            for number in range(20)
+        )
+        self.admin = CustomUser.objects.create_superuser(
+            email='admin@example.com', username='admin', password='admin',
+            first_name='Админ', last_name='Админов'
+        )
+        self.client.force_login(self.admin)
+
+    def generate(self, seed, recipes):
+        call_command('generate_dataset', users=10, recipes=recipes,
+                     favorites=10, cart=5, subscriptions=10, seed=seed,
+                     stdout=StringIO())
+
+    def query_counts(self):
+        counts = []
+        for url in self.URLS:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            counts.append(len(queries))
+        return counts
+
+    def test_queries_do_not_grow_with_rows(self):
+        self.generate(seed=1, recipes=5)
+        self.query_counts()
+        small = self.query_counts()
+        self.generate(seed=2, recipes=40)
+        cache.clear()
+        self.query_counts()
+        self.assertEqual(self.query_counts(), small)
+
+    def test_cooking_time_borders_are_cached(self):
+        self.generate(seed=1, recipes=30)
+        changelist = self.client.get('/admin/recipes/recipe/')
+        filter_spec = next(
+            spec for spec in changelist.context['cl'].filter_specs
+            if spec.parameter_name == 'cooking_time_range'
+        )
+        shortest, longest = (filter_spec.shortest_border,
+                             filter_spec.longest_border)
+        times = sorted(set(Recipe.objects.values_list('cooking_time',
+                                                      flat=True)))
+        self.assertEqual(shortest, times[len(times) // 3])
+        self.assertEqual(longest, times[2 * len(times) // 3])
+        fast = self.client.get('/admin/recipes/recipe/?cooking_time_range=%3C')
+        self.assertEqual(
+            fast.context['cl'].result_count,
+            Recipe.objects.filter(cooking_time__lt=shortest).count()
+        )
+
+        Recipe.objects.update(cooking_time=1)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/admin/recipes/recipe/')
+        self.assertFalse(any('DISTINCT' in query['sql']
+                             for query in queries))
+
+    def test_ingredient_recipes_count(self):
+        self.generate(seed=1, recipes=10)
+        response = self.client.get(
+            '/admin/recipes/ingredient/?is_used_in_recipes=no'
+        )
+        unused = set(Ingredient.objects.exclude(
+            recipe_ingredients__isnull=False
+        ).values_list('id', flat=True))
+        page = response.context['cl'].result_list
+        self.assertEqual({ingredient.id for ingredient in page}, unused)
+        self.assertTrue(all(ingredient.recipes_count == 0
+                            for ingredient in page))
+        used = self.client.get(
+            '/admin/recipes/ingredient/?is_used_in_recipes=yes'
+        ).context['cl'].result_list
+        self.assertTrue(all(
+            ingredient.recipes_count == RecipeIngredient.objects.filter(
+                ingredient=ingredient
+            ).count()
+            for ingredient in used
+        ))
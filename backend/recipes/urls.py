@@ -1,7 +1,8 @@
 from django.urls import path
-from recipes.views import short_recipe_view
+from recipes.views import recipe_id_redirect_view, short_recipe_view
 
 
 urlpatterns = [
-    path('s/<int:recipe_id>/', short_recipe_view, name='short-link'),
+    path('r/<str:code>/', short_recipe_view, name='short-link'),
+    path('s/<int:recipe_id>/', recipe_id_redirect_view),
 ]
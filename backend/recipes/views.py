@@ -1,9 +1,25 @@
+from django.http import Http404
 from django.shortcuts import redirect
-from rest_framework.exceptions import ValidationError
-from recipes.models import Recipe
+from recipes.short_links import clicks, decode, recipe_ids
 
 
-def short_recipe_view(request, recipe_id):
-    if not Recipe.objects.filter(id=recipe_id).exists():
-        raise ValidationError(f'Рецепт с id {recipe_id} не найден')
+def redirect_to_recipe(recipe_id):
+    # Без запросов к базе: id проверяется по набору в памяти,
+    # переход записывается в буфер
+    if recipe_id not in recipe_ids:
+        raise Http404(f'Рецепт с id {recipe_id} не найден')
+    clicks.record(recipe_id)
     return redirect(f'/recipes/{recipe_id}/')
+
+
+def short_recipe_view(request, code):
+    try:
+        recipe_id = decode(code)
+    except ValueError:
+        raise Http404(f'Неверный код ссылки: {code}')
+    return redirect_to_recipe(recipe_id)
+
+
+def recipe_id_redirect_view(request, recipe_id):
+    # Короткие ссылки с id рецепта, выданные до появления кодов
+    return redirect_to_recipe(recipe_id)